@@ -1,13 +1,18 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, send_file
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, send_file, g
 from flask_sqlalchemy import SQLAlchemy
+from jinja2 import nodes
+from jinja2.ext import Extension
+from sqlalchemy import event
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, timedelta
-import pandas as pd
+import atexit
 import io
 import os
 import sys
+import threading
 import markdown
+import snowballstemmer
 import requests
 from bs4 import BeautifulSoup
 import random
@@ -17,7 +22,7 @@ from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib import colors
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
-from functools import wraps
+from functools import lru_cache, wraps
 import re
 try:
     import phonenumbers
@@ -25,6 +30,11 @@ try:
 except ImportError:
     PHONENUMBERS_AVAILABLE = False
     print("⚠️  phonenumbers не доступен, используем упрощенную валидацию")
+try:
+    import redis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
 
 # Load environment variables from .env file
 try:
@@ -120,15 +130,323 @@ app.config.update({
 })
 mail.init_app(app)
 
+# ======================
+# Хэширование паролей
+# ======================
+# Метод и стоимость werkzeug, например 'pbkdf2:sha256:600000' (по умолчанию werkzeug 2.3),
+# 'pbkdf2:sha256:200000' или 'scrypt:32768:8:1'. Хэши другого метода пересчитываются при входе.
+PASSWORD_HASH_METHOD = os.getenv('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:600000')
+_password_rehash_executor = None
+_password_hash_prefixes = {}
+
+
+def _rehash_executor():
+    """Отдельный поток для отложенного пересчёта хэшей — вход не ждёт нового хэша."""
+    global _password_rehash_executor
+    if _password_rehash_executor is None:
+        from concurrent.futures import ThreadPoolExecutor
+        _password_rehash_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='umay-rehash')
+    return _password_rehash_executor
+
+
+def hash_password(password: str) -> str:
+    """Хэш пароля текущим PASSWORD_HASH_METHOD."""
+    return generate_password_hash(password, method=PASSWORD_HASH_METHOD)
+
+
+def verify_password(stored_hash: str, password: str) -> bool:
+    if not stored_hash or password is None:
+        return False
+    return check_password_hash(stored_hash, password)
+
+
+def password_needs_rehash(stored_hash: str) -> bool:
+    """True, если хэш посчитан другим методом или с другой стоимостью, чем PASSWORD_HASH_METHOD."""
+    method = PASSWORD_HASH_METHOD
+    if method not in _password_hash_prefixes:
+        # werkzeug дописывает параметры по умолчанию ('scrypt' -> 'scrypt:32768:8:1') — берём их из пробного хэша
+        _password_hash_prefixes[method] = generate_password_hash('', method=method).split('$', 1)[0]
+    return (stored_hash or '').split('$', 1)[0] != _password_hash_prefixes[method]
+
+
+def schedule_password_rehash(user, password: str):
+    """Пересчитывает хэш после успешного входа в фоне, не задерживая ответ."""
+    model, user_id, old_hash, cache_key = type(user), user.id, user.password, user.get_id()
+
+    def rehash():
+        new_hash = generate_password_hash(password, method=PASSWORD_HASH_METHOD)
+        with app.app_context():
+            # Условие по старому хэшу: пароль, сменённый за это время, не перезаписываем
+            updated = model.query.filter_by(id=user_id, password=old_hash).update(
+                {'password': new_hash}, synchronize_session=False)
+            db.session.commit()
+        user_cache.pop(cache_key)
+        if updated:
+            logger.info(f"🔐 Password hash upgraded to {PASSWORD_HASH_METHOD.split(':')[0]} for {cache_key}")
+        return bool(updated)
+
+    return _rehash_executor().submit(rehash)
+
+# ======================
+# Rate limiting: скользящие окна по IP и по идентификатору (логин, email)
+# ======================
+RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+app.config['RATELIMIT_ENABLED'] = RATE_LIMIT_ENABLED
+# Общий backend для нескольких процессов/инстансов; без него окна считаются в памяти процесса
+RATE_LIMIT_REDIS_URL = os.getenv('RATE_LIMIT_REDIS_URL', os.getenv('REDIS_URL', ''))
+# Сколько прокси (Railway/Render) дописывают X-Forwarded-For перед приложением. По умолчанию 0:
+# без прокси заголовок присылает сам клиент, и доверять ему нельзя — ключом служит remote_addr
+RATE_LIMIT_TRUSTED_PROXIES = int(os.getenv('RATE_LIMIT_TRUSTED_PROXIES', '0'))
+
+
+class InProcessRateLimitBackend:
+    """Окна в памяти процесса: отдельный SlidingWindowCounter на каждое правило."""
+
+    def __init__(self, maxsize: int = 10000):
+        import threading
+        self.maxsize = maxsize
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def _counter(self, name: str, window: int):
+        with self._lock:
+            counter = self._counters.get(name)
+            if counter is None:
+                counter = self._counters[name] = SlidingWindowCounter(window=window, maxsize=self.maxsize)
+            return counter
+
+    def hit(self, name: str, key: str, limit: int, window: int) -> float:
+        """Регистрирует запрос; 0 — пропустить, иначе через сколько секунд можно повторить."""
+        counter = self._counter(name, window)
+        allowed, _ = counter.acquire(key, limit)
+        return 0.0 if allowed else max(counter.retry_after(key), 1.0)
+
+    def check(self, name: str, key: str, limit: int, window: int) -> float:
+        """Как hit(), но без регистрации запроса."""
+        counter = self._counter(name, window)
+        if counter.count(key) < limit:
+            return 0.0
+        return max(counter.retry_after(key), 1.0)
+
+    def record(self, name: str, key: str, window: int) -> None:
+        self._counter(name, window).acquire(key, float('inf'))
+
+    def forget(self, name: str, key: str) -> None:
+        counter = self._counters.get(name)
+        if counter is not None:
+            counter.discard(key)
+
+    def reset(self) -> None:
+        with self._lock:
+            for counter in self._counters.values():
+                counter.clear()
+
+
+class RedisRateLimitBackend:
+    """Окна в Redis (sorted set на ключ): лимиты общие для всех процессов."""
+
+    def __init__(self, url: str):
+        self.client = redis.Redis.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5)
+
+    def hit(self, name: str, key: str, limit: int, window: int) -> float:
+        import time
+        import uuid
+        now = time.time()
+        redis_key = f'umay:rl:{name}:{key}'
+        member = f'{now}:{uuid.uuid4().hex[:8]}'
+        pipe = self.client.pipeline()
+        pipe.zremrangebyscore(redis_key, 0, now - window)
+        pipe.zadd(redis_key, {member: now})
+        pipe.zcard(redis_key)
+        pipe.zrange(redis_key, 0, 0, withscores=True)
+        pipe.expire(redis_key, int(window) + 1)
+        _, _, count, oldest, _ = pipe.execute()
+        if count <= limit:
+            return 0.0
+        self.client.zrem(redis_key, member)
+        return max(oldest[0][1] + window - now, 1.0) if oldest else float(window)
+
+    def check(self, name: str, key: str, limit: int, window: int) -> float:
+        import time
+        now = time.time()
+        redis_key = f'umay:rl:{name}:{key}'
+        pipe = self.client.pipeline()
+        pipe.zremrangebyscore(redis_key, 0, now - window)
+        pipe.zcard(redis_key)
+        pipe.zrange(redis_key, 0, 0, withscores=True)
+        _, count, oldest = pipe.execute()
+        if count < limit:
+            return 0.0
+        return max(oldest[0][1] + window - now, 1.0) if oldest else float(window)
+
+    def record(self, name: str, key: str, window: int) -> None:
+        import time
+        import uuid
+        now = time.time()
+        redis_key = f'umay:rl:{name}:{key}'
+        pipe = self.client.pipeline()
+        pipe.zadd(redis_key, {f'{now}:{uuid.uuid4().hex[:8]}': now})
+        pipe.expire(redis_key, int(window) + 1)
+        pipe.execute()
+
+    def forget(self, name: str, key: str) -> None:
+        self.client.delete(f'umay:rl:{name}:{key}')
+
+    def reset(self) -> None:
+        for redis_key in self.client.scan_iter('umay:rl:*'):
+            self.client.delete(redis_key)
+
+
+class RateLimiter:
+    """Выбирает backend и считает пропущенные/отклонённые запросы по правилам."""
+
+    def __init__(self):
+        import threading
+        from collections import Counter as TallyCounter
+        self.local = InProcessRateLimitBackend()
+        self.shared = None
+        if RATE_LIMIT_REDIS_URL and REDIS_AVAILABLE:
+            self.shared = RedisRateLimitBackend(RATE_LIMIT_REDIS_URL)
+        elif RATE_LIMIT_REDIS_URL:
+            logger.warning("⚠️ RATE_LIMIT_REDIS_URL задан, но пакет redis не установлен — лимиты в памяти процесса")
+        self.policies = {}
+        self.allowed = TallyCounter()
+        self.limited = TallyCounter()
+        self._lock = threading.Lock()
+
+    def _call(self, method: str, *args):
+        if self.shared is not None:
+            try:
+                return getattr(self.shared, method)(*args)
+            except Exception as e:
+                # Недоступный Redis не должен ронять вход — считаем в памяти процесса
+                logger.warning(f"Rate limit backend error, using in-process windows: {e}")
+        return getattr(self.local, method)(*args)
+
+    def _tally(self, name: str, retry_after: float) -> float:
+        with self._lock:
+            (self.limited if retry_after else self.allowed)[name] += 1
+        return retry_after
+
+    def hit(self, name: str, key: str, limit: int, window: int) -> float:
+        return self._tally(name, self._call('hit', name, key, limit, window))
+
+    def check(self, name: str, key: str, limit: int, window: int) -> float:
+        """Проверяет окно, не регистрируя запрос (для правил, считающих только неудачи)."""
+        return self._tally(name, self._call('check', name, key, limit, window))
+
+    def record(self, name: str, key: str, window: int) -> None:
+        self._call('record', name, key, window)
+
+    def forget(self, name: str, key: str) -> None:
+        self._call('forget', name, key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                name: dict(policy, allowed=self.allowed[name], limited=self.limited[name])
+                for name, policy in self.policies.items()
+            }
+
+    def reset(self) -> None:
+        self.local.reset()
+        if self.shared is not None:
+            self.shared.reset()
+        with self._lock:
+            self.allowed.clear()
+            self.limited.clear()
+
+
+rate_limiter = RateLimiter()
+
+
+def client_ip() -> str:
+    """IP клиента с учётом RATE_LIMIT_TRUSTED_PROXIES доверенных прокси перед приложением."""
+    forwarded = [ip.strip() for ip in request.headers.get('X-Forwarded-For', '').split(',') if ip.strip()]
+    if RATE_LIMIT_TRUSTED_PROXIES and len(forwarded) >= RATE_LIMIT_TRUSTED_PROXIES:
+        return forwarded[-RATE_LIMIT_TRUSTED_PROXIES]
+    return request.remote_addr or ''
+
+
+def rate_limit_key(scope: str):
+    """'ip' или 'form:<поле>' -> функция, возвращающая ключ окна для текущего запроса."""
+    if scope == 'ip':
+        return client_ip
+    if scope.startswith('form:'):
+        field = scope.split(':', 1)[1]
+        return lambda: (request.form.get(field) or '').strip().lower()
+    raise ValueError(f"Unknown rate limit scope: {scope}")
+
+
+def rate_limited_response(retry_after: float):
+    message = 'Слишком много попыток. Попробуйте позже.'
+    if request.path.startswith('/api/') or request.is_json:
+        response = jsonify({'error': message, 'retry_after': int(retry_after)})
+    else:
+        response = app.make_response(render_template('error.html', error=message))
+    response.status_code = 429
+    response.headers['Retry-After'] = str(int(retry_after))
+    return response
+
+
+def rate_limit_success() -> None:
+    """Отмечает запрос как успешный: правила failures_only сбрасывают окно ключа, а не пополняют."""
+    g.rate_limit_success = True
+
+
+def rate_limit(name: str, limit: int, window: int, scope: str = 'ip', methods=('POST',), failures_only: bool = False):
+    """Декоратор маршрута: не больше limit запросов за window секунд на ключ scope.
+
+    Лимит можно переопределить переменной окружения RATE_LIMIT_<NAME>="limit/window".
+    Проверка идёт до кода маршрута, то есть до любых запросов в базу. С failures_only
+    считаются только запросы, в которых маршрут не вызвал rate_limit_success(), а успех
+    обнуляет окно — чужие неверные пароли не блокируют владельца логина надолго.
+    """
+    override = os.getenv(f"RATE_LIMIT_{name.upper().replace('-', '_')}")
+    if override:
+        limit, window = (int(part) for part in override.split('/'))
+    rate_limiter.policies[name] = {'limit': limit, 'window': window, 'scope': scope,
+                                   'failures_only': failures_only}
+    key_func = rate_limit_key(scope)
+
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            key = None
+            if request.method in methods and app.config.get('RATELIMIT_ENABLED', True):
+                key = key_func()
+                if key:
+                    if failures_only:
+                        retry_after = rate_limiter.check(name, key, limit, window)
+                    else:
+                        retry_after = rate_limiter.hit(name, key, limit, window)
+                    if retry_after:
+                        logger.warning(f"🚦 Rate limit {name}: {request.path} ({scope})")
+                        return rate_limited_response(retry_after)
+            response = f(*args, **kwargs)
+            if failures_only and key:
+                if g.pop('rate_limit_success', False):
+                    rate_limiter.forget(name, key)
+                else:
+                    rate_limiter.record(name, key, window)
+            return response
+        return decorated_function
+    return decorator
+
 # Email verification settings
 EMAIL_VERIFICATION_TTL_HOURS = int(os.getenv('EMAIL_VERIFICATION_TTL_HOURS', '24'))
 
 # Email verification functions
 def generate_email_token():
-    """Generate secure token for email verification"""
+    """Generate secure token for email verification.
+
+    Подписывается случайный nonce, поэтому токены разные даже для регистраций
+    в одну и ту же секунду (метка времени itsdangerous — с точностью до секунды).
+    """
+    import secrets
     from itsdangerous import URLSafeTimedSerializer
     serializer = URLSafeTimedSerializer(app.config['SECRET_KEY'])
-    return serializer.dumps('email_verification', salt='email-verification')
+    return serializer.dumps(secrets.token_urlsafe(16), salt='email-verification')
 
 def verify_email_token(token, expiration=EMAIL_VERIFICATION_TTL_HOURS * 3600):
     """Verify email verification token"""
@@ -142,89 +460,38 @@ def verify_email_token(token, expiration=EMAIL_VERIFICATION_TTL_HOURS * 3600):
     except BadSignature:
         return False, "Неверная ссылка подтверждения"
 
-def send_verification_email(email, token, user_type, app_type, purpose='register'):
-    """Send email verification email"""
-    try:
-        if purpose == 'reset':
-            verification_url = url_for('reset_password', token=token, _external=True)
-            subject = "Восстановление пароля - UMAY"
-            header_text = "🔐 Восстановление пароля"
-            content_text = f"Для восстановления пароля в системе UMAY {app_type.upper()} нажмите на кнопку ниже:"
-            button_text = "🔄 Сбросить пароль"
-            footer_text = "Если вы не запрашивали восстановление пароля, просто проигнорируйте это письмо."
-            ttl_text = "Ссылка действительна в течение 1 часа."
-        else:
-            verification_url = url_for('verify_email', token=token, _external=True)
-            subject = "Подтвердите ваш email - UMAY"
-            header_text = "🎉 Добро пожаловать в UMAY!"
-            content_text = f"Спасибо за регистрацию в системе UMAY {app_type.upper()}! Для завершения регистрации нажмите на кнопку ниже:"
-            button_text = "✅ Подтвердить Email"
-            footer_text = "Если вы не регистрировались в UMAY, просто проигнорируйте это письмо."
-            ttl_text = f"Ссылка действительна в течение {EMAIL_VERIFICATION_TTL_HOURS} часов."
-        
-        html_body = f"""
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <meta charset="utf-8">
-            <meta name="viewport" content="width=device-width, initial-scale=1.0">
-            <title>{subject}</title>
-            <style>
-                body {{ font-family: Arial, sans-serif; line-height: 1.6; color: #333; }}
-                .container {{ max-width: 600px; margin: 0 auto; padding: 20px; }}
-                .header {{ background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); color: white; padding: 30px; text-align: center; border-radius: 10px 10px 0 0; }}
-                .content {{ background: #f9f9f9; padding: 30px; border-radius: 0 0 10px 10px; }}
-                .button {{ display: inline-block; background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); color: white; padding: 15px 30px; text-decoration: none; border-radius: 25px; font-weight: bold; margin: 20px 0; }}
-                .footer {{ text-align: center; margin-top: 30px; color: #666; font-size: 14px; }}
-            </style>
-        </head>
-        <body>
-            <div class="container">
-                <div class="header">
-                    <h1>{header_text}</h1>
-                    <p>{'Подтвердите ваш email для завершения регистрации' if purpose == 'register' else 'Восстановите доступ к вашему аккаунту'}</p>
-                </div>
-                <div class="content">
-                    <h2>Здравствуйте!</h2>
-                    <p>{content_text}</p>
-                    
-                    <div style="text-align: center;">
-                        <a href="{verification_url}" class="button">{button_text}</a>
-                    </div>
-                    
-                    <p><strong>Или скопируйте эту ссылку в браузер:</strong></p>
-                    <p style="word-break: break-all; background: #f0f0f0; padding: 10px; border-radius: 5px;">
-                        {verification_url}
-                    </p>
-                    
-                    <p><em>{ttl_text}</em></p>
-                </div>
-                <div class="footer">
-                    <p>© 2024 UMAY. Все права защищены.</p>
-                    <p>{footer_text}</p>
-                </div>
-            </div>
-        </body>
-        </html>
-        """
-        
-        from flask_mail import Message
-        msg = Message(subject, recipients=[email])
-        msg.html = html_body
-        
-        mail.send(msg)
-        return True, "Email отправлен успешно"
-    except Exception as e:
-        logger.error(f"Error sending verification email: {e}")
-        return False, f"Ошибка отправки email: {str(e)}"
+def queue_verification_email(email, token, user_type, app_type, purpose='register'):
+    """Кладёт письмо подтверждения/сброса пароля в outbox (в текущей транзакции).
+
+    Письмо уходит фоновым отправителем (process_email_outbox) после коммита,
+    поэтому запрос не ждёт SMTP. Коммит остаётся за вызывающим кодом.
+    """
+    if purpose == 'reset':
+        verification_url = url_for('reset_password', token=token, _external=True)
+        subject = "Восстановление пароля - UMAY"
+        ttl_hours = 1
+    else:
+        verification_url = url_for('verify_email', token=token, _external=True)
+        subject = "Подтвердите ваш email - UMAY"
+        ttl_hours = EMAIL_VERIFICATION_TTL_HOURS
+    context = dict(subject=subject, purpose=purpose, app_type=app_type,
+                   verification_url=verification_url, ttl_hours=ttl_hours)
+    message = EmailOutbox(
+        recipient=email,
+        subject=subject,
+        html_body=render_template('email/verification.html', **context),
+        text_body=render_template('email/verification.txt', **context),
+    )
+    db.session.add(message)
+    return message
 
 # Markdown filter for templates
 @app.template_filter('markdown')
 def markdown_filter(text):
-    """Convert markdown text to HTML"""
+    """Convert markdown text to HTML (через LRU-кэш render_markdown_cached)"""
     if not text:
         return ""
-    return markdown.markdown(text, extensions=['extra', 'codehilite'])
+    return render_markdown_cached(text, 'article')
 
 # Mobile device detection
 def is_mobile_device():
@@ -287,9 +554,7 @@ def verify_email(token):
         
         # Find and update user
         if verification_record.purpose == 'register':
-            user = db.session.query(UserPro).filter_by(email_verification_token=token).first()
-            if not user:
-                user = db.session.query(UserMama).filter_by(email_verification_token=token).first()
+            user = find_user('token', token)
             
             if user:
                 user.is_email_verified = True
@@ -304,6 +569,8 @@ def verify_email(token):
     return redirect(url_for('register'))
 
 @app.route('/resend-verification', methods=['POST'])
+@rate_limit('resend_ip', 10, 600)
+@rate_limit('resend_email', 1, 60, scope='form:email')
 def resend_verification():
     """Resend email verification link to user"""
     try:
@@ -315,9 +582,7 @@ def resend_verification():
             return redirect(url_for('login'))
 
         # Find user by email in both tables
-        user = db.session.query(UserPro).filter_by(email=email).first()
-        if not user:
-            user = db.session.query(UserMama).filter_by(email=email).first()
+        user = find_user('email', email)
 
         if not user:
             flash('Пользователь с таким email не найден.', 'error')
@@ -327,20 +592,7 @@ def resend_verification():
             flash('Email уже подтвержден. Можете войти в систему.', 'success')
             return redirect(url_for('login'))
 
-        # Throttle repeat sends (min interval 60 seconds)
-        last = (
-            db.session.query(EmailVerification)
-            .filter_by(email=email, purpose='register')
-            .order_by(EmailVerification.created_at.desc())
-            .first()
-        )
-        if last:
-            from datetime import datetime
-            delta_sec = (datetime.utcnow() - last.created_at).total_seconds()
-            if delta_sec < 60:
-                remaining = 60 - int(delta_sec)
-                flash(f'Пожалуйста, подождите {remaining} сек перед повторной отправкой.', 'error')
-                return redirect(url_for('login'))
+        # Повторная отправка не чаще раза в минуту — правило resend_email (rate_limit)
 
         # Generate new token and update user + create verification record
         token = generate_email_token()
@@ -356,13 +608,11 @@ def resend_verification():
             expires_at=expires
         )
         db.session.add(verification)
+        queue_verification_email(email, token, user.user_type, user.app_type, purpose='register')
         db.session.commit()
+        email_outbox_job.wake()
 
-        ok, message = send_verification_email(email, token, user.user_type, user.app_type, purpose='register')
-        if not ok:
-            flash(message, 'error')
-        else:
-            flash('Письмо с подтверждением отправлено повторно.', 'success')
+        flash('Письмо с подтверждением отправлено повторно.', 'success')
         return redirect(url_for('login'))
     except Exception as e:
         logger.exception(f"Resend verification error: {e}")
@@ -395,13 +645,11 @@ def reset_password(token):
         verification_record = db.session.query(EmailVerification).filter_by(token=token).first()
         if verification_record and verification_record.purpose == 'reset':
             # Find user by email
-            user = db.session.query(UserPro).filter_by(email=verification_record.email).first()
-            if not user:
-                user = db.session.query(UserMama).filter_by(email=verification_record.email).first()
+            user = find_user('email', verification_record.email)
             
             if user:
                 # Update password
-                user.password = generate_password_hash(new_password)
+                user.password = hash_password(new_password)
                 
                 # Mark verification as completed and delete
                 db.session.delete(verification_record)
@@ -468,11 +716,45 @@ def service_worker():
     return send_file('static/js/sw.js', mimetype='application/javascript')
 
 # ======================
-# OTP helpers
+# SMS / OTP configuration
+# ======================
+SMS_PROVIDER = os.getenv('SMS_PROVIDER', 'infobip').lower()
+SMS_BASE_URL = os.getenv('SMS_BASE_URL', '')
+SMS_API_KEY = os.getenv('SMS_API_KEY', '')
+SMS_SENDER = os.getenv('SMS_SENDER', 'UMAY')
+# Таймауты HTTP к провайдеру: (соединение, ответ), секунды
+SMS_CONNECT_TIMEOUT = float(os.getenv('SMS_CONNECT_TIMEOUT', '3'))
+SMS_READ_TIMEOUT = float(os.getenv('SMS_READ_TIMEOUT', '10'))
+# Свои адрес/ключ для каждого провайдера; по умолчанию — общие SMS_BASE_URL/SMS_API_KEY
+SMS_PROVIDERS = {
+    'infobip': {
+        'base_url': os.getenv('INFOBIP_BASE_URL', SMS_BASE_URL),
+        'api_key': os.getenv('INFOBIP_API_KEY', SMS_API_KEY),
+    },
+    'mobizon': {
+        'base_url': os.getenv('MOBIZON_BASE_URL', SMS_BASE_URL),
+        'api_key': os.getenv('MOBIZON_API_KEY', SMS_API_KEY),
+    },
+}
+# Порядок попыток: основной провайдер, для Mobizon — Infobip как запасной
+SMS_PROVIDER_ORDER = ['mobizon', 'infobip'] if SMS_PROVIDER == 'mobizon' else ['infobip']
+
+ONLY_KZ_NUMBERS = os.getenv('ONLY_KZ_NUMBERS', 'true').lower() == 'true'
+OTP_TTL_SEC = int(os.getenv('OTP_TTL_SEC', '300'))
+OTP_RESEND_COOLDOWN_SEC = int(os.getenv('OTP_RESEND_COOLDOWN_SEC', '60'))
+OTP_MAX_PER_DAY = int(os.getenv('OTP_MAX_PER_DAY', '5'))
+OTP_MAX_ATTEMPTS = int(os.getenv('OTP_MAX_ATTEMPTS', '5'))
+# Дневной лимит считается в скользящем окне (по умолчанию 24 часа)
+OTP_SEND_WINDOW_SEC = int(os.getenv('OTP_SEND_WINDOW_SEC', '86400'))
+# Сколько хранить истёкшие коды и отправленные SMS (не меньше окна лимита)
+OTP_RETENTION_SEC = max(int(os.getenv('OTP_RETENTION_SEC', '86400')), OTP_SEND_WINDOW_SEC)
+OTP_PURGE_INTERVAL = float(os.getenv('OTP_PURGE_INTERVAL', '3600'))
+
 # ======================
-# Email verification helpers
+# OTP helpers
 # ======================
-# (Functions moved to email verification section above)
+def normalize_phone(raw_phone: str) -> str:
+    """Телефон в формате E.164 или пустая строка, если номер некорректен."""
     phone = ''.join(c for c in (raw_phone or '') if c.isdigit() or c == '+')
     
     if PHONENUMBERS_AVAILABLE:
@@ -501,30 +783,85 @@ def service_worker():
             phone = '+7' + phone
         return phone if len(phone) >= 10 else ''
 
-def can_resend_otp(last_sent_at: datetime) -> bool:
-    if not last_sent_at:
-        return True
-    return (datetime.utcnow() - last_sent_at).total_seconds() >= OTP_RESEND_COOLDOWN_SEC
-
-def count_otp_sent_today(phone: str, purpose: str) -> int:
-    start_of_day = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
-    return OTPCode.query.filter(
+def load_otp_send_times(phone: str, purpose: str) -> list:
+    """Моменты отправки кодов за окно лимита — только для первичного заполнения otp_send_window."""
+    since = datetime.utcnow() - timedelta(seconds=OTP_SEND_WINDOW_SEC)
+    rows = db.session.query(OTPCode.created_at).filter(
         OTPCode.phone == phone,
         OTPCode.purpose == purpose,
-        OTPCode.created_at >= start_of_day
-    ).count()
+        OTPCode.created_at >= since
+    ).order_by(OTPCode.created_at.desc()).limit(OTP_MAX_PER_DAY).all()
+    return sorted(row.created_at for row in rows)
 
 def generate_otp_code() -> str:
     return f"{random.randint(100000, 999999)}"
 
+class CircuitBreaker:
+    """Размыкатель: после failure_threshold ошибок подряд провайдер пропускается
+    reset_timeout секунд, затем пропускается одна пробная попытка."""
+
+    def __init__(self, name: str, failure_threshold: int = 3, reset_timeout: float = 60):
+        import threading
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        import time
+        if self.opened_at is None:
+            return 'closed'
+        return 'half-open' if time.monotonic() - self.opened_at >= self.reset_timeout else 'open'
+
+    def allow(self) -> bool:
+        return self.state != 'open'
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self) -> None:
+        import time
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logger.warning(f"⚡ SMS provider {self.name} disabled for {self.reset_timeout}s")
+                self.opened_at = time.monotonic()
+
+
+SMS_BREAKER_THRESHOLD = int(os.getenv('SMS_BREAKER_THRESHOLD', '3'))
+SMS_BREAKER_RESET_SEC = float(os.getenv('SMS_BREAKER_RESET_SEC', '60'))
+sms_breakers = {name: CircuitBreaker(name, SMS_BREAKER_THRESHOLD, SMS_BREAKER_RESET_SEC) for name in SMS_PROVIDERS}
+_sms_sessions = {}
+
+
+def sms_session(provider: str):
+    """Общий keep-alive requests.Session провайдера (соединения переиспользуются)."""
+    session_obj = _sms_sessions.get(provider)
+    if session_obj is None:
+        from requests.adapters import HTTPAdapter
+        session_obj = requests.Session()
+        session_obj.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=0))
+        session_obj.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=0))
+        session_obj.headers['User-Agent'] = 'UMAY-App/1.0'
+        _sms_sessions[provider] = session_obj
+    return session_obj
+
+
 def send_sms_infobip(phone: str, text: str) -> bool:
-    if not SMS_BASE_URL or not SMS_API_KEY:
-        logger.error('SMS config is missing')
+    config = SMS_PROVIDERS['infobip']
+    if not config['base_url'] or not config['api_key']:
+        logger.error('Infobip SMS config is missing')
         return False
     try:
-        url = SMS_BASE_URL.rstrip('/') + '/sms/2/text/advanced'
+        url = config['base_url'].rstrip('/') + '/sms/2/text/advanced'
         headers = {
-            'Authorization': f'App {SMS_API_KEY}',
+            'Authorization': f"App {config['api_key']}",
             'Content-Type': 'application/json'
         }
         message_obj = {
@@ -535,146 +872,122 @@ def send_sms_infobip(phone: str, text: str) -> bool:
         # if SMS_SENDER:
         #     message_obj['from'] = SMS_SENDER
         payload = {'messages': [message_obj]}
-        resp = requests.post(url, json=payload, headers=headers, timeout=10)
+        resp = sms_session('infobip').post(url, json=payload, headers=headers,
+                                           timeout=(SMS_CONNECT_TIMEOUT, SMS_READ_TIMEOUT))
         if resp.status_code in (200, 201):
             return True
-        logger.error(f"Infobip send failed: {resp.status_code} {resp.text}")
+        logger.error(f"Infobip send failed: {resp.status_code} {resp.text[:200]}")
         return False
     except Exception as e:
-        logger.error(f"Infobip send exception: {e}")
+        logger.error(f"Infobip send exception: {e.__class__.__name__}: {e}")
         return False
 
 def send_sms_mobizon(phone: str, text: str) -> bool:
-    if not SMS_BASE_URL or not SMS_API_KEY:
-        logger.error('SMS config is missing')
+    config = SMS_PROVIDERS['mobizon']
+    if not config['base_url'] or not config['api_key']:
+        logger.error('Mobizon SMS config is missing')
         return False
-    
-    logger.info(f"🔧 Начинаем отправку SMS через Mobizon")
-    logger.info(f"🔧 SMS_PROVIDER: {SMS_PROVIDER}")
-    logger.info(f"🔧 SMS_BASE_URL: {SMS_BASE_URL}")
-    logger.info(f"🔧 SMS_API_KEY: {'*' * 10 if SMS_API_KEY else 'НЕ_УСТАНОВЛЕН'}")
-    
     try:
         # Mobizon API: https://api.mobizon.kz/service/message/sendSmsMessage
-        url = SMS_BASE_URL.rstrip('/') + '/service/message/sendSmsMessage'
-        logger.info(f"🔧 Отправка SMS через Mobizon: {url}")
-        
+        url = config['base_url'].rstrip('/') + '/service/message/sendSmsMessage'
         data = {
-            'apiKey': SMS_API_KEY,
+            'apiKey': config['api_key'],
             'recipient': phone,
             'text': text
         }
         # Временно отключаем from, пока подпись не одобрена
         # if SMS_SENDER:
         #     data['from'] = SMS_SENDER
-        
-        logger.info(f"📱 Данные для отправки: recipient={phone}, from=НЕ_УКАЗАН (подпись не одобрена), text_length={len(text)}")
-        logger.info(f"📱 Полный URL: {url}")
-        logger.info(f"📱 Данные запроса: {data}")
-        
-        # Добавляем заголовки для лучшей совместимости
-        headers = {
-            'Content-Type': 'application/x-www-form-urlencoded',
-            'User-Agent': 'UMAY-App/1.0'
-        }
-        
-        logger.info(f"📤 Отправляем POST запрос...")
-        resp = requests.post(url, data=data, headers=headers, timeout=30)
-        logger.info(f"📡 Mobizon ответ: статус={resp.status_code}, размер={len(resp.text)}")
-        logger.info(f"📡 Заголовки ответа: {dict(resp.headers)}")
-        
-        if resp.status_code in (200, 201):
-            # Typical Mobizon success payload contains code == 0 and data.messageId
-            try:
-                payload = resp.json()
-                logger.info(f"📋 Mobizon JSON ответ: {payload}")
-                
-                code_val = str(payload.get('code', '')).lower()
-                message_val = str(payload.get('message', '')).lower()
-                has_id = isinstance(payload.get('data', {}), dict) and (
-                    'messageId' in payload.get('data', {}) or 'messages' in payload.get('data', {})
-                )
-                
-                if code_val in ('0', 'success') or message_val in ('ok', 'success') or has_id:
-                    logger.info("✅ Mobizon SMS отправлен успешно")
-                    return True
-                else:
-                    logger.error(f"❌ Mobizon вернул ошибку: code={code_val}, message={message_val}")
-                    logger.error(f"❌ Полный ответ: {payload}")
-                    return False
-                    
-            except Exception as json_error:
-                logger.error(f"❌ Ошибка парсинга JSON ответа Mobizon: {json_error}")
-                # If response is not JSON but HTTP 200, consider failure with details
-                logger.error(f"📄 Сырой ответ: {resp.text[:500]}")
-                return False
-        else:
-            logger.error(f"❌ Mobizon HTTP ошибка: {resp.status_code}")
-            logger.error(f"❌ Текст ошибки: {resp.text[:500]}")
+        resp = sms_session('mobizon').post(url, data=data, timeout=(SMS_CONNECT_TIMEOUT, SMS_READ_TIMEOUT))
+        if resp.status_code not in (200, 201):
+            logger.error(f"❌ Mobizon HTTP ошибка: {resp.status_code} {resp.text[:200]}")
             return False
+        # Typical Mobizon success payload contains code == 0 and data.messageId
+        try:
+            payload = resp.json()
+        except ValueError:
+            logger.error(f"❌ Mobizon вернул не JSON: {resp.text[:200]}")
+            return False
+        code_val = str(payload.get('code', '')).lower()
+        message_val = str(payload.get('message', '')).lower()
+        data_val = payload.get('data', {})
+        has_id = isinstance(data_val, dict) and ('messageId' in data_val or 'messages' in data_val)
+        if code_val in ('0', 'success') or message_val in ('ok', 'success') or has_id:
+            return True
+        logger.error(f"❌ Mobizon вернул ошибку: code={code_val}, message={message_val}")
+        return False
     except requests.exceptions.Timeout:
-        logger.error("⏰ Mobizon timeout - сервер не ответил за 30 секунд")
+        logger.error("⏰ Mobizon timeout")
         return False
     except requests.exceptions.ConnectionError as e:
         logger.error(f"🔌 Mobizon connection error: {e}")
         return False
     except Exception as e:
-        logger.error(f"❌ Mobizon общая ошибка: {e}")
-        import traceback
-        logger.error(f"❌ Stack trace: {traceback.format_exc()}")
+        logger.error(f"❌ Mobizon общая ошибка: {e.__class__.__name__}: {e}")
         return False
 
-def send_sms(phone: str, text: str) -> bool:
-    provider = (SMS_PROVIDER or 'infobip').lower()
-    logger.info(f"📱 Отправка SMS через провайдера: {provider}")
-    
-    if provider == 'mobizon':
-        logger.info("📱 Пробуем Mobizon...")
-        result = send_sms_mobizon(phone, text)
-        if result:
-            return True
-        else:
-            logger.warning("⚠️ Mobizon не сработал, пробуем Infobip как fallback...")
-            return send_sms_infobip(phone, text)
-    
-    # default to infobip for backward compatibility
-    logger.info("📱 Используем Infobip...")
-    return send_sms_infobip(phone, text)
+SMS_SENDERS = {'infobip': send_sms_infobip, 'mobizon': send_sms_mobizon}
+
+
+def send_sms(phone: str, text: str, providers=None) -> str:
+    """Синхронно отправляет SMS первым доступным провайдером.
+
+    Провайдер с разомкнутым CircuitBreaker пропускается сразу, без сетевого
+    запроса. Возвращает имя провайдера, принявшего сообщение, или ''.
+    """
+    for provider in providers or SMS_PROVIDER_ORDER:
+        breaker = sms_breakers[provider]
+        if not breaker.allow():
+            logger.info(f"📱 {provider} пропущен: провайдер временно отключен")
+            continue
+        if SMS_SENDERS[provider](phone, text):
+            breaker.record_success()
+            return provider
+        breaker.record_failure()
+        logger.warning(f"⚠️ {provider} не сработал")
+    return ''
 
 def send_otp(phone: str, purpose: str):
+    """Создаёт OTP и ставит SMS в очередь одной транзакцией.
+
+    Отправку выполняет фоновый диспетчер (process_sms_outbox), поэтому запрос
+    не ждёт провайдера: ответ приходит сразу после коммита.
+    """
     try:
         normalized = normalize_phone(phone)
         if not normalized:
             return False, 'Некорректный номер телефона'
         
-        sent_today = count_otp_sent_today(normalized, purpose)
-        if sent_today >= OTP_MAX_PER_DAY:
+        # Лимиты проверяются в памяти; база читается только при первом обращении к номеру
+        key = (normalized, purpose)
+        if key not in otp_send_window:
+            otp_send_window.seed(key, load_otp_send_times(normalized, purpose))
+        now = datetime.utcnow()
+        allowed, reason = otp_send_window.acquire(key, OTP_MAX_PER_DAY, OTP_RESEND_COOLDOWN_SEC, now=now)
+        if reason == 'limit':
             return False, 'Превышен дневной лимит отправки кодов'
-        
-        last = OTPCode.query.filter_by(phone=normalized, purpose=purpose).order_by(OTPCode.created_at.desc()).first()
-        if last and not can_resend_otp(last.last_sent_at):
+        if not allowed:
             return False, 'Пожалуйста, подождите перед повторной отправкой'
         
         code = generate_otp_code()
         text = f"UMAY: ваш код подтверждения {code}. Никому его не сообщайте."
-        
-        logger.info(f"📱 Попытка отправки OTP: phone={normalized}, purpose={purpose}, provider={SMS_PROVIDER}")
-        
-        sent = send_sms(normalized, text)
-        if not sent:
-            logger.error(f"❌ Не удалось отправить SMS для {normalized}")
-            return False, 'Не удалось отправить СМС. Попробуйте позже'
-        
-        logger.info(f"✅ SMS отправлен успешно для {normalized}")
-        
         otp = OTPCode(phone=normalized, code=code, purpose=purpose,
-                      expires_at=datetime.utcnow() + timedelta(seconds=OTP_TTL_SEC),
-                      last_sent_at=datetime.utcnow())
+                      expires_at=now + timedelta(seconds=OTP_TTL_SEC),
+                      last_sent_at=now, created_at=now)
         db.session.add(otp)
-        db.session.commit()
+        db.session.add(SMSOutbox(phone=normalized, text=text, purpose=purpose,
+                                 expires_at=otp.expires_at))
+        try:
+            db.session.commit()
+        except Exception:
+            otp_send_window.release(key, now)
+            raise
+        sms_outbox_job.wake()
+        logger.info(f"📱 OTP поставлен в очередь: phone={normalized}, purpose={purpose}")
         return True, 'Код отправлен'
         
     except Exception as e:
+        db.session.rollback()
         logger.error(f"❌ Критическая ошибка в send_otp: {e}")
         return False, 'Внутренняя ошибка сервера. Попробуйте позже'
 
@@ -804,6 +1117,12 @@ def init_database():
                     add_column_if_missing('user_mama', 'work_experience_years INTEGER')
                     add_column_if_missing('user_mama', 'phone VARCHAR(20)')
                     add_column_if_missing('user_mama', 'avatar_filename VARCHAR(255)')
+                    add_column_if_missing('patient', 'client_uuid VARCHAR(64)')
+                    add_column_if_missing('patient', 'sync_version BIGINT')
+                    for table_name in ('mama_content', 'guideline'):
+                        add_column_if_missing(table_name, 'content_html TEXT')
+                        add_column_if_missing(table_name, 'content_hash VARCHAR(64)')
+                    add_column_if_missing('content_generation_task', 'heartbeat_at DATETIME')
                 else:
                     add_column_if_missing('user_pro', 'email VARCHAR(120)')
                     add_column_if_missing('user_pro', 'is_email_verified BOOLEAN DEFAULT FALSE')
@@ -823,13 +1142,119 @@ def init_database():
                     add_column_if_missing('user_mama', 'work_experience_years INTEGER')
                     add_column_if_missing('user_mama', 'phone VARCHAR(20)')
                     add_column_if_missing('user_mama', 'avatar_filename VARCHAR(255)')
+                    add_column_if_missing('patient', 'client_uuid VARCHAR(64)')
+                    add_column_if_missing('patient', 'sync_version BIGINT')
+                    for table_name in ('mama_content', 'guideline'):
+                        add_column_if_missing(table_name, 'content_html TEXT')
+                        add_column_if_missing(table_name, 'content_hash VARCHAR(64)')
+                    add_column_if_missing('content_generation_task', 'heartbeat_at TIMESTAMP')
             except Exception as e:
                 logger.warning(f"Could not ensure email columns: {e}")
-            
+
+            # Одиночные индексы по phone/email заменены составными (..., purpose, created_at)
+            for index_name in ('ix_otp_code_phone', 'ix_email_verification_email'):
+                try:
+                    from sqlalchemy import text
+                    db.session.execute(text(f"DROP INDEX IF EXISTS {index_name}"))
+                    db.session.commit()
+                except Exception as e:
+                    db.session.rollback()
+                    logger.warning(f"Could not drop {index_name}: {e}")
+
+            # create_all не добавляет индексы в уже существующие таблицы — создаём недостающие
+            for table in db.metadata.sorted_tables:
+                for index in table.indexes:
+                    try:
+                        index.create(bind=db.engine, checkfirst=True)
+                    except Exception as e:
+                        logger.warning(f"Could not create index {index.name}: {e}")
+
+            # Keyset-пагинация не видит строк с NULL в колонке сортировки — заполняем их
+            try:
+                from sqlalchemy import text
+                for table_name, column, fallback, condition in KEYSET_SORT_COLUMNS:
+                    where = f"{column} IS NULL" + (f" AND {condition}" if condition else "")
+                    db.session.execute(text(f"UPDATE {table_name} SET {column} = {fallback} WHERE {where}"))
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                logger.warning(f"Could not backfill sort columns: {e}")
+
+            # Delta-sync: записям, созданным до появления sync_version, даём версию = id
+            try:
+                from sqlalchemy import text
+                db.session.execute(text("UPDATE patient SET sync_version = id WHERE sync_version IS NULL"))
+                max_version = db.session.query(db.func.max(Patient.sync_version)).scalar() or 0
+                ensure_counter(PATIENT_SYNC_COUNTER, max_version)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                logger.warning(f"Could not backfill patient sync versions: {e}")
+
+            # Единый индекс логинов/email: заполняем при первом запуске и чиним частично заполненный
+            try:
+                migrated = migrate_user_identity_schema()
+                if migrated or not user_identity_in_sync():
+                    count = rebuild_user_identity()
+                    logger.info(f"✅ User identity index built: {count} entries")
+            except Exception as e:
+                db.session.rollback()
+                logger.warning(f"Could not build user identity index: {e}")
+
+            # Сводка аналитики: пересчитываем, если рассинхронизировалась (массовые удаления и т.п.)
+            try:
+                rollup_total = db.session.query(db.func.sum(PatientRollup.patients)) \
+                    .filter(PatientRollup.kind == 'birth').scalar() or 0
+                if rollup_total != db.session.query(Patient).count():
+                    rebuild_patient_rollups()
+                    logger.info("✅ Patient rollups rebuilt")
+            except Exception as e:
+                db.session.rollback()
+                logger.warning(f"Could not rebuild patient rollups: {e}")
+
+            # Счётчики дашбордов: пересчитываем, если рассинхронизировались (массовые операции, старая база)
+            try:
+                if not entity_counters_in_sync():
+                    rebuild_entity_counters()
+                    logger.info("✅ Dashboard counters rebuilt")
+            except Exception as e:
+                db.session.rollback()
+                logger.warning(f"Could not rebuild dashboard counters: {e}")
+
+            # Поисковый индекс контента: FTS5/tsvector и первичное заполнение
+            try:
+                ensure_content_search_schema()
+                if db.session.query(ContentSearchDocument.id).first() is None:
+                    count = rebuild_content_search()
+                    logger.info(f"✅ Content search index built: {count} documents")
+            except Exception as e:
+                db.session.rollback()
+                logger.warning(f"Could not build content search index: {e}")
+
+            # Похожие статьи: первичный расчёт TF-IDF
+            try:
+                if db.session.query(SimilarArticle.article_id).first() is None:
+                    count = rebuild_similar_articles()  # None: считает другой воркер
+                    if count:
+                        logger.info(f"✅ Similar articles computed for {count} articles")
+            except Exception as e:
+                db.session.rollback()
+                logger.warning(f"Could not compute similar articles: {e}")
+
+            # Теги методичек: связи guideline_tag по строкам Guideline.tags
+            try:
+                if db.session.query(GuidelineTag.tag_id).first() is None:
+                    count = rebuild_guideline_tags()
+                    if count:
+                        logger.info(f"✅ Guideline tags linked: {count}")
+            except Exception as e:
+                db.session.rollback()
+                logger.warning(f"Could not link guideline tags: {e}")
+
             # Create admin user if not exists
             admin_user = db.session.query(UserPro).filter_by(login='Joker').first()
             if not admin_user:
-                hashed_password = generate_password_hash('19341934')
+                hashed_password = hash_password('19341934')
                 admin_user = UserPro(
                     full_name='Super Admin',
                     login='Joker',
@@ -1055,6 +1480,10 @@ class UserPro(UserMixin, db.Model):
     phone = db.Column(db.String(20))
     avatar_filename = db.Column(db.String(255))
 
+    def get_id(self):
+        # id в user_pro и user_mama пересекаются, поэтому в сессии храним "pro:<id>"
+        return f'pro:{self.id}'
+
 class UserMama(UserMixin, db.Model):
     __tablename__ = 'user_mama'
     id = db.Column(db.Integer, primary_key=True)
@@ -1079,16 +1508,103 @@ class UserMama(UserMixin, db.Model):
     phone = db.Column(db.String(20))
     avatar_filename = db.Column(db.String(255))
 
+    def get_id(self):
+        # id в user_pro и user_mama пересекаются, поэтому в сессии храним "mama:<id>"
+        return f'mama:{self.id}'
+
 class EmailVerification(db.Model):
     __tablename__ = 'email_verification'
     id = db.Column(db.Integer, primary_key=True)
-    email = db.Column(db.String(120), index=True, nullable=False)
+    email = db.Column(db.String(120), nullable=False)
     token = db.Column(db.String(100), unique=True, nullable=False)
     purpose = db.Column(db.String(20), default='register')  # register, reset
     expires_at = db.Column(db.DateTime, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     verified = db.Column(db.Boolean, default=False)
 
+    __table_args__ = (
+        # Последняя запись по email и цели: WHERE email, purpose ORDER BY created_at DESC
+        db.Index('ix_email_verification_email_purpose_created', 'email', 'purpose', 'created_at'),
+        db.Index('ix_email_verification_expires_at', 'expires_at'),
+    )
+
+class EmailOutbox(db.Model):
+    """Исходящие письма: пишутся в транзакции запроса, отправляются в фоне"""
+    __tablename__ = 'email_outbox'
+    id = db.Column(db.Integer, primary_key=True)
+    recipient = db.Column(db.String(120), nullable=False)
+    subject = db.Column(db.String(200), nullable=False)
+    html_body = db.Column(db.Text, nullable=False)
+    text_body = db.Column(db.Text)
+    status = db.Column(db.String(10), nullable=False, default='pending')  # pending, sent, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_error = db.Column(db.String(500))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_email_outbox_status_next_attempt', 'status', 'next_attempt_at'),
+    )
+
+class OTPCode(db.Model):
+    __tablename__ = 'otp_code'
+    id = db.Column(db.Integer, primary_key=True)
+    phone = db.Column(db.String(20), nullable=False)
+    code = db.Column(db.String(10), nullable=False)
+    purpose = db.Column(db.String(20))
+    expires_at = db.Column(db.DateTime, nullable=False)
+    attempts = db.Column(db.Integer, default=0)
+    last_sent_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    verified = db.Column(db.Boolean, default=False)
+
+    __table_args__ = (
+        # Последний код и отправки за окно: WHERE phone, purpose ORDER BY created_at
+        db.Index('ix_otp_code_phone_purpose_created', 'phone', 'purpose', 'created_at'),
+        db.Index('ix_otp_code_expires_at', 'expires_at'),
+    )
+
+class SMSOutbox(db.Model):
+    """Очередь SMS: send_otp только пишет сюда, отправляет фоновый диспетчер"""
+    __tablename__ = 'sms_outbox'
+    id = db.Column(db.Integer, primary_key=True)
+    phone = db.Column(db.String(20), nullable=False)
+    text = db.Column(db.String(500), nullable=False)  # очищается после отправки (содержит код)
+    purpose = db.Column(db.String(20))
+    status = db.Column(db.String(10), nullable=False, default='pending')  # pending, sent, failed
+    provider = db.Column(db.String(20))
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime)  # после этого момента отправлять бессмысленно
+    last_error = db.Column(db.String(500))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_sms_outbox_status_next_attempt', 'status', 'next_attempt_at'),
+    )
+
+class UserIdentity(db.Model):
+    """Единый индекс логинов, email и токенов подтверждения обеих систем (Pro и Mama)"""
+    __tablename__ = 'user_identity'
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(10), nullable=False)  # login, email, token
+    value = db.Column(db.String(255), nullable=False)  # email хранится в нижнем регистре
+    app_type = db.Column(db.String(10), nullable=False)  # pro, mama
+    user_id = db.Column(db.Integer, nullable=False)
+    # Значение, которое до общего индекса уже было у пользователя другой системы
+    # (старые общие логины/email Pro и Mama); новые значения всегда shared=False
+    shared = db.Column(db.Boolean, nullable=False, default=False)
+
+    __table_args__ = (
+        db.UniqueConstraint('kind', 'value', 'app_type', name='uq_user_identity_kind_value_app'),
+        # Между системами значение уникально, кроме старых общих учётных записей
+        db.Index('uq_user_identity_kind_value_unshared', 'kind', 'value', unique=True,
+                 postgresql_where=db.text('NOT shared'), sqlite_where=db.text('NOT shared')),
+        db.Index('ix_user_identity_owner', 'app_type', 'user_id'),
+    )
+
 # CMS Модели для контента - используем основную базу данных (UMAY Pro)
 class News(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -1104,10 +1620,18 @@ class News(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+    __table_args__ = (
+        # Keyset-пагинация: публичная лента и список в админке
+        db.Index('ix_news_published_published_at', 'is_published', 'published_at', 'id'),
+        db.Index('ix_news_created_at', 'created_at', 'id'),
+    )
+
 class MamaContent(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(200), nullable=False)
     content = db.Column(db.Text, nullable=False)
+    content_html = db.Column(db.Text)  # content, отрендеренный при сохранении (render_markdown)
+    content_hash = db.Column(db.String(64))  # content_hash(content), по которому получен content_html
     category = db.Column(db.String(50), nullable=False)  # sport, nutrition, vitamins, body_care, baby_care, doctor_advice
     image_url = db.Column(db.String(500))
     video_url = db.Column(db.String(500))
@@ -1120,10 +1644,19 @@ class MamaContent(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+    __table_args__ = (
+        # Keyset-пагинация: раздел по категории, модерация (is_published) и список в админке
+        db.Index('ix_mama_content_category_created', 'category', 'created_at', 'id'),
+        db.Index('ix_mama_content_published_created', 'is_published', 'created_at', 'id'),
+        db.Index('ix_mama_content_created_at', 'created_at', 'id'),
+    )
+
 class Guideline(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(255), nullable=False)
     content = db.Column(db.Text, nullable=False)
+    content_html = db.Column(db.Text)  # content, отрендеренный при сохранении (render_markdown)
+    content_hash = db.Column(db.String(64))  # content_hash(content), по которому получен content_html
     category = db.Column(db.String(100))
     tags = db.Column(db.String(255))  # запятая-разделённый список тегов
     author = db.Column(db.String(100))
@@ -1131,6 +1664,62 @@ class Guideline(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+    __table_args__ = (
+        # Keyset-пагинация: методички для Pro и список в админке
+        db.Index('ix_guideline_published_updated', 'is_published', 'updated_at', 'id'),
+        db.Index('ix_guideline_updated_at', 'updated_at', 'id'),
+    )
+
+class Tag(db.Model):
+    """Нормализованный тег методичек (нижний регистр, без лишних пробелов)"""
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(64), unique=True, nullable=False)
+
+class GuidelineTag(db.Model):
+    """Связь методичка ↔ тег; поддерживается set_guideline_tags"""
+    __tablename__ = 'guideline_tag'
+    guideline_id = db.Column(db.Integer, primary_key=True)
+    tag_id = db.Column(db.Integer, primary_key=True)
+
+    __table_args__ = (
+        # Фильтр и фасеты по тегу: tag_id -> guideline_id без обращения к таблице
+        db.Index('ix_guideline_tag_tag', 'tag_id', 'guideline_id'),
+    )
+
+class SimilarArticle(db.Model):
+    """Предрасчитанные похожие статьи UMAY Mama: top-k соседей по TF-IDF на статью"""
+    __tablename__ = 'similar_article'
+    article_id = db.Column(db.Integer, primary_key=True)
+    rank = db.Column(db.Integer, primary_key=True)  # 1..k по убыванию score
+    similar_id = db.Column(db.Integer, nullable=False)
+    score = db.Column(db.Float, nullable=False)  # косинусная близость
+
+    __table_args__ = (
+        # Инкрементальный пересчёт: в чьих списках стоит изменённая статья
+        db.Index('ix_similar_article_similar', 'similar_id'),
+    )
+
+class ContentGenerationTask(db.Model):
+    """Фоновая генерация статей UMAY Mama по шаблонам: параметры и прогресс"""
+    __tablename__ = 'content_generation_task'
+    id = db.Column(db.Integer, primary_key=True)
+    category = db.Column(db.String(50), nullable=False)
+    trimester = db.Column(db.String(20))
+    requested = db.Column(db.Integer, nullable=False)  # сколько статей запросил администратор
+    total = db.Column(db.Integer, nullable=False)  # сколько будет создано (не больше числа шаблонов)
+    generated = db.Column(db.Integer, nullable=False, default=0)
+    status = db.Column(db.String(10), nullable=False, default='pending')  # pending, running, done, failed
+    error = db.Column(db.String(500))
+    created_by = db.Column(db.String(100))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    heartbeat_at = db.Column(db.DateTime)  # обновляется после каждого пакета, пока задача выполняется
+    finished_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_content_generation_task_status', 'status', 'id'),
+    )
+
 class MediaFile(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     filename = db.Column(db.String(200), nullable=False)
@@ -1141,6 +1730,12 @@ class MediaFile(db.Model):
     uploaded_by = db.Column(db.String(100))
     uploaded_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        # Keyset-пагинация: документы для Pro и медиатека в админке
+        db.Index('ix_media_file_type_uploaded', 'file_type', 'uploaded_at', 'id'),
+        db.Index('ix_media_file_uploaded_at', 'uploaded_at', 'id'),
+    )
+
 class Patient(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     date = db.Column(db.String(20), nullable=False)
@@ -1180,19 +1775,2021 @@ class Patient(db.Model):
     postpartum_hemorrhage = db.Column(db.String(10), nullable=False)
     placental_abruption = db.Column(db.String(10), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Ключ идемпотентности, сгенерированный клиентом (PWA / offline-очередь)
+    client_uuid = db.Column(db.String(64), unique=True, index=True)
+    # Версия для delta-синхронизации PWA (см. PATIENT_SYNC_COUNTER)
+    sync_version = db.Column(db.BigInteger)
+
+    __table_args__ = (
+        db.Index('ix_patient_midwife_sync_version', 'midwife', 'sync_version'),
+    )
+
+class PatientTombstone(db.Model):
+    """Отметка об удалении пациента для delta-синхронизации"""
+    __tablename__ = 'patient_tombstone'
+    id = db.Column(db.Integer, primary_key=True)
+    patient_id = db.Column(db.Integer, nullable=False)
+    client_uuid = db.Column(db.String(64))
+    midwife = db.Column(db.String(100), nullable=False)
+    sync_version = db.Column(db.BigInteger, nullable=False)
+    deleted_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_patient_tombstone_midwife_sync_version', 'midwife', 'sync_version'),
+    )
+
+class PatientRollup(db.Model):
+    """Предрасчитанные счётчики пациентов по месяцам (сводка /pwa/analytics)
+
+    kind='birth' — по месяцу родов, kind='created' — по месяцу внесения записи.
+    """
+    __tablename__ = 'patient_rollup'
+    kind = db.Column(db.String(20), primary_key=True)
+    bucket = db.Column(db.String(7), primary_key=True)  # YYYY-MM, '' если дата не распознана
+    patients = db.Column(db.Integer, nullable=False, default=0)
+    complicated = db.Column(db.Integer, nullable=False, default=0)
+
+class EntityCounter(db.Model):
+    """Предрасчитанные счётчики для дашбордов админки и Mama
+
+    facet='' — всего записей сущности, 'поле:значение' — в разрезе поля
+    (например 'category:sport', 'is_published:false').
+    """
+    __tablename__ = 'entity_counter'
+    entity = db.Column(db.String(32), primary_key=True)
+    facet = db.Column(db.String(100), primary_key=True)
+    value = db.Column(db.BigInteger, nullable=False, default=0)
+
+class Counter(db.Model):
+    """Именованные монотонные счётчики (версии синхронизации и т.п.)"""
+    __tablename__ = 'counter'
+    name = db.Column(db.String(64), primary_key=True)
+    value = db.Column(db.BigInteger, nullable=False, default=0)
+
+class ContentSearchDocument(db.Model):
+    """Документ поискового индекса: опубликованная статья, новость или методичка в виде текста"""
+    __tablename__ = 'content_search'
+    id = db.Column(db.Integer, primary_key=True)
+    doc_type = db.Column(db.String(20), nullable=False)  # mama, news, guideline
+    doc_id = db.Column(db.Integer, nullable=False)
+    title = db.Column(db.String(255), nullable=False)
+    body = db.Column(db.Text, nullable=False)  # текст без разметки
+    category = db.Column(db.String(100))
+    trimester = db.Column(db.String(20))
+    tags = db.Column(db.String(500))  # ',тег1,тег2,' — для фильтра LIKE '%,тег,%'
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # PostgreSQL: + generated-колонка document tsvector с GIN-индексом (init_database)
+    # SQLite: + FTS5-таблица content_search_fts с основами слов (rowid = id)
+
+    __table_args__ = (
+        db.UniqueConstraint('doc_type', 'doc_id', name='uq_content_search_doc'),
+        db.Index('ix_content_search_type_category', 'doc_type', 'category'),
+    )
+
+# ======================
+# In-process кэши
+# ======================
+class TTLCache:
+    """Потокобезопасный LRU-кэш с временем жизни записей (в памяти процесса)."""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300):
+        import threading
+        from collections import OrderedDict
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        import time
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expires_at = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl: float = None) -> None:
+        import time
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            return default if item is None else item[0]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class SlidingWindowCounter:
+    """Скользящее окно событий по ключу (в памяти процесса).
+
+    Для каждого ключа хранятся моменты последних событий в пределах window секунд;
+    число ключей ограничено maxsize (LRU), вытесненный ключ заполняется заново через seed().
+    """
+
+    def __init__(self, window: float, maxsize: int = 10000):
+        import threading
+        from collections import OrderedDict
+        self.window = window
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _events(self, key, now: datetime, create: bool = True) -> list:
+        """События ключа в окне; create=False — чтение без заведения записи для нового ключа."""
+        if create:
+            events = self._data.setdefault(key, [])
+        else:
+            events = self._data.get(key)
+            if events is None:
+                return []
+        self._data.move_to_end(key)
+        cutoff = now - timedelta(seconds=self.window)
+        while events and events[0] <= cutoff:
+            events.pop(0)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+        return events
+
+    def __contains__(self, key) -> bool:
+        return key in self._data
+
+    def seed(self, key, timestamps) -> None:
+        """Заполняет окно известными событиями, если ключ ещё не отслеживается."""
+        with self._lock:
+            if key not in self._data:
+                self._data[key] = sorted(timestamps)
+                self._events(key, datetime.utcnow())
+
+    def count(self, key, now: datetime = None) -> int:
+        with self._lock:
+            return len(self._events(key, now or datetime.utcnow(), create=False))
+
+    def acquire(self, key, limit: int, min_interval: float = 0, now: datetime = None):
+        """Атомарно регистрирует событие, если в окне меньше limit событий и после
+        предыдущего прошло min_interval секунд. Возвращает (True, None) или (False, 'limit'/'interval')."""
+        now = now or datetime.utcnow()
+        with self._lock:
+            events = self._events(key, now)
+            if len(events) >= limit:
+                return False, 'limit'
+            if events and (now - events[-1]).total_seconds() < min_interval:
+                return False, 'interval'
+            events.append(now)
+            return True, None
+
+    def retry_after(self, key, now: datetime = None) -> float:
+        """Через сколько секунд самое старое событие ключа выйдет из окна."""
+        now = now or datetime.utcnow()
+        with self._lock:
+            events = self._events(key, now, create=False)
+            if not events:
+                return 0.0
+            return max((events[0] + timedelta(seconds=self.window) - now).total_seconds(), 0.0)
+
+    def discard(self, key) -> None:
+        """Забывает все события ключа."""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def release(self, key, timestamp: datetime) -> None:
+        """Отменяет событие, зарегистрированное acquire() (например, транзакция не прошла)."""
+        with self._lock:
+            events = self._data.get(key)
+            if events and timestamp in events:
+                events.remove(timestamp)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+# (phone, purpose) -> моменты отправки OTP за OTP_SEND_WINDOW_SEC
+otp_send_window = SlidingWindowCounter(window=OTP_SEND_WINDOW_SEC,
+                                       maxsize=int(os.getenv('OTP_WINDOW_SIZE', '10000')))
+
+
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', '300'))
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '1024'))
+# "pro:12" -> снимок колонок пользователя (dict), не сам ORM-объект
+user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+USER_MODELS = {'pro': UserPro, 'mama': UserMama}
+
+
+def _user_snapshot(user) -> dict:
+    return {attr.key: getattr(user, attr.key) for attr in db.inspect(type(user)).column_attrs}
+
+
+def _user_from_snapshot(model, snapshot: dict):
+    """Восстанавливает пользователя из снимка и привязывает к сессии без запроса в базу."""
+    from sqlalchemy.orm import make_transient_to_detached
+    user = model()
+    for key, value in snapshot.items():
+        setattr(user, key, value)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
+@event.listens_for(db.session, 'after_flush')
+def _collect_changed_users(session, flush_context):
+    keys = session.info.setdefault('changed_user_keys', set())
+    for obj in list(session.dirty) + list(session.deleted):
+        if isinstance(obj, (UserPro, UserMama)):
+            keys.add(obj.get_id())
+
+
+@event.listens_for(db.session, 'after_commit')
+def _invalidate_changed_users(session):
+    """Сбрасывает кэш пользователей после смены профиля/пароля (после коммита)."""
+    for key in session.info.pop('changed_user_keys', ()):
+        user_cache.pop(key)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _forget_changed_users(session):
+    session.info.pop('changed_user_keys', None)
+
+# ======================
+# Единый индекс идентификаторов пользователей (user_identity)
+# ======================
+USER_IDENTITY_FIELDS = {'login': 'login', 'email': 'email', 'token': 'email_verification_token'}
+
+
+def _user_identity_rows(user, app_type: str) -> list:
+    rows = []
+    for kind, attr in USER_IDENTITY_FIELDS.items():
+        value = getattr(user, attr, None)
+        value = value.strip().lower() if kind == 'email' and value else value
+        if value:
+            rows.append({'kind': kind, 'value': value, 'app_type': app_type, 'user_id': user.id, 'shared': False})
+    return rows
+
+
+def _sync_user_identity(connection, user, app_type: str) -> None:
+    """Перезаписывает строки пользователя; флаг shared сохраняется только за прежними значениями."""
+    table = UserIdentity.__table__
+    owner = (table.c.app_type == app_type, table.c.user_id == user.id)
+    shared = {tuple(row) for row in connection.execute(
+        db.select(table.c.kind, table.c.value).where(*owner, table.c.shared.is_(True))
+    )}
+    connection.execute(table.delete().where(*owner))
+    rows = _user_identity_rows(user, app_type)
+    for row in rows:
+        row['shared'] = (row['kind'], row['value']) in shared
+    if rows:
+        connection.execute(table.insert(), rows)
+
+
+def _register_identity_events(model, app_type: str) -> None:
+    """Держит user_identity в той же транзакции, что и изменения пользователя.
+
+    Уникальный индекс (kind, value, app_type) не пускает дубликаты внутри
+    системы, частичный (kind, value) WHERE NOT shared — между Pro и Mama.
+    Существующие общие логины/email (shared) остаются рабочими.
+    """
+    @event.listens_for(model, 'after_insert')
+    def after_insert(mapper, connection, target):
+        _sync_user_identity(connection, target, app_type)
+
+    @event.listens_for(model, 'after_update')
+    def after_update(mapper, connection, target):
+        state = db.inspect(target)
+        if any(state.attrs[attr].history.has_changes() for attr in USER_IDENTITY_FIELDS.values()):
+            _sync_user_identity(connection, target, app_type)
+
+    @event.listens_for(model, 'after_delete')
+    def after_delete(mapper, connection, target):
+        table = UserIdentity.__table__
+        connection.execute(table.delete().where(table.c.app_type == app_type, table.c.user_id == target.id))
+
+
+for _app_type, _model in USER_MODELS.items():
+    _register_identity_events(_model, _app_type)
+
+
+def find_user(kind: str, value: str, app_type: str = None):
+    """Пользователь по логину, email или токену подтверждения через user_identity.
+
+    С app_type — один запрос (identity JOIN таблица пользователей), без него —
+    поиск по индексу и выборка по первичному ключу; если значение есть в обеих
+    системах, как и раньше побеждает Pro.
+    """
+    if not value:
+        return None
+    value = value.strip().lower() if kind == 'email' else value
+    if app_type:
+        model = USER_MODELS.get(app_type)
+        if model is None:
+            return None
+        return model.query.join(
+            UserIdentity, db.and_(UserIdentity.user_id == model.id, UserIdentity.app_type == app_type)
+        ).filter(UserIdentity.kind == kind, UserIdentity.value == value).first()
+    owners = dict(db.session.query(UserIdentity.app_type, UserIdentity.user_id)
+                  .filter(UserIdentity.kind == kind, UserIdentity.value == value))
+    for app_type, model in USER_MODELS.items():
+        if app_type in owners:
+            return db.session.get(model, owners[app_type])
+    return None
+
+
+def rebuild_user_identity() -> int:
+    """Заполняет user_identity по таблицам пользователей (миграция существующих баз).
+
+    Значения, повторяющиеся внутри одной системы (например, email в разном
+    регистре), пропускаются с предупреждением: такие записи нужно
+    переименовать вручную. Значение, уже занятое в другой системе (старые
+    общие учётные записи), сохраняется с shared=True.
+    """
+    db.session.execute(UserIdentity.__table__.delete())
+    seen = set()
+    owners = {}
+    rows = []
+    for app_type, model in USER_MODELS.items():
+        for user in model.query.yield_per(500):
+            for row in _user_identity_rows(user, app_type):
+                key = (row['kind'], row['value'], app_type)
+                if key in seen:
+                    logger.warning(f"Duplicate user identity skipped: {row['kind']}={row['value']} ({app_type}:{user.id})")
+                    continue
+                seen.add(key)
+                row['shared'] = owners.setdefault((row['kind'], row['value']), app_type) != app_type
+                rows.append(row)
+    bulk_insert_rows(UserIdentity.__table__, rows)
+    db.session.commit()
+    return len(rows)
+
+
+def user_identity_in_sync() -> bool:
+    """Совпадает ли число строк user_identity с числом различных идентификаторов в таблицах пользователей.
+
+    Считаются различные значения внутри системы (как в rebuild_user_identity,
+    которая пропускает дубликаты), иначе база с такими дубликатами
+    пересобирала бы индекс при каждом старте.
+    """
+    expected = 0
+    for model in USER_MODELS.values():
+        counts = []
+        for kind, attr in USER_IDENTITY_FIELDS.items():
+            column = getattr(model, attr)
+            if kind == 'email':
+                column = db.func.lower(db.func.trim(column))
+            counts.append(db.func.count(db.distinct(db.func.nullif(column, ''))))
+        expected += sum(db.session.query(*counts).one())
+    return db.session.query(db.func.count(UserIdentity.id)).scalar() == expected
+
+
+def migrate_user_identity_schema() -> bool:
+    """Пересоздаёт user_identity старой схемы (уникальный (kind, value) или без shared); True, если пересоздана."""
+    from sqlalchemy import inspect as sa_inspect
+    inspector = sa_inspect(db.engine)
+    constraints = inspector.get_unique_constraints(UserIdentity.__tablename__)
+    columns = {column['name'] for column in inspector.get_columns(UserIdentity.__tablename__)}
+    if 'shared' in columns and not any(constraint['column_names'] == ['kind', 'value'] for constraint in constraints):
+        return False
+    db.session.commit()
+    UserIdentity.__table__.drop(db.engine)
+    UserIdentity.__table__.create(db.engine)
+    return True
+
+# ======================
+# Markdown: рендер при сохранении (content_html) + LRU для ещё не отрендеренных строк
+# ======================
+def _render_article_markdown(text: str) -> str:
+    return markdown.markdown(text, extensions=['extra', 'codehilite'])
+
+
+def _render_guideline_markdown(text: str) -> str:
+    # Строки с типографскими маркерами (•, —, –) превращаем в markdown-списки, убираем отступы
+    normalized = re.sub(r'^[\u2022•—–]\s+', '- ', text, flags=re.MULTILINE)
+    normalized = re.sub(r'^[\t ]+', '', normalized, flags=re.MULTILINE)
+    try:
+        return markdown.markdown(normalized, extensions=['extra', 'sane_lists', 'nl2br'])
+    except Exception:
+        return text.replace('\n', '<br>')
+
+
+MARKDOWN_RENDERERS = {
+    'article': _render_article_markdown,
+    'guideline': _render_guideline_markdown,
+}
+# Модель -> вариант рендера поля content
+MARKDOWN_MODELS = {
+    MamaContent: 'article',
+    Guideline: 'guideline',
+}
+# Версия рендера входит в content_hash: увеличьте её при смене расширений или нормализации
+# выше, и сохранённый content_html перестанет считаться актуальным (см. backfill_markdown.py)
+MARKDOWN_RENDER_VERSION = 1
+MARKDOWN_CACHE_SIZE = int(os.getenv('MARKDOWN_CACHE_SIZE', '256'))
+# (вариант, sha256) -> HTML; строки с актуальным content_html в кэш не попадают
+markdown_cache = TTLCache(maxsize=MARKDOWN_CACHE_SIZE, ttl=24 * 3600)
+
+
+def content_hash(text: str) -> str:
+    """sha256 текста вместе с MARKDOWN_RENDER_VERSION."""
+    import hashlib
+    return hashlib.sha256(f"{MARKDOWN_RENDER_VERSION}\n{text or ''}".encode('utf-8')).hexdigest()
+
+
+def render_markdown_cached(text: str, flavor: str) -> str:
+    digest = content_hash(text)
+    html = markdown_cache.get((flavor, digest))
+    if html is None:
+        html = MARKDOWN_RENDERERS[flavor](text or '')
+        markdown_cache.set((flavor, digest), html)
+    return html
+
+
+@app.template_filter('rendered')
+def rendered_content(obj) -> str:
+    """HTML поля content: сохранённый content_html, если он соответствует тексту, иначе LRU."""
+    text = obj.content or ''
+    if obj.content_html is not None and obj.content_hash == content_hash(text):
+        return obj.content_html
+    return render_markdown_cached(text, MARKDOWN_MODELS[type(obj)])
+
+
+@event.listens_for(db.session, 'before_flush')
+def _render_markdown_on_save(session, flush_context, instances):
+    """Рендерит content новых и изменённых статей/методичек один раз — при сохранении."""
+    for obj in list(session.new) + list(session.dirty):
+        flavor = MARKDOWN_MODELS.get(type(obj))
+        if flavor is None:
+            continue
+        digest = content_hash(obj.content)
+        if obj.content_hash != digest or obj.content_html is None:
+            obj.content_html = render_markdown_cached(obj.content, flavor)
+            obj.content_hash = digest
+
+
+def backfill_rendered_markdown(batch_size: int = 200) -> int:
+    """Заполняет content_html для строк без него или с устаревшим хэшем; возвращает число обновлённых."""
+    updated = 0
+    for model in MARKDOWN_MODELS:
+        last_id = 0
+        while True:
+            rows = model.query.filter(model.id > last_id).order_by(model.id).limit(batch_size).all()
+            if not rows:
+                break
+            for row in rows:
+                if row.content_html is None or row.content_hash != content_hash(row.content):
+                    # before_flush отрендерит строку при коммите
+                    row.content_hash = None
+                    updated += 1
+            db.session.commit()
+            last_id = rows[-1].id
+    return updated
+
+# ======================
+# Keyset-пагинация списков контента
+# ======================
+CONTENT_PAGE_SIZE = int(os.getenv('CONTENT_PAGE_SIZE', '20'))
+# (таблица, колонка сортировки, чем заполнить NULL, для каких строк) — см. init_database.
+# published_at сортирует только опубликованные новости; черновикам дата публикации не выдумывается
+KEYSET_SORT_COLUMNS = [
+    ('news', 'created_at', 'CURRENT_TIMESTAMP', None),
+    ('news', 'published_at', 'created_at', 'is_published'),
+    ('mama_content', 'created_at', 'CURRENT_TIMESTAMP', None),
+    ('guideline', 'updated_at', 'COALESCE(created_at, CURRENT_TIMESTAMP)', None),
+    ('media_file', 'uploaded_at', 'CURRENT_TIMESTAMP', None),
+]
+
+
+class KeysetPage:
+    """Страница списка: items, ссылка на следующую страницу и на начало списка."""
+
+    def __init__(self, items: list, cursor: str, next_cursor: str):
+        self.items = items
+        self.cursor = cursor
+        self.next_cursor = next_cursor
+
+    def _url(self, after):
+        args = request.args.to_dict(flat=False)
+        args.pop('after', None)
+        if after:
+            args['after'] = after
+        return url_for(request.endpoint, **(request.view_args or {}), **args)
+
+    @property
+    def next_url(self):
+        return self._url(self.next_cursor) if self.next_cursor else None
+
+    @property
+    def first_url(self):
+        return self._url(None) if self.cursor else None
+
+
+def _parse_keyset_cursor(cursor: str):
+    try:
+        value, object_id = cursor.rsplit('_', 1)
+        return datetime.fromisoformat(value), int(object_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def keyset_paginate(query, model, sort_attr: str, per_page: int = None) -> KeysetPage:
+    """Страница query в порядке (sort_attr DESC, id DESC) после курсора ?after=<значение>_<id>.
+
+    Условие (sort, id) < (курсор) обслуживается составным индексом (фильтры..., sort, id),
+    поэтому стоимость страницы не зависит от её номера и объёма контента.
+    """
+    per_page = per_page or CONTENT_PAGE_SIZE
+    sort_column = getattr(model, sort_attr)
+    cursor = request.args.get('after')
+    key = _parse_keyset_cursor(cursor) if cursor else None
+    if key:
+        query = query.filter(db.tuple_(sort_column, model.id) < key)
+    rows = query.order_by(sort_column.desc(), model.id.desc()).limit(per_page + 1).all()
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        last = rows[-1]
+        next_cursor = f"{getattr(last, sort_attr).isoformat()}_{last.id}"
+    return KeysetPage(rows, cursor if key else None, next_cursor)
+
+# ======================
+# Полнотекстовый поиск по контенту (PostgreSQL tsvector / SQLite FTS5)
+# ======================
+SEARCH_RESULT_LIMIT = int(os.getenv('SEARCH_RESULT_LIMIT', '20'))
+SEARCH_SNIPPET_WORDS = 30
+# Модель -> тип документа; детальная страница типа -> (endpoint, имя параметра)
+SEARCH_SOURCES = {
+    MamaContent: 'mama',
+    News: 'news',
+    Guideline: 'guideline',
+}
+SEARCH_DETAIL_ENDPOINTS = {
+    'mama': ('mama_article_detail', 'content_id'),
+    'news': ('news_detail', 'news_id'),
+    'guideline': ('pro_guideline_detail', 'guideline_id'),
+}
+# Маркеры подсветки: вставляются до экранирования HTML и заменяются на <mark>
+_MARK_START, _MARK_END = '⟦', '⟧'
+
+# Snowball-стеммер для русского: тот же алгоритм, что у конфигурации 'russian' в PostgreSQL
+# (SQLite стемминг не умеет — основы считаются в Python и кладутся в content_search_fts)
+_RU_STEMMER = snowballstemmer.stemmer('russian')
+
+
+def stem_russian(word: str) -> str:
+    """Основа русского слова по алгоритму Snowball."""
+    return _RU_STEMMER.stemWord(word.lower())
+
+
+def _search_words(text: str) -> list:
+    return re.findall(r'[0-9a-zа-яё]+', (text or '').lower())
+
+
+@lru_cache(maxsize=50000)
+def _search_stem(word: str) -> str:
+    return stem_russian(word) if re.search('[а-яё]', word) else word
+
+
+def search_stems(text: str) -> str:
+    """Текст -> основы слов через пробел (так хранится в content_search_fts)."""
+    return ' '.join(_search_stem(word) for word in _search_words(text))
+
+
+def _search_tags(tags) -> str:
+    items = parse_tags(tags)
+    return f",{','.join(items)}," if items else None
+
+
+def search_document(obj) -> dict:
+    """Строка content_search для опубликованного объекта; None — объект не должен находиться поиском."""
+    if not obj.is_published:
+        return None
+    if isinstance(obj, News):
+        html = f"{obj.short_description or ''}\n{obj.full_content or ''}"
+    else:
+        html = rendered_content(obj)
+    body = ' '.join(BeautifulSoup(html, 'html.parser').get_text(' ').split())
+    return {
+        'doc_type': SEARCH_SOURCES[type(obj)],
+        'doc_id': obj.id,
+        'title': obj.title,
+        'body': body,
+        'category': obj.category,
+        'trimester': getattr(obj, 'trimester', None),
+        'tags': _search_tags(getattr(obj, 'tags', None)),
+        'updated_at': datetime.utcnow(),
+    }
+
+
+def sync_search_documents(connection, upserts: list, removals: list) -> None:
+    """Заменяет/удаляет документы индекса в рамках транзакции connection."""
+    from sqlalchemy import text
+    table = ContentSearchDocument.__table__
+    use_fts = connection.dialect.name == 'sqlite'
+    for doc_type, doc_id in removals + [(doc['doc_type'], doc['doc_id']) for doc in upserts]:
+        params = {'doc_type': doc_type, 'doc_id': doc_id}
+        if use_fts:
+            connection.execute(text(
+                "DELETE FROM content_search_fts WHERE rowid IN "
+                "(SELECT id FROM content_search WHERE doc_type = :doc_type AND doc_id = :doc_id)"), params)
+        connection.execute(table.delete().where(table.c.doc_type == doc_type, table.c.doc_id == doc_id))
+    for doc in upserts:
+        row_id = connection.execute(table.insert().values(**doc)).inserted_primary_key[0]
+        if use_fts:
+            connection.execute(text("INSERT INTO content_search_fts (rowid, title, body) VALUES (:id, :title, :body)"),
+                               {'id': row_id, 'title': search_stems(doc['title']), 'body': search_stems(doc['body'])})
+
+
+@event.listens_for(db.session, 'after_flush')
+def _sync_search_on_flush(session, flush_context):
+    """Инкрементально обновляет поисковый индекс при создании/правке/удалении контента."""
+    upserts, removals = [], []
+    for obj in list(session.new) + list(session.dirty):
+        if type(obj) in SEARCH_SOURCES and (obj in session.new or session.is_modified(obj)):
+            doc = search_document(obj)
+            if doc:
+                upserts.append(doc)
+            else:
+                removals.append((SEARCH_SOURCES[type(obj)], obj.id))
+    for obj in session.deleted:
+        if type(obj) in SEARCH_SOURCES:
+            removals.append((SEARCH_SOURCES[type(obj)], obj.id))
+    if upserts or removals:
+        sync_search_documents(session.connection(), upserts, removals)
+
+
+@event.listens_for(db.session, 'do_orm_execute')
+def _sync_search_on_bulk_delete(orm_execute_state):
+    """Query.delete() по контенту минует after_flush — документы индекса удаляются здесь же."""
+    if not orm_execute_state.is_delete or orm_execute_state.bind_mapper is None:
+        return None
+    model = orm_execute_state.bind_mapper.class_
+    if model not in SEARCH_SOURCES:
+        return None
+    from sqlalchemy import select
+    statement = orm_execute_state.statement
+    ids = select(model.id)
+    if statement.whereclause is not None:
+        ids = ids.where(statement.whereclause)
+    removals = [(SEARCH_SOURCES[model], doc_id) for doc_id in orm_execute_state.session.scalars(ids)]
+    result = orm_execute_state.invoke_statement()
+    if removals:
+        sync_search_documents(orm_execute_state.session.connection(), [], removals)
+    return result
+
+
+def ensure_content_search_schema() -> None:
+    """Поисковые структуры, которые create_all не создаёт: FTS5-таблица или tsvector + GIN."""
+    from sqlalchemy import text
+    if is_postgresql():
+        db.session.execute(text(
+            "ALTER TABLE content_search ADD COLUMN IF NOT EXISTS document tsvector GENERATED ALWAYS AS ("
+            "setweight(to_tsvector('russian', coalesce(title, '')), 'A') || "
+            "setweight(to_tsvector('russian', coalesce(body, '')), 'B')) STORED"))
+        db.session.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_content_search_document ON content_search USING GIN (document)"))
+    else:
+        db.session.execute(text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS content_search_fts USING fts5(title, body, tokenize='unicode61')"))
+    db.session.commit()
+
+
+def rebuild_content_search(batch_size: int = 200) -> int:
+    """Полностью перестраивает поисковый индекс; возвращает число документов."""
+    from sqlalchemy import text
+    connection = db.session.connection()
+    if not is_postgresql():
+        connection.execute(text("DELETE FROM content_search_fts"))
+    connection.execute(ContentSearchDocument.__table__.delete())
+    total = 0
+    for model in SEARCH_SOURCES:
+        last_id = 0
+        while True:
+            rows = model.query.filter(model.id > last_id).order_by(model.id).limit(batch_size).all()
+            if not rows:
+                break
+            docs = [doc for doc in map(search_document, rows) if doc]
+            sync_search_documents(db.session.connection(), docs, [])
+            total += len(docs)
+            last_id = rows[-1].id
+    db.session.commit()
+    return total
+
+
+def _format_snippet(marked: str) -> str:
+    """Экранирует фрагмент и превращает маркеры подсветки в <mark>."""
+    from markupsafe import escape
+    return str(escape(marked)).replace(_MARK_START, '<mark>').replace(_MARK_END, '</mark>')
+
+
+def _highlight_snippet(body: str, stems: list) -> str:
+    """Фрагмент body вокруг первого совпадения с подсвеченными словами (для SQLite)."""
+    parts = re.split(r'([0-9A-Za-zА-Яа-яЁё]+)', body)
+    words = parts[1::2]
+    hits = [i for i, word in enumerate(words) if any(_search_stem(word.lower()).startswith(s) for s in stems)]
+    first = max(hits[0] - SEARCH_SNIPPET_WORDS // 3, 0) if hits else 0
+    last = min(first + SEARCH_SNIPPET_WORDS, len(words))
+    hits = set(hits)
+    chunks = []
+    for i in range(first, last):
+        word = words[i]
+        chunks.append(f"{_MARK_START}{word}{_MARK_END}" if i in hits else word)
+        if i + 1 < last:
+            chunks.append(parts[2 * i + 2])
+    snippet = ''.join(chunks)
+    return ('… ' if first > 0 else '') + snippet + (' …' if last < len(words) else '')
+
+
+def search_content(query: str, doc_types: list, category: str = None, trimester: str = None,
+                   tags: list = None, limit: int = SEARCH_RESULT_LIMIT) -> list:
+    """Ранжированный поиск по content_search: [{'type', 'id', 'title', 'snippet', ...}, ...]."""
+    from sqlalchemy import select, text
+    table = ContentSearchDocument.__table__
+    filters = [table.c.doc_type.in_(doc_types)]
+    if category:
+        filters.append(table.c.category == category)
+    if trimester:
+        filters.append(table.c.trimester.in_((trimester, 'all')))
+    for tag in tags or []:
+        filters.append(table.c.tags.like(f"%,{tag},%"))
+
+    if is_postgresql():
+        tsquery = db.func.websearch_to_tsquery('russian', query)
+        document = db.literal_column('content_search.document')
+        rank = db.func.ts_rank_cd(document, tsquery)
+        snippet = db.func.ts_headline(
+            'russian', table.c.body, tsquery,
+            f'StartSel={_MARK_START}, StopSel={_MARK_END}, MaxWords={SEARCH_SNIPPET_WORDS}, MinWords=10, '
+            'MaxFragments=2, FragmentDelimiter=" … "')
+        stmt = (select(table, rank.label('score'), snippet.label('snippet'))
+                .where(document.op('@@')(tsquery), *filters)
+                .order_by(rank.desc(), table.c.id.desc()).limit(limit))
+        rows = db.session.execute(stmt).mappings().all()
+        snippets = [row['snippet'] for row in rows]
+    else:
+        stems = list(dict.fromkeys(_search_stem(word) for word in _search_words(query)))
+        if not stems:
+            return []
+        # Каждая основа — префиксный термин: «беремен»* найдёт и «беременность», и «беременных»
+        match = ' '.join(f'"{stem}"*' for stem in stems)
+        rank = db.literal_column('bm25(content_search_fts, 5.0, 1.0)')
+        fts = db.table('content_search_fts', db.column('rowid'))
+        stmt = (select(table, (-rank).label('score'))
+                .select_from(table.join(fts, fts.c.rowid == table.c.id))
+                .where(text('content_search_fts MATCH :match'), *filters)
+                .order_by(rank, table.c.id.desc()).limit(limit))
+        rows = db.session.execute(stmt, {'match': match}).mappings().all()
+        snippets = [_highlight_snippet(row['body'], stems) for row in rows]
+
+    results = []
+    for row, snippet in zip(rows, snippets):
+        endpoint, arg = SEARCH_DETAIL_ENDPOINTS[row['doc_type']]
+        results.append({
+            'type': row['doc_type'],
+            'id': row['doc_id'],
+            'title': row['title'],
+            'url': url_for(endpoint, **{arg: row['doc_id']}),
+            'snippet': _format_snippet(snippet),
+            'category': row['category'],
+            'trimester': row['trimester'],
+            'tags': [t for t in (row['tags'] or '').split(',') if t],
+            'score': round(float(row['score']), 4),
+        })
+    return results
+
+# ======================
+# Теги методичек: таблицы tag + guideline_tag вместо разбора строки Guideline.tags
+# ======================
+GUIDELINE_TAG_FACETS_LIMIT = 30
+
+
+def parse_tags(raw) -> list:
+    """'Протокол,  роды, протокол' -> ['протокол', 'роды'] (порядок сохраняется)."""
+    names = (' '.join(part.split()).lower()[:64] for part in (raw or '').split(','))
+    return list(dict.fromkeys(name for name in names if name))
+
+
+def dialect_insert(table):
+    """INSERT текущего диалекта — с поддержкой on_conflict_do_nothing/do_update (PostgreSQL, SQLite)."""
+    from sqlalchemy.dialects import postgresql, sqlite
+    return (postgresql.insert if is_postgresql() else sqlite.insert)(table)
+
+
+def _insert_tags(names: list) -> None:
+    """INSERT ... ON CONFLICT DO NOTHING: тег, который параллельно сохранила другая
+    транзакция, пропускается, а не обрывает сохранение методички на unique(tag.name)."""
+    db.session.execute(dialect_insert(Tag).values([{'name': name} for name in names])
+                       .on_conflict_do_nothing(index_elements=['name']))
+
+
+def _tag_ids(names: list) -> dict:
+    """{имя тега: id}; недостающие теги создаются."""
+    if not names:
+        return {}
+    existing = {tag.name: tag.id for tag in Tag.query.filter(Tag.name.in_(names))}
+    missing = [name for name in names if name not in existing]
+    if missing:
+        _insert_tags(missing)
+        existing.update(db.session.query(Tag.name, Tag.id).filter(Tag.name.in_(missing)).all())
+    return existing
+
+
+def _link_guideline_tags(guideline_id: int, names: list) -> None:
+    existing = _tag_ids(names)
+    GuidelineTag.query.filter_by(guideline_id=guideline_id).delete(synchronize_session=False)
+    db.session.add_all(GuidelineTag(guideline_id=guideline_id, tag_id=existing[name]) for name in names)
+
+
+def set_guideline_tags(guideline, raw) -> None:
+    """Сохраняет теги методички: строку Guideline.tags (для вывода) и связи guideline_tag."""
+    names = parse_tags(raw)
+    guideline.tags = ', '.join(names) or None
+    db.session.flush()  # нужен guideline.id
+    _link_guideline_tags(guideline.id, names)
+
+
+def guideline_ids_with_tags(names: list):
+    """Подзапрос id методичек, у которых есть все теги names (пересечение)."""
+    from sqlalchemy import select
+    return (select(GuidelineTag.guideline_id)
+            .join(Tag, Tag.id == GuidelineTag.tag_id)
+            .where(Tag.name.in_(names))
+            .group_by(GuidelineTag.guideline_id)
+            .having(db.func.count() == len(names)))
+
+
+def guideline_tag_facets(selected: list = None, limit: int = GUIDELINE_TAG_FACETS_LIMIT) -> list:
+    """[(тег, число опубликованных методичек)] среди методичек с тегами selected."""
+    count = db.func.count(GuidelineTag.guideline_id)
+    query = (db.session.query(Tag.name, count)
+             .join(GuidelineTag, GuidelineTag.tag_id == Tag.id)
+             .join(Guideline, Guideline.id == GuidelineTag.guideline_id)
+             .filter(Guideline.is_published.is_(True)))
+    if selected:
+        query = query.filter(GuidelineTag.guideline_id.in_(guideline_ids_with_tags(selected)))
+    return [tuple(row) for row in query.group_by(Tag.name).order_by(count.desc(), Tag.name).limit(limit)]
+
+
+def rebuild_guideline_tags() -> int:
+    """Заполняет guideline_tag по строкам Guideline.tags (миграция существующих баз)."""
+    linked = 0
+    for guideline_id, tags in db.session.query(Guideline.id, Guideline.tags).filter(Guideline.tags.isnot(None)).all():
+        names = parse_tags(tags)
+        _link_guideline_tags(guideline_id, names)
+        linked += len(names)
+    db.session.commit()
+    return linked
+
+# ======================
+# Фоновые задачи (daemon-потоки внутри процесса gunicorn)
+# ======================
+BACKGROUND_JOBS_ENABLED = os.getenv('BACKGROUND_JOBS_ENABLED', 'true').lower() == 'true'
+
+
+class BackgroundJob:
+    """Периодическая задача в отдельном потоке; wake() запускает её досрочно."""
+
+    def __init__(self, name: str, func, interval: float):
+        import threading
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self.last_run_at = None
+        self.last_result = None
+
+    def run_once(self):
+        """Один проход задачи в app context; ошибки логируются, поток не падает."""
+        with app.app_context():
+            try:
+                self.last_result = self.func()
+            except Exception as e:
+                db.session.rollback()
+                logger.exception(f"Background job {self.name} failed: {e}")
+                self.last_result = None
+            self.last_run_at = datetime.utcnow()
+            return self.last_result
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.run_once()
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def start(self) -> None:
+        import threading
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name=f'umay-{self.name}', daemon=True)
+        self._thread.start()
+        logger.info(f"🔄 Background job started: {self.name} (every {self.interval}s)")
+
+    def wake(self) -> None:
+        self._wake.set()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wake.set()
+
+
+background_jobs = {}
+
+
+def register_background_job(name: str, func, interval: float) -> BackgroundJob:
+    job = BackgroundJob(name, func, interval)
+    background_jobs[name] = job
+    return job
+
+
+@app.before_request
+def start_background_jobs():
+    """Запускает фоновые задачи при первом запросе рабочего процесса (не в тестах)."""
+    if app.config.get('BACKGROUND_JOBS_STARTED') or not BACKGROUND_JOBS_ENABLED or app.testing:
+        return
+    app.config['BACKGROUND_JOBS_STARTED'] = True
+    for job in background_jobs.values():
+        job.start()
+
+# ======================
+# Email outbox: фоновая отправка через постоянное SMTP-соединение
+# ======================
+EMAIL_OUTBOX_INTERVAL = float(os.getenv('EMAIL_OUTBOX_INTERVAL', '10'))
+EMAIL_OUTBOX_BATCH_SIZE = int(os.getenv('EMAIL_OUTBOX_BATCH_SIZE', '50'))
+EMAIL_OUTBOX_MAX_ATTEMPTS = int(os.getenv('EMAIL_OUTBOX_MAX_ATTEMPTS', '8'))
+EMAIL_OUTBOX_BACKOFF_SECONDS = int(os.getenv('EMAIL_OUTBOX_BACKOFF_SECONDS', '30'))
+# Простаивающее дольше соединение считаем закрытым сервером и открываем заново
+SMTP_IDLE_TIMEOUT = int(os.getenv('SMTP_IDLE_TIMEOUT', '60'))
+
+
+class SMTPUnavailable(Exception):
+    """SMTP-сервер недоступен: не удалось подключиться или переподключиться."""
+
+
+class SMTPConnection:
+    """SMTP-соединение, которое переиспользуется между письмами и пакетами."""
+
+    def __init__(self):
+        import threading
+        self._smtp = None
+        self._last_used = 0.0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        import smtplib
+        config = app.config
+        if config.get('MAIL_USE_SSL'):
+            smtp = smtplib.SMTP_SSL(config['MAIL_SERVER'], config['MAIL_PORT'], timeout=30)
+        else:
+            smtp = smtplib.SMTP(config['MAIL_SERVER'], config['MAIL_PORT'], timeout=30)
+            if config.get('MAIL_USE_TLS'):
+                smtp.starttls()
+        smtp.ehlo_or_helo_if_needed()
+        if config.get('MAIL_USERNAME') and config.get('MAIL_PASSWORD') and smtp.has_extn('auth'):
+            smtp.login(config['MAIL_USERNAME'], config['MAIL_PASSWORD'])
+        return smtp
+
+    def send(self, message) -> None:
+        import smtplib
+        import time
+        with self._lock:
+            if self._smtp is not None and time.monotonic() - self._last_used > SMTP_IDLE_TIMEOUT:
+                self._close()
+            for attempt in range(2):
+                if self._smtp is None:
+                    try:
+                        self._smtp = self._connect()
+                    except OSError as e:  # сюда же входят smtplib.SMTPException
+                        raise SMTPUnavailable(f"{e.__class__.__name__}: {e}") from e
+                try:
+                    self._smtp.send_message(message)
+                    break
+                except smtplib.SMTPServerDisconnected as e:
+                    self._close()
+                    if attempt:
+                        raise SMTPUnavailable(f"{e.__class__.__name__}: {e}") from e
+                except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused):
+                    raise  # отказ по адресу: сеанс в порядке, соединение переиспользуется
+                except Exception:
+                    # Таймаут или обрыв посреди письма: состояние протокола неизвестно
+                    self._close()
+                    raise
+            self._last_used = time.monotonic()
+
+    def _close(self) -> None:
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except Exception:
+                pass
+        self._smtp = None
+
+    def close(self) -> None:
+        with self._lock:
+            self._close()
+
+
+smtp_connection = SMTPConnection()
+
+
+def _build_email_message(outbox_message):
+    from email.message import EmailMessage
+    message = EmailMessage()
+    message['Subject'] = outbox_message.subject
+    message['From'] = app.config['MAIL_DEFAULT_SENDER']
+    message['To'] = outbox_message.recipient
+    message.set_content(outbox_message.text_body or '')
+    message.add_alternative(outbox_message.html_body, subtype='html')
+    return message
+
+
+def process_email_outbox(limit: int = None) -> dict:
+    """Отправляет пакет писем из outbox, которым подошло время.
+
+    Ошибки доставки откладывают письмо с экспоненциальной паузой; после
+    EMAIL_OUTBOX_MAX_ATTEMPTS попыток или отказа получателя письмо помечается failed.
+    Если SMTP-сервер недоступен, пакет прерывается на первом письме: остальные
+    откладываются на EMAIL_OUTBOX_BACKOFF_SECONDS без попытки, и их блокировки
+    снимаются коммитом, а не держатся, пока каждое письмо ждёт таймаута соединения.
+    """
+    import smtplib
+    now = datetime.utcnow()
+    query = EmailOutbox.query.filter(
+        EmailOutbox.status == 'pending', EmailOutbox.next_attempt_at <= now
+    ).order_by(EmailOutbox.next_attempt_at, EmailOutbox.id).limit(limit or EMAIL_OUTBOX_BATCH_SIZE)
+    if is_postgresql():
+        query = query.with_for_update(skip_locked=True)
+    stats = {'sent': 0, 'retry': 0, 'failed': 0, 'deferred': 0}
+    messages = query.all()
+    for index, message in enumerate(messages):
+        message.attempts += 1
+        try:
+            if not app.config.get('MAIL_SUPPRESS_SEND'):
+                smtp_connection.send(_build_email_message(message))
+            message.status = 'sent'
+            message.sent_at = datetime.utcnow()
+            message.last_error = None
+            stats['sent'] += 1
+        except Exception as e:
+            message.last_error = f"{e.__class__.__name__}: {e}"[:500]
+            if isinstance(e, smtplib.SMTPRecipientsRefused) or message.attempts >= EMAIL_OUTBOX_MAX_ATTEMPTS:
+                message.status = 'failed'
+                stats['failed'] += 1
+                logger.error(f"Email to {message.recipient} failed permanently: {message.last_error}")
+            else:
+                delay = EMAIL_OUTBOX_BACKOFF_SECONDS * 2 ** (message.attempts - 1)
+                message.next_attempt_at = datetime.utcnow() + timedelta(seconds=delay)
+                stats['retry'] += 1
+                logger.warning(f"Email to {message.recipient} postponed for {delay}s: {message.last_error}")
+            if isinstance(e, SMTPUnavailable):
+                retry_at = datetime.utcnow() + timedelta(seconds=EMAIL_OUTBOX_BACKOFF_SECONDS)
+                for pending in messages[index + 1:]:
+                    pending.next_attempt_at = retry_at
+                    stats['deferred'] += 1
+                break
+    db.session.commit()
+    if any(stats.values()):
+        logger.info(f"📧 Email outbox: {stats}")
+    return stats
+
+
+email_outbox_job = register_background_job('email_outbox', process_email_outbox, EMAIL_OUTBOX_INTERVAL)
+
+# ======================
+# SMS outbox: фоновая отправка через провайдеров с размыкателями
+# ======================
+SMS_OUTBOX_INTERVAL = float(os.getenv('SMS_OUTBOX_INTERVAL', '5'))
+SMS_OUTBOX_BATCH_SIZE = int(os.getenv('SMS_OUTBOX_BATCH_SIZE', '20'))
+SMS_OUTBOX_MAX_ATTEMPTS = int(os.getenv('SMS_OUTBOX_MAX_ATTEMPTS', '5'))
+SMS_OUTBOX_BACKOFF_SECONDS = int(os.getenv('SMS_OUTBOX_BACKOFF_SECONDS', '5'))
+# На столько откладывается сообщение, пока идёт его отправка; должно превышать
+# худшее время send_sms: провайдеры × (SMS_CONNECT_TIMEOUT + SMS_READ_TIMEOUT)
+SMS_OUTBOX_CLAIM_SEC = int(os.getenv('SMS_OUTBOX_CLAIM_SEC', '120'))
+
+
+def _claim_sms_message(now: datetime, stats: dict):
+    """Берёт одно подошедшее SMS и продлевает его next_attempt_at на SMS_OUTBOX_CLAIM_SEC.
+
+    Коммит снимает блокировку строки до обращения к провайдерам; пока идёт
+    отправка, другие воркеры строку не видят. Возвращает (id, phone, text)
+    или None; истёкшие сообщения помечаются failed и пропускаются.
+    """
+    while True:
+        query = SMSOutbox.query.filter(
+            SMSOutbox.status == 'pending', SMSOutbox.next_attempt_at <= now
+        ).order_by(SMSOutbox.next_attempt_at, SMSOutbox.id)
+        if is_postgresql():
+            query = query.with_for_update(skip_locked=True)
+        message = query.first()
+        if message is None:
+            db.session.commit()
+            return None
+        if message.expires_at and message.expires_at <= now:
+            message.status = 'failed'
+            message.last_error = 'expired'
+            message.text = ''
+            db.session.commit()
+            stats['failed'] += 1
+            continue
+        message.attempts += 1
+        message.next_attempt_at = now + timedelta(seconds=SMS_OUTBOX_CLAIM_SEC)
+        claimed = (message.id, message.phone, message.text)
+        db.session.commit()
+        return claimed
+
+
+def process_sms_outbox(limit: int = None) -> dict:
+    """Отправляет пакет SMS из очереди.
+
+    Каждое сообщение сначала закрепляется коротким коммитом (_claim_sms_message),
+    затем отправляется вне транзакции, и результат фиксируется отдельным коммитом:
+    сбой воркера не приводит к повторной отправке уже ушедших SMS пакета.
+    Неудача откладывает сообщение с экспоненциальной паузой. Истёкшие
+    (код уже недействителен) и исчерпавшие попытки сообщения помечаются failed.
+    """
+    now = datetime.utcnow()
+    stats = {'sent': 0, 'retry': 0, 'failed': 0}
+    for _ in range(limit or SMS_OUTBOX_BATCH_SIZE):
+        claimed = _claim_sms_message(now, stats)
+        if claimed is None:
+            break
+        message_id, phone, text = claimed
+        provider = send_sms(phone, text)
+        message = db.session.get(SMSOutbox, message_id)
+        if provider:
+            message.status = 'sent'
+            message.provider = provider
+            message.sent_at = datetime.utcnow()
+            message.last_error = None
+            message.text = ''
+            stats['sent'] += 1
+        elif message.attempts >= SMS_OUTBOX_MAX_ATTEMPTS:
+            message.status = 'failed'
+            message.last_error = 'all providers failed'
+            message.text = ''
+            stats['failed'] += 1
+            logger.error(f"❌ SMS на {message.phone} не отправлено после {message.attempts} попыток")
+        else:
+            message.last_error = 'all providers failed'
+            message.next_attempt_at = datetime.utcnow() + timedelta(
+                seconds=SMS_OUTBOX_BACKOFF_SECONDS * 2 ** (message.attempts - 1))
+            stats['retry'] += 1
+        db.session.commit()
+    if stats['sent'] or stats['retry'] or stats['failed']:
+        logger.info(f"📱 SMS outbox: {stats}")
+    return stats
+
+
+sms_outbox_job = register_background_job('sms_outbox', process_sms_outbox, SMS_OUTBOX_INTERVAL)
+
+
+def purge_otp_codes() -> dict:
+    """Удаляет давно истёкшие OTP-коды и завершённые SMS старше OTP_RETENTION_SEC."""
+    cutoff = datetime.utcnow() - timedelta(seconds=OTP_RETENTION_SEC)
+    stats = {
+        'otp_code': OTPCode.query.filter(OTPCode.expires_at < cutoff).delete(synchronize_session=False),
+        'sms_outbox': SMSOutbox.query.filter(
+            SMSOutbox.status.in_(('sent', 'failed')),
+            SMSOutbox.created_at < cutoff
+        ).delete(synchronize_session=False),
+    }
+    db.session.commit()
+    if any(stats.values()):
+        logger.info(f"🧹 OTP retention: {stats}")
+    return stats
+
+
+otp_purge_job = register_background_job('otp_purge', purge_otp_codes, OTP_PURGE_INTERVAL)
+
+# ======================
+# Retention: подтверждения email и отправленные письма
+# ======================
+# Использованные и истёкшие записи хранятся ещё столько секунд (повторный клик по ссылке, разбор жалоб)
+EMAIL_VERIFICATION_RETENTION_SEC = int(os.getenv('EMAIL_VERIFICATION_RETENTION_SEC', str(7 * 24 * 3600)))
+EMAIL_RETENTION_INTERVAL = float(os.getenv('EMAIL_RETENTION_INTERVAL', '3600'))
+EMAIL_RETENTION_BATCH_SIZE = int(os.getenv('EMAIL_RETENTION_BATCH_SIZE', '1000'))
+
+
+def _delete_in_batches(model, condition, batch_size: int) -> int:
+    """Удаляет строки пакетами по batch_size с коммитом после каждого, чтобы не держать длинных блокировок."""
+    deleted = 0
+    while True:
+        ids = [row.id for row in db.session.query(model.id).filter(condition).limit(batch_size).all()]
+        if not ids:
+            return deleted
+        deleted += model.query.filter(model.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+        if len(ids) < batch_size:
+            return deleted
+
+
+def purge_email_verifications(batch_size: int = None) -> dict:
+    """Удаляет истёкшие и подтверждённые записи email_verification и отправленные письма outbox."""
+    batch_size = batch_size or EMAIL_RETENTION_BATCH_SIZE
+    cutoff = datetime.utcnow() - timedelta(seconds=EMAIL_VERIFICATION_RETENTION_SEC)
+    stats = {
+        'email_verification': _delete_in_batches(EmailVerification, db.or_(
+            EmailVerification.expires_at < cutoff,
+            db.and_(EmailVerification.verified.is_(True), EmailVerification.created_at < cutoff),
+        ), batch_size),
+        'email_outbox': _delete_in_batches(EmailOutbox, db.and_(
+            EmailOutbox.status.in_(('sent', 'failed')),
+            EmailOutbox.created_at < cutoff,
+        ), batch_size),
+    }
+    if any(stats.values()):
+        logger.info(f"🧹 Email retention: {stats}")
+    return stats
+
+
+email_retention_job = register_background_job('email_retention', purge_email_verifications, EMAIL_RETENTION_INTERVAL)
+
+# Таблицы, которые растут с каждой регистрацией/отправкой — размер смотрим в /admin/metrics
+METRICS_TABLES = ['email_verification', 'email_outbox', 'otp_code', 'sms_outbox', 'user_identity',
+                  'patient', 'patient_tombstone', 'content_search', 'similar_article']
+
+
+def table_size_metrics() -> dict:
+    """Число строк (и размер на диске для PostgreSQL) по таблицам METRICS_TABLES."""
+    from sqlalchemy import text
+    metrics = {}
+    for table in METRICS_TABLES:
+        rows = db.session.execute(text(f"SELECT COUNT(*) FROM {table}")).scalar()
+        size = None
+        if is_postgresql():
+            size = db.session.execute(text("SELECT pg_total_relation_size(:t)"), {'t': table}).scalar()
+        metrics[table] = {'rows': rows, 'bytes': size}
+    return metrics
+
+# ======================
+# Счётчики просмотров: буфер в памяти, периодический UPDATE views = views + n
+# ======================
+VIEW_COUNTER_FLUSH_INTERVAL = float(os.getenv('VIEW_COUNTER_FLUSH_INTERVAL', '30'))
+
+
+class ViewCounterBuffer:
+    """Накопленные просмотры по (модель, id); публичные страницы не пишут в базу на каждый просмотр."""
+
+    def __init__(self):
+        import threading
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def add(self, model, object_id: int, count: int = 1) -> int:
+        """Учитывает просмотр и возвращает число ещё не записанных просмотров объекта."""
+        key = (model, object_id)
+        with self._lock:
+            self._pending[key] = self._pending.get(key, 0) + count
+            return self._pending[key]
+
+    def pending(self, model, object_id: int) -> int:
+        with self._lock:
+            return self._pending.get((model, object_id), 0)
+
+    def flush(self) -> dict:
+        """Записывает накопленное пакетными атомарными UPDATE; при ошибке возвращает счётчики в буфер."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return {}
+        by_model = {}
+        for (model, object_id), count in pending.items():
+            by_model.setdefault(model, []).append({'object_id': object_id, 'count': count})
+        try:
+            for model, params in by_model.items():
+                table = model.__table__
+                stmt = table.update().where(table.c.id == db.bindparam('object_id')).values(
+                    views=db.func.coalesce(table.c.views, 0) + db.bindparam('count'))
+                db.session.execute(stmt, params)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            for (model, object_id), count in pending.items():
+                self.add(model, object_id, count)
+            raise
+        return {model.__tablename__: sum(p['count'] for p in params) for model, params in by_model.items()}
+
+
+view_counters = ViewCounterBuffer()
+
+
+def record_view(obj) -> None:
+    """Учитывает просмотр obj; obj.views показывает сохранённое значение плюс буфер, не помечая объект изменённым."""
+    from sqlalchemy.orm.attributes import set_committed_value
+    pending = view_counters.add(type(obj), obj.id)
+    set_committed_value(obj, 'views', (obj.views or 0) + pending)
+
+
+def flush_view_counters() -> dict:
+    stats = view_counters.flush()
+    if stats:
+        logger.info(f"👁 View counters flushed: {stats}")
+    return stats
+
+
+view_counter_job = register_background_job('view_counters', flush_view_counters, VIEW_COUNTER_FLUSH_INTERVAL)
+
+
+def _flush_view_counters_at_exit():
+    """Graceful shutdown (SIGTERM gunicorn → выход воркера): не теряем накопленные просмотры."""
+    view_counter_job.run_once()
+
+
+atexit.register(_flush_view_counters_at_exit)
+
+# ======================
+# Похожие статьи: TF-IDF по основам слов, top-k соседей в таблице similar_article
+# ======================
+SIMILAR_ARTICLES_K = int(os.getenv('SIMILAR_ARTICLES_K', '6'))  # с запасом: соседа могут снять с публикации
+SIMILAR_ARTICLES_SHOWN = 3
+SIMILAR_ARTICLES_INTERVAL = float(os.getenv('SIMILAR_ARTICLES_INTERVAL', '60'))
+# Полный пересчёт обновляет IDF, который инкрементальные проходы не трогают
+SIMILAR_ARTICLES_REBUILD_SEC = float(os.getenv('SIMILAR_ARTICLES_REBUILD_SEC', str(24 * 3600)))
+SIMILAR_TITLE_WEIGHT = 2  # слово заголовка весит как два слова текста
+SIMILAR_MAX_TERMS = 64  # в векторе остаются самые весомые термы: меньше пересечений при поиске соседей
+SIMILAR_ARTICLES_LOCK_KEY = 0x756d6179  # ключ advisory-блокировки пересчёта similar_article на PostgreSQL
+_SIMILAR_STOP_STEMS = frozenset(search_stems(
+    'и в во не что он на я с со как а то все она так его но да ты к у же вы за бы по только ее мне было вот '
+    'от меня еще нет о из ему теперь когда даже ну ли если уже или ни быть был него до вас опять уж вам ведь '
+    'там потом себя ничего ей может они тут где есть надо ней для мы тебя их чем была сам чтоб без чего раз '
+    'тоже себе под будет тогда кто этот того потому этого какой совсем ним здесь этом один почти мой тем '
+    'чтобы нее сейчас были куда зачем всех можно при после над больше тот через эти нас про всего них какая '
+    'много разве эту моя хорошо свою этой перед иногда лучше чуть том нельзя такой им более всегда между '
+    'очень также'
+).split())
+
+
+class SimilarityIndex:
+    """TF-IDF векторы статей (разреженные dict, норма 1) и инвертированный индекс по термам."""
+
+    def __init__(self, articles):
+        import heapq
+        import math
+        term_counts = {}
+        for article_id, title, content in articles:
+            counts = {}
+            words = search_stems(title).split() * SIMILAR_TITLE_WEIGHT + search_stems(content).split()
+            for term in words:
+                if len(term) > 2 and term not in _SIMILAR_STOP_STEMS and not term.isdigit():
+                    counts[term] = counts.get(term, 0) + 1
+            term_counts[article_id] = counts
+        document_frequency = {}
+        for counts in term_counts.values():
+            for term in counts:
+                document_frequency[term] = document_frequency.get(term, 0) + 1
+        total = len(term_counts)
+        self.vectors = {}
+        self.postings = {}
+        for article_id, counts in term_counts.items():
+            weights = {term: (1 + math.log(count)) * (math.log((1 + total) / (1 + document_frequency[term])) + 1)
+                       for term, count in counts.items()}
+            vector = dict(heapq.nlargest(SIMILAR_MAX_TERMS, weights.items(), key=lambda item: item[1]))
+            norm = math.sqrt(sum(w * w for w in vector.values())) or 1.0
+            vector = {term: w / norm for term, w in vector.items()}
+            self.vectors[article_id] = vector
+            for term, weight in vector.items():
+                self.postings.setdefault(term, []).append((article_id, weight))
+
+    def scores(self, article_id: int) -> dict:
+        """{другая статья: косинусная близость} по общим термам."""
+        scores = {}
+        for term, weight in self.vectors.get(article_id, {}).items():
+            for other_id, other_weight in self.postings[term]:
+                if other_id != article_id:
+                    scores[other_id] = scores.get(other_id, 0.0) + weight * other_weight
+        return scores
+
+    def neighbour_rows(self, article_id: int, k: int = None) -> list:
+        import heapq
+        best = heapq.nlargest(k or SIMILAR_ARTICLES_K, self.scores(article_id).items(),
+                              key=lambda item: (item[1], -item[0]))
+        return [{'article_id': article_id, 'rank': rank, 'similar_id': other_id, 'score': round(score, 6)}
+                for rank, (other_id, score) in enumerate(best, start=1)]
+
+
+def load_similarity_index() -> SimilarityIndex:
+    articles = (db.session.query(MamaContent.id, MamaContent.title, MamaContent.content)
+                .filter(MamaContent.is_published.is_(True)).all())
+    return SimilarityIndex(articles)
+
+
+def _lock_similar_articles() -> bool:
+    """Блокировка пересчёта similar_article до конца транзакции; False — её держит другой воркер.
+
+    Воркеры пересчитывают таблицу независимо (DELETE + вставка по PK (article_id, rank)),
+    и два одновременных пересчёта падают на уникальности. На SQLite запись и так
+    сериализована, блокировка не нужна.
+    """
+    if not is_postgresql():
+        return True
+    return bool(db.session.execute(db.text('SELECT pg_try_advisory_xact_lock(:key)'),
+                                   {'key': SIMILAR_ARTICLES_LOCK_KEY}).scalar())
+
+
+def rebuild_similar_articles():
+    """Полный пересчёт similar_article; возвращает число статей или None, если пересчёт уже идёт в другом воркере."""
+    if not _lock_similar_articles():
+        db.session.rollback()
+        return None
+    index = load_similarity_index()
+    rows = [row for article_id in index.vectors for row in index.neighbour_rows(article_id)]
+    db.session.query(SimilarArticle).delete()
+    bulk_insert_rows(SimilarArticle.__table__, rows)
+    bump_content_version(db.session)  # блок «похожие» на страницах статей изменился
+    db.session.commit()
+    return len(index.vectors)
+
+
+def update_similar_articles(changed_ids):
+    """Пересчитывает соседей изменённых статей и тех статей, чьи списки они затрагивают.
+
+    None — таблицу сейчас пересчитывает другой воркер.
+    """
+    changed_ids = set(changed_ids)
+    if not _lock_similar_articles():
+        db.session.rollback()
+        return None
+    index = load_similarity_index()
+    affected = set(changed_ids)
+    # Статьи, у которых изменённая статья уже в списке (могла отдалиться или исчезнуть)
+    affected.update(article_id for (article_id,) in db.session.query(SimilarArticle.article_id)
+                    .filter(SimilarArticle.similar_id.in_(changed_ids)))
+    # Статьи, в top-k которых изменённая статья теперь проходит
+    candidates = {}
+    for article_id in changed_ids:
+        for other_id, score in index.scores(article_id).items():
+            candidates[other_id] = max(score, candidates.get(other_id, 0.0))
+    candidates = {other_id: score for other_id, score in candidates.items() if other_id not in affected}
+    if candidates:
+        thresholds = dict(
+            db.session.query(SimilarArticle.article_id, db.func.min(SimilarArticle.score))
+            .filter(SimilarArticle.article_id.in_(candidates))
+            .group_by(SimilarArticle.article_id)
+            .having(db.func.count() >= SIMILAR_ARTICLES_K))
+        affected.update(other_id for other_id, score in candidates.items()
+                        if score > thresholds.get(other_id, 0.0))
+
+    SimilarArticle.query.filter(SimilarArticle.article_id.in_(affected)).delete(synchronize_session=False)
+    bulk_insert_rows(SimilarArticle.__table__,
+                     [row for article_id in affected for row in index.neighbour_rows(article_id)])
+    bump_content_version(db.session)
+    db.session.commit()
+    return len(affected)
+
+
+class SimilarArticlesRefresher:
+    """Очередь изменённых статей процесса и время последнего полного пересчёта."""
+
+    def __init__(self):
+        import threading
+        import time
+        self._lock = threading.Lock()
+        self._pending = set()
+        self.rebuilt_at = time.monotonic()
+
+    def mark(self, article_ids) -> None:
+        with self._lock:
+            self._pending.update(article_ids)
+
+    def refresh(self) -> dict:
+        import time
+        if time.monotonic() - self.rebuilt_at >= SIMILAR_ARTICLES_REBUILD_SEC:
+            with self._lock:
+                self._pending.clear()
+            self.rebuilt_at = time.monotonic()
+            count = rebuild_similar_articles()
+            if count is None:
+                return {'rebuilt': 0, 'skipped': 'locked'}  # пересчитывает другой воркер
+            return {'rebuilt': count}
+        with self._lock:
+            pending, self._pending = self._pending, set()
+        if not pending:
+            return {'updated': 0}
+        try:
+            count = update_similar_articles(pending)
+        except Exception:
+            self.mark(pending)
+            raise
+        if count is None:
+            self.mark(pending)
+            return {'updated': 0, 'skipped': 'locked'}
+        return {'updated': count}
+
+
+similar_articles = SimilarArticlesRefresher()
+similar_articles_job = register_background_job('similar_articles', similar_articles.refresh, SIMILAR_ARTICLES_INTERVAL)
+
+
+@event.listens_for(db.session, 'after_flush')
+def _collect_changed_articles(session, flush_context):
+    from sqlalchemy import inspect
+    ids = session.info.setdefault('changed_article_ids', set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, MamaContent):
+            state = inspect(obj)
+            if obj in session.new or obj in session.deleted or any(
+                    state.attrs[name].history.has_changes() for name in ('title', 'content', 'is_published')):
+                ids.add(obj.id)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _queue_changed_articles(session):
+    """Ставит изменённые статьи в очередь пересчёта похожих (после коммита)."""
+    ids = session.info.pop('changed_article_ids', None)
+    if ids:
+        similar_articles.mark(ids)
+        similar_articles_job.wake()
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _forget_changed_articles(session):
+    session.info.pop('changed_article_ids', None)
+
+
+def similar_articles_for(article, limit: int = SIMILAR_ARTICLES_SHOWN) -> list:
+    """Похожие опубликованные статьи одним запросом по первичному ключу similar_article."""
+    return (MamaContent.query
+            .join(SimilarArticle, SimilarArticle.similar_id == MamaContent.id)
+            .filter(SimilarArticle.article_id == article.id, MamaContent.is_published.is_(True))
+            .order_by(SimilarArticle.rank)
+            .limit(limit).all())
+
+# ======================
+# Conditional GET для страниц контента: ETag (версия контента) + Last-Modified
+# ======================
+CONTENT_VERSION_COUNTER = 'content'
+CONTENT_MODELS = (News, MamaContent, Guideline)
+# Last-Modified списков: (страница, версия контента) -> max(updated_at)
+content_last_modified_cache = TTLCache(maxsize=256, ttl=3600)
+
+
+def _templates_version() -> str:
+    """Отпечаток шаблонов: после деплоя с новыми шаблонами ETag меняются."""
+    import hashlib
+    digest = hashlib.sha1()
+    folder = os.path.join(app.root_path, app.template_folder)
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        for name in sorted(files):
+            stat = os.stat(os.path.join(root, name))
+            digest.update(f"{os.path.relpath(os.path.join(root, name), folder)}:{stat.st_size}:{int(stat.st_mtime)}".encode())
+    return digest.hexdigest()[:8]
+
+
+TEMPLATES_VERSION = _templates_version()
+
+
+CONTENT_VERSION_TTL = float(os.getenv('CONTENT_VERSION_TTL', '2'))
+# Версия контента в памяти процесса: изменения в других воркерах видны через CONTENT_VERSION_TTL
+content_version_cache = TTLCache(maxsize=1, ttl=CONTENT_VERSION_TTL)
+
+
+def current_content_version() -> int:
+    version = content_version_cache.get(CONTENT_VERSION_COUNTER)
+    if version is None:
+        counter = db.session.get(Counter, CONTENT_VERSION_COUNTER)
+        version = counter.value if counter else 0
+        content_version_cache.set(CONTENT_VERSION_COUNTER, version)
+    return version
+
+
+def bump_content_version(session) -> None:
+    """Новая версия контента в транзакции session; кэши процесса сбрасываются после коммита."""
+    next_counter_value(CONTENT_VERSION_COUNTER, connection=session.connection())
+    session.info['content_changed'] = True
+
+
+@event.listens_for(db.session, 'after_flush')
+def _bump_content_version(session, flush_context):
+    """Любое изменение новостей/статей/методичек меняет ETag страниц контента."""
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, CONTENT_MODELS) and (obj not in session.dirty or session.is_modified(obj)):
+            bump_content_version(session)
+            return
+
+
+@event.listens_for(db.session, 'after_commit')
+def _forget_content_version(session):
+    if session.info.pop('content_changed', False):
+        content_version_cache.clear()
+        page_cache.clear()
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _keep_content_version(session):
+    session.info.pop('content_changed', None)
+
+
+def max_updated_at(*models):
+    """Последнее изменение среди моделей (Last-Modified списков), кэшируется до смены версии контента."""
+    values = [db.session.query(db.func.max(model.updated_at)).scalar() for model in models]
+    return max((v for v in values if v), default=None)
+
+
+@app.template_global()
+def viewer_key() -> str:
+    """Кто смотрит страницу — всё, от чего зависит навигация: id, имя и роль пользователя."""
+    if not current_user.is_authenticated:
+        return 'anon'
+    return f"{current_user.get_id()}:{getattr(current_user, 'full_name', '')}:{getattr(current_user, 'user_type', '')}"
+
+
+def content_not_modified(last_modified=None):
+    """Валидаторы страницы контента; 304-ответ, если у клиента актуальная копия, иначе None.
+
+    last_modified — datetime или функция (для списков: считается один раз на версию контента).
+    Заголовки ETag/Last-Modified/Cache-Control/Vary добавляет add_content_validators.
+    """
+    import hashlib
+    from datetime import timezone
+    if request.method != 'GET' or session.get('_flashes'):
+        return None  # страница с flash-сообщением показывается один раз и не кэшируется
+    try:
+        version = current_content_version()
+        if callable(last_modified):
+            key = (request.endpoint, version)
+            value = content_last_modified_cache.get(key)
+            if value is None:
+                value = last_modified() or datetime(2000, 1, 1)
+                content_last_modified_cache.set(key, value)
+            last_modified = value
+    except Exception as e:
+        db.session.rollback()
+        logger.warning(f"Content validators failed: {e}")
+        return None
+
+    digest = hashlib.sha1(f"{TEMPLATES_VERSION}|{request.full_path}|{viewer_key()}".encode('utf-8')).hexdigest()[:16]
+    etag = f"{version}-{digest}"
+    if last_modified is not None:
+        last_modified = last_modified.replace(tzinfo=timezone.utc, microsecond=0)
+    g.content_validators = (etag, last_modified)
+
+    # If-None-Match главнее If-Modified-Since (RFC 9110): удаление не двигает max(updated_at)
+    if request.if_none_match:
+        fresh = etag in request.if_none_match
+    else:
+        fresh = bool(last_modified and request.if_modified_since and last_modified <= request.if_modified_since)
+    return app.response_class(status=304) if fresh else None
+
+
+@app.after_request
+def add_content_validators(response):
+    validators = g.pop('content_validators', None)
+    if validators is None or response.status_code not in (200, 304):
+        return response
+    etag, last_modified = validators
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    # Анонимную страницу может хранить и прокси; страницу пользователя — только браузер/service worker
+    shared = not current_user.is_authenticated and not session
+    response.headers['Cache-Control'] = 'public, no-cache' if shared else 'private, no-cache'
+    response.vary.add('Cookie')
+    return response
+
+# ======================
+# Кэш страниц целиком для анонимных GET-запросов
+# ======================
+PAGE_CACHE_ENABLED = os.getenv('PAGE_CACHE_ENABLED', 'true').lower() == 'true'
+PAGE_CACHE_SIZE = int(os.getenv('PAGE_CACHE_SIZE', '512'))
+_PAGE_CACHE_HEADERS = ('Content-Type', 'ETag', 'Last-Modified', 'Cache-Control', 'Vary')
+
+
+class PageCache:
+    """Готовые ответы страниц (статус, заголовки, тело) и счётчики попаданий по маршрутам."""
+
+    def __init__(self, maxsize: int):
+        import threading
+        self.store = TTLCache(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self.hits = {}
+        self.misses = {}
+
+    def count(self, endpoint: str, hit: bool) -> None:
+        counters = self.hits if hit else self.misses
+        with self._lock:
+            counters[endpoint] = counters.get(endpoint, 0) + 1
+
+    def clear(self) -> None:
+        self.store.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            routes = {}
+            for endpoint in set(self.hits) | set(self.misses):
+                hits, misses = self.hits.get(endpoint, 0), self.misses.get(endpoint, 0)
+                routes[endpoint] = {'hits': hits, 'misses': misses, 'hit_rate': round(hits / (hits + misses), 3)}
+            hits, misses = sum(self.hits.values()), sum(self.misses.values())
+        return {
+            'entries': len(self.store),
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': round(hits / (hits + misses), 3) if hits + misses else None,
+            'routes': routes,
+        }
+
+    def reset(self) -> None:
+        self.clear()
+        with self._lock:
+            self.hits.clear()
+            self.misses.clear()
+
+
+page_cache = PageCache(PAGE_CACHE_SIZE)
+
+
+def cache_page(ttl: float, content: bool = True):
+    """Кэширует ответ маршрута для анонимов: ключ — путь, query string и тип устройства.
+
+    content=True — страница показывает новости/статьи: запись действительна только для
+    текущей версии контента (см. bump_content_version). Вошедшие пользователи, запросы с
+    данными в сессии (flash) и ответы, ставящие cookie, мимо кэша.
+    """
+    def decorator(view):
+        page_ttl = float(os.getenv(f'PAGE_CACHE_TTL_{view.__name__.upper()}', ttl))
+
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if (not PAGE_CACHE_ENABLED or request.method != 'GET'
+                    or current_user.is_authenticated or session):
+                return view(*args, **kwargs)
+            device = 'mobile' if is_mobile_device() else 'desktop'
+            key = (request.path, request.query_string, device)
+            version = current_content_version() if content else None
+            entry = page_cache.store.get(key)
+            if entry is not None and entry[0] == version:
+                page_cache.count(request.endpoint, hit=True)
+                response = app.response_class(entry[3], status=entry[1], headers=entry[2])
+                response.headers['X-Page-Cache'] = 'HIT'
+                return response.make_conditional(request)
+
+            page_cache.count(request.endpoint, hit=False)
+            response = app.make_response(view(*args, **kwargs))
+            add_content_validators(response)  # ETag/Last-Modified сохраняются вместе с телом
+            if response.status_code == 200 and 'Set-Cookie' not in response.headers and not session:
+                headers = [(name, response.headers[name]) for name in _PAGE_CACHE_HEADERS if name in response.headers]
+                page_cache.store.set(key, (version, 200, headers, response.get_data()), ttl=page_ttl)
+            response.headers['X-Page-Cache'] = 'MISS'
+            return response
+        return wrapper
+    return decorator
+
+# ======================
+# Кэш фрагментов шаблонов: {% cache key, ttl[, 'news'|'mama'|'guidelines'] %}…{% endcache %}
+# ======================
+FRAGMENT_CACHE_ENABLED = os.getenv('FRAGMENT_CACHE_ENABLED', 'true').lower() == 'true'
+FRAGMENT_CACHE_SIZE = int(os.getenv('FRAGMENT_CACHE_SIZE', '1024'))
+# Теги данных контента: такие фрагменты действительны только для текущей версии контента
+FRAGMENT_CONTENT_TAGS = frozenset({'news', 'mama', 'guidelines'})
+
+
+class FragmentCache:
+    """Отрендеренные фрагменты шаблонов.
+
+    Фрагмент меняется вместе с ключом (например, viewer_key() для навигации)
+    или, для тегов контента, с current_content_version(); остальное — по TTL.
+    """
+
+    def __init__(self, maxsize: int):
+        import threading
+        self.store = TTLCache(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, key, tags) -> tuple:
+        key = key if isinstance(key, str) else tuple(key)
+        unknown = set(tags) - FRAGMENT_CONTENT_TAGS
+        if unknown:
+            raise ValueError(f"Unknown fragment cache tags: {sorted(unknown)}")
+        content = current_content_version() if tags else None
+        return key, content
+
+    def render(self, key, ttl: float, tags, caller):
+        if not FRAGMENT_CACHE_ENABLED:
+            return caller()
+        full_key = self._key(key, tags)
+        html = self.store.get(full_key)
+        with self._lock:
+            if html is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if html is None:
+            html = caller()
+            self.store.set(full_key, html, ttl=ttl)
+        return html
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {'entries': len(self.store), 'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': round(self.hits / total, 3) if total else None}
+
+    def reset(self) -> None:
+        self.store.clear()
+        with self._lock:
+            self.hits = self.misses = 0
+
+
+fragment_cache = FragmentCache(FRAGMENT_CACHE_SIZE)
+
+
+class FragmentCacheExtension(Extension):
+    """{% cache key, ttl[, 'тег', ...] %}…{% endcache %}: тело рендерится раз на ключ.
+
+    key — строка или список (например ['nav', viewer_key()]); ttl — секунды;
+    теги — из FRAGMENT_CONTENT_TAGS, если фрагмент показывает данные контента.
+    """
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        key = parser.parse_expression()
+        parser.stream.expect('comma')
+        ttl = parser.parse_expression()
+        cache_tags = []
+        while parser.stream.skip_if('comma'):
+            cache_tags.append(parser.parse_expression())
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+        call = self.call_method('_render', [key, ttl, nodes.List(cache_tags)])
+        return nodes.CallBlock(call, [], [], body).set_lineno(lineno)
+
+    def _render(self, key, ttl, tags, caller):
+        return fragment_cache.render(key, ttl, tags, caller)
+
+
+app.jinja_env.add_extension(FragmentCacheExtension)
+
+
+@app.template_global()
+def latest_news(limit: int = 6) -> list:
+    """Последние опубликованные новости — для ленты внутри {% cache %} (без запроса при попадании)."""
+    try:
+        return News.query.filter_by(is_published=True).order_by(News.published_at.desc()).limit(limit).all()
+    except Exception as e:
+        db.session.rollback()
+        logger.warning(f"Latest news query failed: {e}")
+        return []
+
+
+@app.template_global()
+def recent_mama_content(limit: int = 6) -> list:
+    return MamaContent.query.order_by(MamaContent.created_at.desc()).limit(limit).all()
+
+# ======================
+# Bulk storage helpers: COPY на PostgreSQL, executemany на SQLite
+# ======================
+def is_postgresql(connection=None) -> bool:
+    """True, если база — PostgreSQL (production через DATABASE_URL)."""
+    dialect = connection.dialect if connection is not None else db.engine.dialect
+    return dialect.name == 'postgresql'
+
+
+def _copy_csv_value(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, datetime):
+        return value.isoformat(sep=' ')
+    return value
+
+
+def bulk_insert_rows(table, rows, connection=None, use_copy=None) -> int:
+    """Вставляет список dict-строк в таблицу одной операцией.
+
+    На PostgreSQL данные передаются через COPY … FROM STDIN (CSV), иначе —
+    executemany. Работает в текущей транзакции (по умолчанию в db.session);
+    коммит остаётся за вызывающим кодом. Python-умолчания колонок при COPY
+    не применяются, поэтому строки должны содержать все нужные значения.
+    """
+    if not rows:
+        return 0
+    import csv
+    connection = connection if connection is not None else db.session.connection()
+    if use_copy is None:
+        use_copy = is_postgresql(connection)
+    if not use_copy:
+        connection.execute(table.insert(), rows)
+        return len(rows)
+
+    columns = list(rows[0].keys())
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    for row in rows:
+        writer.writerow([_copy_csv_value(row.get(column)) for column in columns])
+    buffer.seek(0)
+
+    quote = connection.dialect.identifier_preparer.quote
+    column_list = ', '.join(quote(column) for column in columns)
+    sql = f"COPY {quote(table.name)} ({column_list}) FROM STDIN WITH (FORMAT csv, NULL '\\N')"
+    cursor = connection.connection.dbapi_connection.cursor()
+    try:
+        cursor.copy_expert(sql, buffer)
+    finally:
+        cursor.close()
+    return len(rows)
+
+
+def bulk_export_csv(statement, out, connection=None, use_copy=None) -> None:
+    """Пишет результат SELECT в `out` как CSV с заголовком.
+
+    На PostgreSQL используется COPY (…) TO STDOUT, иначе строки читаются курсором
+    и записываются csv.writer. Заголовки — имена/labels колонок запроса.
+    """
+    import csv
+    connection = connection if connection is not None else db.session.connection()
+    if use_copy is None:
+        use_copy = is_postgresql(connection)
+    if not use_copy:
+        result = connection.execute(statement)
+        writer = csv.writer(out, lineterminator='\n')
+        writer.writerow(list(result.keys()))
+        for chunk in result.partitions(1000):
+            writer.writerows(chunk)
+        return
+
+    compiled = statement.compile(dialect=connection.dialect)
+    cursor = connection.connection.dbapi_connection.cursor()
+    try:
+        query = cursor.mogrify(str(compiled), compiled.params).decode('utf-8')
+        cursor.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER true)", out)
+    finally:
+        cursor.close()
+
+
+def next_counter_value(name: str, count: int = 1, connection=None) -> int:
+    """Атомарно увеличивает счётчик `name` на `count` и возвращает новое значение.
+
+    Выделенный блок — (value - count, value]. Строка счётчика остаётся
+    заблокированной до конца транзакции, поэтому транзакции, взявшие номера,
+    фиксируются в порядке номеров.
+    """
+    connection = connection if connection is not None else db.session.connection()
+    table = Counter.__table__
+    value = connection.execute(
+        table.update()
+        .where(table.c.name == name)
+        .values(value=table.c.value + count)
+        .returning(table.c.value)
+    ).scalar()
+    if value is None:
+        connection.execute(table.insert().values(name=name, value=count))
+        value = count
+    return value
+
+
+def ensure_counter(name: str, minimum: int = 0) -> None:
+    """Создаёт счётчик, если его нет, и поднимает значение не ниже `minimum`."""
+    counter = db.session.get(Counter, name)
+    if counter is None:
+        db.session.add(Counter(name=name, value=minimum))
+    elif counter.value < minimum:
+        counter.value = minimum
 
 @login_manager.user_loader
 def load_user(user_id):
-    # Check both databases for the user with safe error handling
+    """Пользователь по id сессии вида "pro:12" / "mama:7".
+
+    Сначала memo текущего запроса, затем кэш снимков (user_cache), и только
+    потом один запрос по первичному ключу. Старые сессии с числовым id
+    проверяются в user_pro, затем в user_mama, как раньше.
+    """
+    memo = g.setdefault('_user_memo', {})
+    if user_id in memo:
+        return memo[user_id]
     try:
+        prefix, _, raw_id = str(user_id).rpartition(':')
+        if prefix:
+            app_types = [prefix] if prefix in USER_MODELS else []
+        else:
+            app_types = ['pro', 'mama']
         user = None
-        # First check UMAY Pro database
-        with app.app_context():
-            user = db.session.query(UserPro).get(int(user_id))
-        # Then check UMAY Mama database
-        if not user:
-            with app.app_context():
-                user = db.session.query(UserMama).get(int(user_id))
+        for app_type in app_types:
+            model = USER_MODELS[app_type]
+            key = f'{app_type}:{int(raw_id)}'
+            snapshot = user_cache.get(key)
+            if snapshot is not None:
+                user = _user_from_snapshot(model, snapshot)
+                break
+            user = db.session.get(model, int(raw_id))
+            if user:
+                user_cache.set(key, _user_snapshot(user))
+                break
+        memo[user_id] = user
         return user
     except Exception as e:
         logger.warning(f"load_user failed: {e}")
@@ -1200,14 +3797,13 @@ def load_user(user_id):
 
 # Маршруты
 @app.route('/')
+@cache_page(60)
 def index():
-    # Безопасный рендер главной: при ошибке БД показываем страницу без новостей
-    try:
-        latest_news = News.query.filter_by(is_published=True).order_by(News.published_at.desc()).limit(6).all()
-    except Exception as e:
-        logger.warning(f"Index news query failed: {e}")
-        latest_news = []
-    return render_template('index.html', news=latest_news)
+    not_modified = content_not_modified(lambda: max_updated_at(News))
+    if not_modified:
+        return not_modified
+    # Лента новостей берётся в шаблоне (latest_news) внутри {% cache %}; при ошибке БД — без новостей
+    return render_template('index.html')
 
 @app.route('/healthz')
 def healthz():
@@ -1233,6 +3829,8 @@ def get_departments(city, institution):
     return jsonify([])
 
 @app.route('/login', methods=['GET', 'POST'])
+@rate_limit('login_ip', 30, 60)
+@rate_limit('login_identity', 10, 300, scope='form:login', failures_only=True)
 def login():
     if request.method == 'POST':
         login = request.form.get('login')
@@ -1243,20 +3841,15 @@ def login():
         user = None
         app_type = None
         
-        if is_medic:
-            # Если переключатель "Медик" включен - ищем в UMAY Pro
-            with app.app_context():
-                user = db.session.query(UserPro).filter_by(login=login).first()
-                if user:
-                    app_type = 'pro'
-        else:
-            # Если переключатель "Медик" выключен - ищем в UMAY Mama
-            with app.app_context():
-                user = db.session.query(UserMama).filter_by(login=login).first()
-                if user:
-                    app_type = 'mama'
+        # Переключатель "Медик" выбирает систему: UMAY Pro или UMAY Mama
+        user = find_user('login', login, app_type='pro' if is_medic else 'mama')
+        if user:
+            app_type = 'pro' if is_medic else 'mama'
         
-        if user and check_password_hash(user.password, password):
+        if user and verify_password(user.password, password):
+            rate_limit_success()
+            if password_needs_rehash(user.password):
+                schedule_password_rehash(user, password)
             # Always skip email verification for Joker and admin users
             require_email_verification = True
             try:
@@ -1296,6 +3889,8 @@ def login():
     return render_template('login.html')
 
 @app.route('/register', methods=['GET', 'POST'])
+@rate_limit('register_ip', 20, 600)
+@rate_limit('register_email', 3, 3600, scope='form:email')
 def register():
     # Lightweight debug
     if request.args.get('debug') == '1':
@@ -1349,58 +3944,56 @@ def register():
             return render_template('register.html')
 
         # Проверяем существование пользователя и выполняем операции с БД безопасно
+        from sqlalchemy.exc import IntegrityError
         try:
-            existing_user = None
-            if app_type == 'mama':
-                with app.app_context():
-                    existing_user = db.session.query(UserMama).filter_by(login=login).first()
-                    if not existing_user:
-                        existing_user = db.session.query(UserMama).filter_by(email=email).first()
-            else:
-                with app.app_context():
-                    existing_user = db.session.query(UserPro).filter_by(login=login).first()
-                    if not existing_user:
-                        existing_user = db.session.query(UserPro).filter_by(email=email).first()
+            # Хэш считается до обращения к базе, чтобы не держать соединение из пула во время хэширования
+            hashed_password = hash_password(password)
+
+            # Новые логин и email не должны совпадать ни с Pro, ни с Mama (старые общие
+            # учётные записи остаются); одновременные регистрации, прошедшие эту
+            # проверку, отсекает уникальный индекс user_identity (IntegrityError ниже)
+            existing_user = UserIdentity.query.filter(db.or_(
+                db.and_(UserIdentity.kind == 'login', UserIdentity.value == login),
+                db.and_(UserIdentity.kind == 'email', UserIdentity.value == email),
+            )).first()
             
             if existing_user:
                 flash('Пользователь с таким логином или email уже существует!', 'error')
                 return render_template('register.html')
             
-            hashed_password = generate_password_hash(password)
-
             # Generate email verification token
             email_token = generate_email_token()
             token_expires = datetime.utcnow() + timedelta(hours=EMAIL_VERIFICATION_TTL_HOURS)
             
             if user_type == 'user' and app_type == 'mama':
                 # UMAY Mama user registration
-                with app.app_context():
-                    new_user = UserMama(
-                        full_name=full_name[:100],
-                        login=login[:50],
-                        password=hashed_password,
-                        user_type='user',
-                        position='Пользователь',
-                        city='Не указан',
-                        medical_institution='Не указано',
-                        department='Не указано',
-                        app_type='mama',
-                        email=email,
-                        is_email_verified=False,
-                        email_verification_token=email_token,
-                        email_verification_expires=token_expires
-                    )
-                    db.session.add(new_user)
+                new_user = UserMama(
+                    full_name=full_name[:100],
+                    login=login[:50],
+                    password=hashed_password,
+                    user_type='user',
+                    position='Пользователь',
+                    city='Не указан',
+                    medical_institution='Не указано',
+                    department='Не указано',
+                    app_type='mama',
+                    email=email,
+                    is_email_verified=False,
+                    email_verification_token=email_token,
+                    email_verification_expires=token_expires
+                )
+                db.session.add(new_user)
                     
-                    # Create email verification record
-                    verification = EmailVerification(
-                        email=email,
-                        token=email_token,
-                        purpose='register',
-                        expires_at=token_expires
-                    )
-                    db.session.add(verification)
-                    db.session.commit()
+                # Create email verification record
+                verification = EmailVerification(
+                    email=email,
+                    token=email_token,
+                    purpose='register',
+                    expires_at=token_expires
+                )
+                db.session.add(verification)
+                queue_verification_email(email, email_token, user_type, app_type)
+                db.session.commit()
                 
             elif user_type in ('midwife', 'manager') and app_type == 'pro':
                 # UMAY Pro registration (midwife or manager)
@@ -1443,51 +4036,48 @@ def register():
                     flash('Название отделения слишком длинное! Максимум 200 символов.', 'error')
                     return render_template('register.html')
                 
-                with app.app_context():
-                    new_user = UserPro(
-                        full_name=full_name[:100],
-                        login=login[:50],
-                        password=hashed_password,
-                        user_type=user_type,
-                        position=position[:100],
-                        city=city[:100],
-                        medical_institution=medical_institution[:200],
-                        department=department[:200],
-                        app_type='pro',
-                        email=email,
-                        is_email_verified=False,
-                        email_verification_token=email_token,
-                        email_verification_expires=token_expires
-                    )
-                    db.session.add(new_user)
+                new_user = UserPro(
+                    full_name=full_name[:100],
+                    login=login[:50],
+                    password=hashed_password,
+                    user_type=user_type,
+                    position=position[:100],
+                    city=city[:100],
+                    medical_institution=medical_institution[:200],
+                    department=department[:200],
+                    app_type='pro',
+                    email=email,
+                    is_email_verified=False,
+                    email_verification_token=email_token,
+                    email_verification_expires=token_expires
+                )
+                db.session.add(new_user)
                     
-                    # Create email verification record
-                    verification = EmailVerification(
-                        email=email,
-                        token=email_token,
-                        purpose='register',
-                        expires_at=token_expires
-                    )
-                    db.session.add(verification)
-                    db.session.commit()
+                # Create email verification record
+                verification = EmailVerification(
+                    email=email,
+                    token=email_token,
+                    purpose='register',
+                    expires_at=token_expires
+                )
+                db.session.add(verification)
+                queue_verification_email(email, email_token, user_type, app_type)
+                db.session.commit()
             else:
                 flash('Неверный тип пользователя или приложения!', 'error')
                 return render_template('register.html')
             
-            # Send verification email
-            ok, message = send_verification_email(email, email_token, user_type, app_type)
-            if not ok:
-                # If email fails, delete user and show error
-                db.session.delete(new_user)
-                db.session.delete(verification)
-                db.session.commit()
-                flash(f'Ошибка отправки email: {message}', 'error')
-                return render_template('register.html')
-            
+            # Письмо уходит фоновым отправителем из outbox
+            email_outbox_job.wake()
             flash('Регистрация успешна! Проверьте ваш email для подтверждения адреса.', 'success')
             return redirect(url_for('login'))
             
+        except IntegrityError:
+            db.session.rollback()
+            flash('Пользователь с таким логином или email уже существует!', 'error')
+            return render_template('register.html')
         except Exception as e:
+            db.session.rollback()
             logger.exception(f"Registration error: {e}")
             flash('Ошибка при регистрации. Попробуйте позже.', 'error')
             return render_template('register.html')
@@ -1504,6 +4094,8 @@ def register():
 
 
 @app.route('/recover', methods=['GET', 'POST'])
+@rate_limit('recover_ip', 10, 600)
+@rate_limit('recover_email', 3, 900, scope='form:email')
 def recover():
     if request.method == 'POST':
         email = request.form.get('email', '').strip().lower()
@@ -1519,9 +4111,7 @@ def recover():
             return render_template('recover.html')
 
         # Find user by email
-        user = db.session.query(UserPro).filter_by(email=email).first()
-        if not user:
-            user = db.session.query(UserMama).filter_by(email=email).first()
+        user = find_user('email', email)
         if not user:
             flash('Пользователь с таким email не найден', 'error')
             return render_template('recover.html')
@@ -1538,13 +4128,9 @@ def recover():
             expires_at=token_expires
         )
         db.session.add(verification)
+        queue_verification_email(email, reset_token, user.user_type, user.app_type, purpose='reset')
         db.session.commit()
-        
-        # Send reset email
-        ok, message = send_verification_email(email, reset_token, user.user_type, user.app_type, purpose='reset')
-        if not ok:
-            flash(f'Ошибка отправки email: {message}', 'error')
-            return render_template('recover.html')
+        email_outbox_job.wake()
         
         flash('Инструкции по восстановлению пароля отправлены на ваш email.', 'success')
         return redirect(url_for('login'))
@@ -1612,33 +4198,156 @@ def mama_dashboard():
     """Дашборд для пользователей UMAY Mama"""
     logger.info(f"Mama Dashboard accessed by user: {current_user.full_name} (login: {current_user.login})")
     try:
-        # Получаем ВСЕ статьи для отладки (убираем фильтр is_published)
-        mama_content = MamaContent.query.order_by(MamaContent.created_at.desc()).limit(6).all()
-        
-        # Отладочная информация
-        logger.info(f"Found {len(mama_content)} articles in mama_content")
-        for article in mama_content:
-            logger.info(f"Article: {article.title}, Published: {article.is_published}, Category: {article.category}")
-        
-        # Статистика контента (убираем фильтр is_published)
-        total_content = MamaContent.query.count()
-        sport_content = MamaContent.query.filter_by(category='sport').count()
-        nutrition_content = MamaContent.query.filter_by(category='nutrition').count()
-        vitamins_content = MamaContent.query.filter_by(category='vitamins').count()
-        
-        logger.info(f"Statistics - Total: {total_content}, Sport: {sport_content}, Nutrition: {nutrition_content}, Vitamins: {vitamins_content}")
-        
+        # Последние статьи (без фильтра is_published)
+        mama_content = MamaContent.query.order_by(MamaContent.created_at.desc()).limit(6).all()
+
+        # Статистика контента — из предрасчитанных счётчиков
+        counters = dashboard_counters()['mama_content']
+        by_category = counters.get('category', {})
+
         return render_template('mama/dashboard.html',
                              mama_content=mama_content,
-                             total_content=total_content,
-                             sport_content=sport_content,
-                             nutrition_content=nutrition_content,
-                             vitamins_content=vitamins_content)
+                             total_content=counters['total'],
+                             sport_content=by_category.get('sport', 0),
+                             nutrition_content=by_category.get('nutrition', 0),
+                             vitamins_content=by_category.get('vitamins', 0))
     except Exception as e:
         logger.error(f"Error in mama dashboard: {e}")
         flash('Ошибка при загрузке панели управления UMAY Mama', 'error')
         return redirect(url_for('index'))
 
+# ======================
+# Patient record validation (add_patient и массовый импорт)
+# ======================
+PATIENT_YES_NO_FIELDS = [
+    'gestosis', 'diabetes', 'hypertension', 'anemia', 'infections',
+    'placenta_pathology', 'polyhydramnios', 'oligohydramnios', 'pls', 'pts',
+    'eclampsia', 'gestational_hypertension', 'placenta_previa', 'shoulder_dystocia',
+    'third_degree_tear', 'cord_prolapse', 'postpartum_hemorrhage', 'placental_abruption'
+]
+# Флаги, которые /analytics и сводка PWA считают осложнениями
+PATIENT_COMPLICATION_FIELDS = [
+    f for f in PATIENT_YES_NO_FIELDS if f not in ('placenta_pathology', 'polyhydramnios', 'oligohydramnios')
+]
+PATIENT_INT_FIELDS = ['age', 'pregnancy_weeks', 'child_weight', 'blood_loss']
+PATIENT_FLOAT_FIELDS = ['weight_before', 'weight_after', 'labor_duration']
+PATIENT_TEXT_FIELDS = ['complications', 'notes', 'other_diseases']
+# Значения чекбокса/ячейки, которые считаются отметкой "Да"
+PATIENT_YES_VALUES = {'да', 'on', 'yes', 'y', 'true', '1', '+', 'д'}
+
+# Подписи колонок (совпадают с /export_csv, чтобы выгрузка импортировалась обратно)
+PATIENT_FIELD_LABELS = {
+    'date': 'Дата',
+    'patient_name': 'ФИО роженицы',
+    'age': 'Возраст',
+    'pregnancy_weeks': 'Срок беременности',
+    'weight_before': 'Вес до родов',
+    'weight_after': 'Вес после родов',
+    'complications': 'Осложнения',
+    'notes': 'Примечания',
+    'midwife': 'Акушерка',
+    'birth_date': 'Дата родов',
+    'birth_time': 'Время родов',
+    'child_gender': 'Пол ребенка',
+    'child_weight': 'Вес ребенка',
+    'delivery_method': 'Способ родоразрешения',
+    'anesthesia': 'Анестезия',
+    'blood_loss': 'Кровопотеря',
+    'labor_duration': 'Продолжительность родов',
+    'other_diseases': 'Сопутствующие заболевания',
+    'gestosis': 'Гестоз',
+    'diabetes': 'Сахарный диабет',
+    'hypertension': 'Гипертония',
+    'anemia': 'Анемия',
+    'infections': 'Инфекции',
+    'placenta_pathology': 'Патология плаценты',
+    'polyhydramnios': 'Многоводие',
+    'oligohydramnios': 'Маловодие',
+    'pls': 'ПЛС',
+    'pts': 'ПТС',
+    'eclampsia': 'Эклампсия',
+    'gestational_hypertension': 'Гестационная гипертензия',
+    'placenta_previa': 'Плотное прикрепление последа',
+    'shoulder_dystocia': 'Дистоция плечиков',
+    'third_degree_tear': 'Разрыв 3 степени',
+    'cord_prolapse': 'Выпадение петель пуповины',
+    'postpartum_hemorrhage': 'ПРК',
+    'placental_abruption': 'ПОНРП',
+}
+
+
+class PatientValidationError(ValueError):
+    """Ошибка валидации записи пациента (сообщение показывается пользователю)"""
+
+
+def _patient_text(value) -> str:
+    if value is None:
+        return ''
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d')
+    if hasattr(value, 'strftime') and hasattr(value, 'hour'):
+        return value.strftime('%H:%M')
+    if hasattr(value, 'strftime'):
+        return value.strftime('%Y-%m-%d')
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value).strip()
+
+
+def _patient_number(field: str, value, cast):
+    label = PATIENT_FIELD_LABELS.get(field, field)
+    if value is None or (isinstance(value, str) and not value.strip()):
+        raise PatientValidationError(f'Поле «{label}» обязательно для заполнения')
+    try:
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            if cast is int and isinstance(value, float) and not value.is_integer():
+                raise ValueError(value)
+            return cast(value)
+        return cast(str(value).strip().replace(',', '.') if cast is float else str(value).strip())
+    except (TypeError, ValueError):
+        raise PatientValidationError(f'Некорректное значение поля «{label}»: {value}')
+
+
+def parse_patient_record(data, midwife: str, record_date: str = None) -> dict:
+    """Проверяет и приводит запись пациента к полям модели Patient.
+
+    `data` — request.form или строка импорта (dict). Правила те же, что в форме
+    add_patient: обязательные ФИО/пол/способ родоразрешения/анестезия, числовые
+    поля приводятся к int/float, чекбоксы — к "Да"/"Нет". Акушерка и дата записи
+    передаются отдельно и из `data` не берутся.
+    """
+    patient_name = _patient_text(data.get('patient_name'))
+    if not patient_name:
+        raise PatientValidationError('ФИО роженицы обязательно для заполнения')
+    if not _patient_text(data.get('child_gender')):
+        raise PatientValidationError('Необходимо выбрать пол ребенка')
+    if not _patient_text(data.get('delivery_method')):
+        raise PatientValidationError('Необходимо выбрать способ родоразрешения')
+    if not _patient_text(data.get('anesthesia')):
+        raise PatientValidationError('Необходимо выбрать тип анестезии')
+
+    fields = {
+        'date': record_date or datetime.now().strftime("%Y-%m-%d %H:%M"),
+        'patient_name': patient_name[:100],
+        'midwife': (midwife or '')[:100],
+        'birth_date': _patient_text(data.get('birth_date'))[:20],
+        'birth_time': _patient_text(data.get('birth_time'))[:10],
+        'child_gender': _patient_text(data.get('child_gender'))[:10],
+        'delivery_method': _patient_text(data.get('delivery_method'))[:50],
+        'anesthesia': _patient_text(data.get('anesthesia'))[:50],
+    }
+    if not fields['midwife']:
+        raise PatientValidationError('Не указана акушерка')
+    for field in PATIENT_INT_FIELDS:
+        fields[field] = _patient_number(field, data.get(field), int)
+    for field in PATIENT_FLOAT_FIELDS:
+        fields[field] = _patient_number(field, data.get(field), float)
+    for field in PATIENT_TEXT_FIELDS:
+        fields[field] = _patient_text(data.get(field))
+    for field in PATIENT_YES_NO_FIELDS:
+        fields[field] = "Да" if _patient_text(data.get(field)).lower() in PATIENT_YES_VALUES else "Нет"
+    return fields
+
 @app.route('/add_patient', methods=['GET', 'POST'])
 @app.route('/добавить_пациента', methods=['GET', 'POST'])  # alias for Russian URL to avoid 404/blank
 @login_required
@@ -1659,81 +4368,13 @@ def add_patient():
     
     if request.method == 'POST':
         try:
-            # Обработка чекбоксов - если не отмечен, то "Нет"
-            gestosis = "Да" if 'gestosis' in request.form else "Нет"
-            diabetes = "Да" if 'diabetes' in request.form else "Нет"
-            hypertension = "Да" if 'hypertension' in request.form else "Нет"
-            anemia = "Да" if 'anemia' in request.form else "Нет"
-            infections = "Да" if 'infections' in request.form else "Нет"
-            placenta_pathology = "Да" if 'placenta_pathology' in request.form else "Нет"
-            polyhydramnios = "Да" if 'polyhydramnios' in request.form else "Нет"
-            oligohydramnios = "Да" if 'oligohydramnios' in request.form else "Нет"
-            pls = "Да" if 'pls' in request.form else "Нет"
-            pts = "Да" if 'pts' in request.form else "Нет"
-            eclampsia = "Да" if 'eclampsia' in request.form else "Нет"
-            gestational_hypertension = "Да" if 'gestational_hypertension' in request.form else "Нет"
-            placenta_previa = "Да" if 'placenta_previa' in request.form else "Нет"
-            shoulder_dystocia = "Да" if 'shoulder_dystocia' in request.form else "Нет"
-            third_degree_tear = "Да" if 'third_degree_tear' in request.form else "Нет"
-            cord_prolapse = "Да" if 'cord_prolapse' in request.form else "Нет"
-            postpartum_hemorrhage = "Да" if 'postpartum_hemorrhage' in request.form else "Нет"
-            placental_abruption = "Да" if 'placental_abruption' in request.form else "Нет"
-            
-            # Валидация обязательных полей
-            if not request.form['patient_name'] or request.form['patient_name'].strip() == "":
-                flash('ФИО роженицы обязательно для заполнения', 'error')
-                return render_template('mobile/add_patient.html' if mobile_requested else 'add_patient.html')
-            
-            if not request.form['child_gender'] or request.form['child_gender'] == "":
-                flash('Необходимо выбрать пол ребенка', 'error')
-                return render_template('mobile/add_patient.html' if mobile_requested else 'add_patient.html')
-            
-            if not request.form['delivery_method'] or request.form['delivery_method'] == "":
-                flash('Необходимо выбрать способ родоразрешения', 'error')
-                return render_template('mobile/add_patient.html' if mobile_requested else 'add_patient.html')
-            
-            if not request.form['anesthesia'] or request.form['anesthesia'] == "":
-                flash('Необходимо выбрать тип анестезии', 'error')
+            try:
+                fields = parse_patient_record(request.form, current_user.full_name)
+            except PatientValidationError as e:
+                flash(str(e), 'error')
                 return render_template('mobile/add_patient.html' if mobile_requested else 'add_patient.html')
-            
-            new_patient = Patient(
-                date=datetime.now().strftime("%Y-%m-%d %H:%M"),
-                patient_name=request.form['patient_name'].strip(),
-                age=int(request.form['age']),
-                pregnancy_weeks=int(request.form['pregnancy_weeks']),
-                weight_before=float(request.form['weight_before']),
-                weight_after=float(request.form['weight_after']),
-                complications=request.form['complications'] or "",
-                notes=request.form['notes'] or "",
-                midwife=current_user.full_name,
-                birth_date=request.form['birth_date'],
-                birth_time=request.form['birth_time'],
-                child_gender=request.form['child_gender'],
-                child_weight=int(request.form['child_weight']),
-                delivery_method=request.form['delivery_method'],
-                anesthesia=request.form['anesthesia'],
-                blood_loss=int(request.form['blood_loss']),
-                labor_duration=float(request.form['labor_duration']),
-                other_diseases=request.form['other_diseases'] or "",
-                gestosis=gestosis,
-                diabetes=diabetes,
-                hypertension=hypertension,
-                anemia=anemia,
-                infections=infections,
-                placenta_pathology=placenta_pathology,
-                polyhydramnios=polyhydramnios,
-                oligohydramnios=oligohydramnios,
-                pls=pls,
-                pts=pts,
-                eclampsia=eclampsia,
-                gestational_hypertension=gestational_hypertension,
-                placenta_previa=placenta_previa,
-                shoulder_dystocia=shoulder_dystocia,
-                third_degree_tear=third_degree_tear,
-                cord_prolapse=cord_prolapse,
-                postpartum_hemorrhage=postpartum_hemorrhage,
-                placental_abruption=placental_abruption
-            )
+
+            new_patient = Patient(**fields)
             
             db.session.add(new_patient)
             db.session.commit()
@@ -2036,6 +4677,142 @@ def profile():
                            avg_child_weight=round(avg_weight, 1),
                            recent_patients=recent_patients)
 
+# ============================================================================
+# Счётчики для дашбордов (entity_counter)
+# ============================================================================
+
+# Модель -> (имя сущности, поля, в разрезе которых ведутся счётчики)
+COUNTED_ENTITIES = {
+    News: ('news', ('is_published', 'category')),
+    MamaContent: ('mama_content', ('is_published', 'category')),
+    MediaFile: ('media_file', ('file_type',)),
+}
+
+
+def _counter_facet(field: str, value) -> str:
+    if isinstance(value, bool):
+        value = 'true' if value else 'false'
+    return f"{field}:{'' if value is None else value}"
+
+
+def add_entity_counter_delta(deltas: dict, entity: str, fields, get, sign: int) -> None:
+    """Добавляет в deltas вклад одной записи (get(field) -> значение) со знаком sign."""
+    for facet in [''] + [_counter_facet(field, get(field)) for field in fields]:
+        deltas[(entity, facet)] = deltas.get((entity, facet), 0) + sign
+
+
+def apply_entity_counter_deltas(deltas: dict, connection=None) -> None:
+    """Применяет накопленные изменения к entity_counter в текущей транзакции.
+
+    Одним INSERT ... ON CONFLICT DO UPDATE: два сохранения, впервые вводящие
+    один и тот же срез, не падают на первичном ключе. Строки идут в порядке
+    ключа, чтобы параллельные транзакции блокировали их в одном порядке.
+    """
+    rows = [
+        {'entity': entity, 'facet': facet, 'value': delta}
+        for (entity, facet), delta in sorted(deltas.items()) if delta
+    ]
+    if not rows:
+        return
+    connection = connection if connection is not None else db.session.connection()
+    table = EntityCounter.__table__
+    insert = dialect_insert(table).values(rows)
+    connection.execute(insert.on_conflict_do_update(
+        index_elements=['entity', 'facet'],
+        set_={'value': table.c.value + insert.excluded.value},
+    ))
+
+
+@event.listens_for(db.session, 'before_flush')
+def _update_entity_counters(session, flush_context, instances):
+    """Поддерживает entity_counter при изменениях новостей, статей Mama и медиафайлов через ORM.
+
+    Старые значения изменённых и удалённых записей читаются из базы одним
+    запросом на модель; у новых незаданные поля берутся из default колонки.
+    """
+    from sqlalchemy import select
+    deltas = {}
+    for model, (entity, fields) in COUNTED_ENTITIES.items():
+        added = [obj for obj in session.new if isinstance(obj, model)]
+        dirty = [
+            obj for obj in session.dirty
+            if isinstance(obj, model) and obj not in session.new
+            and any(db.inspect(obj).attrs[field].history.has_changes() for field in fields)
+        ]
+        deleted = [obj for obj in session.deleted if isinstance(obj, model)]
+        old_ids = [obj.id for obj in dirty + deleted if obj.id is not None]
+        if old_ids:
+            columns = [getattr(model, field) for field in fields]
+            for row in session.connection().execute(select(*columns).where(model.id.in_(old_ids))).mappings():
+                add_entity_counter_delta(deltas, entity, fields, row.get, -1)
+        for obj in added + dirty:
+            def get(field, obj=obj):
+                value = getattr(obj, field)
+                default = model.__table__.c[field].default
+                if value is None and default is not None and default.is_scalar:
+                    return default.arg
+                return value
+            add_entity_counter_delta(deltas, entity, fields, get, 1)
+    if any(deltas.values()):
+        apply_entity_counter_deltas(deltas, connection=session.connection())
+
+
+def count_entities() -> dict:
+    """{(сущность, срез): число}, посчитанные напрямую по исходным таблицам."""
+    deltas = {}
+    for model, (entity, fields) in COUNTED_ENTITIES.items():
+        deltas[(entity, '')] = db.session.query(db.func.count(model.id)).scalar()
+        for field in fields:
+            column = getattr(model, field)
+            for value, count in db.session.query(column, db.func.count(model.id)).group_by(column):
+                deltas[(entity, _counter_facet(field, value))] = count
+    return deltas
+
+
+def rebuild_entity_counters() -> None:
+    """Полностью пересчитывает entity_counter по исходным таблицам."""
+    deltas = count_entities()
+    db.session.execute(EntityCounter.__table__.delete())
+    bulk_insert_rows(EntityCounter.__table__, [
+        {'entity': entity, 'facet': facet, 'value': value} for (entity, facet), value in deltas.items()
+    ])
+    db.session.commit()
+
+
+def entity_counters_in_sync() -> bool:
+    """Совпадают ли все счётчики, включая срезы по полям, с подсчётом по таблицам (проверка при старте)."""
+    stored = {
+        (entity, facet): value
+        for entity, facet, value in db.session.query(EntityCounter.entity, EntityCounter.facet, EntityCounter.value)
+        if value
+    }
+    actual = {key: value for key, value in count_entities().items() if value}
+    return stored == actual
+
+
+def dashboard_counters() -> dict:
+    """Все счётчики дашбордов одним запросом.
+
+    Возвращает {сущность: {'total': n, поле: {значение: n}}}; нулевые срезы
+    пропускаются. Пациенты берутся из сводки patient_rollup.
+    """
+    from sqlalchemy import literal, select, union_all
+    query = union_all(
+        select(EntityCounter.entity, EntityCounter.facet, EntityCounter.value),
+        select(literal('patient'), literal(''), db.func.coalesce(db.func.sum(PatientRollup.patients), 0))
+        .where(PatientRollup.kind == 'birth'),
+    )
+    counters = {entity: {'total': 0} for entity, _ in COUNTED_ENTITIES.values()}
+    counters['patient'] = {'total': 0}
+    for entity, facet, value in db.session.execute(query):
+        entry = counters.setdefault(entity, {'total': 0})
+        if not facet:
+            entry['total'] = int(value)
+        elif value:
+            field, _, key = facet.partition(':')
+            entry.setdefault(field, {})[key] = int(value)
+    return counters
+
 # ============================================================================
 # CMS АДМИН-ПАНЕЛЬ МАРШРУТЫ
 # ============================================================================
@@ -2045,25 +4822,38 @@ def profile():
 @admin_required
 def admin_panel():
     """Главная страница админ-панели"""
-    # Статистика
-    news_count = News.query.count()
-    mama_content_count = MamaContent.query.count()
-    media_count = MediaFile.query.count()
-    patients_count = Patient.query.count()
+    # Статистика — из предрасчитанных счётчиков одним запросом
+    counters = dashboard_counters()
     
     return render_template('admin/dashboard.html', 
-                         news_count=news_count,
-                         mama_content_count=mama_content_count,
-                         media_count=media_count,
-                         patients_count=patients_count)
+                         news_count=counters['news']['total'],
+                         mama_content_count=counters['mama_content']['total'],
+                         media_count=counters['media_file']['total'],
+                         patients_count=counters['patient']['total'])
+
+@app.route('/admin/metrics')
+@login_required
+@admin_required
+def admin_metrics():
+    """Размеры растущих таблиц и последние результаты фоновых задач (JSON)"""
+    jobs = {
+        name: {
+            'last_run_at': job.last_run_at.isoformat() if job.last_run_at else None,
+            'last_result': job.last_result if isinstance(job.last_result, dict) else None,
+        }
+        for name, job in background_jobs.items()
+    }
+    return jsonify({'tables': table_size_metrics(), 'jobs': jobs, 'rate_limits': rate_limiter.stats(),
+                    'page_cache': page_cache.stats(), 'fragment_cache': fragment_cache.stats()})
 
 @app.route('/admin/news')
 @login_required
 @admin_required
 def admin_news():
     """Управление новостями"""
-    news = News.query.order_by(News.created_at.desc()).all()
-    return render_template('admin/news.html', news=news)
+    page = keyset_paginate(News.query, News, 'created_at')
+    return render_template('admin/news.html', news=page.items, page=page,
+                           news_count=dashboard_counters()['news']['total'])
 
 @app.route('/admin/news/add', methods=['GET', 'POST'])
 @login_required
@@ -2143,29 +4933,18 @@ def admin_mama_content():
         flash('Доступ запрещен', 'error')
         return redirect(url_for('dashboard'))
     
-    # Получаем статистику
-    total_content = MamaContent.query.count()
-    published_content = MamaContent.query.filter_by(is_published=True).count()
-    pending_content = MamaContent.query.filter_by(is_published=False).count()
-    
-    # Популярные категории
-    categories_stats = db.session.query(
-        MamaContent.category,
-        db.func.count(MamaContent.id).label('count')
-    ).group_by(MamaContent.category).all()
+    # Получаем статистику (предрасчитанные счётчики)
+    counters = dashboard_counters()['mama_content']
     
     # Последние статьи
     recent_content = MamaContent.query.order_by(MamaContent.created_at.desc()).limit(5).all()
     
-    # Преобразуем статистику категорий в словарь
-    categories_dict = {stat.category: stat.count for stat in categories_stats}
-    
     # Создаем объект статистики
     stats = {
-        'total': total_content,
-        'published': published_content,
-        'pending': pending_content,
-        'categories': categories_dict
+        'total': counters['total'],
+        'published': counters.get('is_published', {}).get('true', 0),
+        'pending': counters.get('is_published', {}).get('false', 0),
+        'categories': counters.get('category', {})
     }
     
     return render_template('admin/mama_content_dashboard.html',
@@ -2181,8 +4960,7 @@ def admin_mama_content_list():
         flash('Доступ запрещен', 'error')
         return redirect(url_for('dashboard'))
     
-    # Получаем все статьи
-    all_content = MamaContent.query.order_by(MamaContent.created_at.desc()).all()
+    page = keyset_paginate(MamaContent.query, MamaContent, 'created_at')
     
     # Категории для отображения
     categories = {
@@ -2195,7 +4973,8 @@ def admin_mama_content_list():
     }
     
     return render_template('admin/mama_content_list.html',
-                         content_list=all_content,
+                         content_list=page.items,
+                         page=page,
                          categories=categories)
 
 @app.route('/admin/mama-content/add', methods=['GET', 'POST'])
@@ -2310,16 +5089,14 @@ def admin_mama_content_moderate():
     # Получаем статьи для модерации (неопубликованные)
     pending_content = MamaContent.query.filter_by(is_published=False).order_by(MamaContent.created_at.desc()).all()
     
-    # Дополнительная статистика для шаблона
-    total_content = MamaContent.query.count()
-    published_content = MamaContent.query.filter_by(is_published=True).count()
-    categories_count = db.session.query(MamaContent.category).distinct().count()
+    # Дополнительная статистика для шаблона (предрасчитанные счётчики)
+    counters = dashboard_counters()['mama_content']
     
     return render_template('admin/mama_content_moderate.html', 
                          pending_content=pending_content,
-                         total_content=total_content,
-                         published_content=published_content,
-                         categories_count=categories_count)
+                         total_content=counters['total'],
+                         published_content=counters.get('is_published', {}).get('true', 0),
+                         categories_count=len(counters.get('category', {})))
 
 @app.route('/admin/mama-content/approve/<int:content_id>', methods=['POST'])
 @login_required
@@ -2364,13 +5141,29 @@ def admin_mama_content_generate():
     if request.method == 'POST':
         category = request.form.get('category')
         trimester = request.form.get('trimester')
-        count = int(request.form.get('count', 1))
-        
-        # Генерируем контент с помощью ИИ
-        generated_content = generate_ai_content(category, trimester, count)
+        try:
+            count = min(max(int(request.form.get('count', 1)), 1), CONTENT_GENERATION_MAX_COUNT)
+        except ValueError:
+            count = 1
+        total = ai_content_total(category, count)
+        if not total:
+            flash('Для выбранной категории нет шаблонов', 'error')
+            return redirect(url_for('admin_mama_content_generate'))
+        
+        # Генерация идёт в фоне; страница показывает прогресс задачи
+        task = ContentGenerationTask(category=category, trimester=trimester, requested=count, total=total,
+                                     created_by=current_user.login)
+        db.session.add(task)
+        db.session.commit()
+        content_generation_job.wake()
         
-        flash(f'Сгенерировано {len(generated_content)} статей!', 'success')
-        return redirect(url_for('admin_mama_content'))
+        flash(f'Генерация {total} статей запущена', 'success')
+        return redirect(url_for('admin_mama_content_generate', task=task.id))
+    
+    task = None
+    task_id = request.args.get('task', type=int)
+    if task_id:
+        task = db.session.get(ContentGenerationTask, task_id)
     
     categories = {
         'sport': 'Спорт',
@@ -2381,7 +5174,18 @@ def admin_mama_content_generate():
         'doctor_advice': 'Советы врачей'
     }
     
-    return render_template('admin/mama_content_generate.html', categories=categories)
+    return render_template('admin/mama_content_generate.html', categories=categories,
+                           task=content_generation_progress(task) if task else None)
+
+@app.route('/admin/mama-content/generate/<int:task_id>/status')
+@login_required
+@admin_required
+def admin_mama_content_generate_status(task_id):
+    """Прогресс фоновой генерации (JSON для страницы генерации)"""
+    task = db.session.get(ContentGenerationTask, task_id)
+    if task is None:
+        return jsonify({'error': 'Задача не найдена'}), 404
+    return jsonify(content_generation_progress(task))
 
 @app.route('/admin/mama-content/analytics')
 @login_required
@@ -2465,11 +5269,19 @@ def get_latest_news(category):
         logger.error(f"Ошибка при получении актуальных новостей: {e}")
         return []
 
-def generate_ai_content(category, trimester, count):
-    """ПРОФЕССИОНАЛЬНЫЙ ИИ-генератор контента с картинками и журналистским стилем"""
-    
-    # Богатые шаблоны для генерации профессиональных статей
-    templates = {
+# ИИ-генерация: фоновая задача вставляет статьи пакетами и сохраняет прогресс после каждого
+CONTENT_GENERATION_INTERVAL = float(os.getenv('CONTENT_GENERATION_INTERVAL', '30'))
+CONTENT_GENERATION_BATCH_SIZE = int(os.getenv('CONTENT_GENERATION_BATCH_SIZE', '5'))
+CONTENT_GENERATION_MAX_COUNT = 50
+# Задача 'running' без отметки о прогрессе дольше стольких секунд считается брошенной
+# (воркер убит или перезапущен) и возвращается в очередь. Должно быть заметно больше
+# времени на один пакет, иначе живую задачу подхватит второй воркер.
+CONTENT_GENERATION_STALE_SEC = int(os.getenv('CONTENT_GENERATION_STALE_SEC', '600'))
+
+
+def _ai_content_template_source() -> dict:
+    """Богатые шаблоны для генерации профессиональных статей (разбираются один раз, см. ai_content_library)"""
+    return {
         'sport': {
             'titles': [
                 '🏃‍♀️ Полное руководство по упражнениям для беременных в {trimester} триместре',
@@ -3233,31 +6045,63 @@ def generate_ai_content(category, trimester, count):
             ]
         }
     }
-    
-    # Генерируем контент
-    generated_content = []
-    
-    if category in templates:
-        template = templates[category]
-        titles = template['titles']
-        images = template['images']
-        contents = template.get('content', [])
-        
-        # Получаем актуальные новости
-        latest_news = get_latest_news(category)
-        
-        for i in range(min(count, len(titles))):
-            title = titles[i].format(trimester=trimester)
-            image_url = images[i % len(images)]
-            
-            # Если есть готовый контент, используем его
-            if i < len(contents):
-                content = contents[i].format(trimester=trimester)
-            else:
-                # Генерируем контент на основе актуальных новостей
-                if latest_news:
-                    news_item = latest_news[i % len(latest_news)]
-                    content = f'''# {title}
+
+
+class CompiledTemplate:
+    """Шаблон str.format, разобранный один раз на литералы и имена полей."""
+    __slots__ = ('parts',)
+
+    def __init__(self, source: str):
+        from string import Formatter
+        parts = []
+        for literal, field, spec, conversion in Formatter().parse(source):
+            if field is not None and (not field.isidentifier() or spec or conversion):
+                raise ValueError(f"Unsupported template field: {{{field}}}")
+            parts.append((literal, field))
+        self.parts = tuple(parts)
+
+    def render(self, **values) -> str:
+        return ''.join(literal if field is None else literal + str(values[field]) for literal, field in self.parts)
+
+
+@lru_cache(maxsize=1)
+def ai_content_library() -> dict:
+    """Шаблоны генератора, скомпилированные при первом обращении: {категория: {'titles', 'images', 'content'}}."""
+    return {
+        category: {
+            'titles': [CompiledTemplate(title) for title in source['titles']],
+            'images': list(source['images']),
+            'content': [CompiledTemplate(text) for text in source.get('content', [])],
+        }
+        for category, source in _ai_content_template_source().items()
+    }
+
+
+def ai_content_total(category, count: int) -> int:
+    """Сколько статей будет создано: не больше, чем заголовков в шаблонах категории."""
+    template = ai_content_library().get(category)
+    return min(count, len(template['titles'])) if template else 0
+
+
+def build_ai_article(category, trimester, index: int, latest_news=None) -> MamaContent:
+    """Статья номер index из шаблонов категории.
+
+    latest_news() вызывается, только если для статьи нет готового текста.
+    """
+    template = ai_content_library()[category]
+    title = template['titles'][index].render(trimester=trimester)
+    image_url = template['images'][index % len(template['images'])]
+    contents = template['content']
+
+    # Если есть готовый контент, используем его
+    if index < len(contents):
+        content = contents[index].render(trimester=trimester)
+    else:
+        news = latest_news() if latest_news else []
+        # Генерируем контент на основе актуальных новостей
+        if news:
+            news_item = news[index % len(news)]
+            content = f'''# {title}
 
 ![Актуальные новости]({image_url})
 
@@ -3292,9 +6136,9 @@ def generate_ai_content(category, trimester, count):
 ---
 
 *Статья подготовлена экспертами UMAY Mama на основе актуальных исследований.*'''
-                else:
-                    # Генерируем базовый контент
-                    content = f'''# {title}
+        else:
+            # Генерируем базовый контент
+            content = f'''# {title}
 
 ![Информация для беременных]({image_url})
 
@@ -3320,26 +6164,127 @@ def generate_ai_content(category, trimester, count):
 ---
 
 *Статья подготовлена экспертами UMAY Mama.*'''
-            
-            # Создаем новый контент
-            new_content = MamaContent(
-                title=title,
-                content=content,
-                category=category,
-                image_url=image_url,
-                trimester=trimester,
-                difficulty_level='medium',
-                duration='15-30 минут',
-                author='UMAY Mama',
-                is_published=True
-            )
-            
-            db.session.add(new_content)
-            generated_content.append(new_content)
-    
-    db.session.commit()
+
+    return MamaContent(
+        title=title,
+        content=content,
+        category=category,
+        image_url=image_url,
+        trimester=trimester,
+        difficulty_level='medium',
+        duration='15-30 минут',
+        author='UMAY Mama',
+        is_published=True
+    )
+
+
+def generate_ai_content(category, trimester, count, start: int = 0, batch_size: int = None, progress=None):
+    """ПРОФЕССИОНАЛЬНЫЙ ИИ-генератор контента с картинками и журналистским стилем
+
+    Статьи start..count-1 вставляются пакетами по batch_size с коммитом после
+    каждого. progress(создано) вызывается до коммита пакета, чтобы прогресс
+    задачи фиксировался вместе со статьями.
+    """
+    batch_size = batch_size or CONTENT_GENERATION_BATCH_SIZE
+    total = ai_content_total(category, count)
+    fetched_news = []
+
+    def latest_news():
+        # Актуальные новости запрашиваются из сети не больше одного раза и только при необходимости
+        if not fetched_news:
+            fetched_news.append(get_latest_news(category))
+        return fetched_news[0]
+
+    generated_content = []
+    for batch_start in range(start, total, batch_size):
+        batch = [
+            build_ai_article(category, trimester, index, latest_news)
+            for index in range(batch_start, min(batch_start + batch_size, total))
+        ]
+        db.session.add_all(batch)
+        generated_content.extend(batch)
+        if progress:
+            progress(batch_start + len(batch))
+        db.session.commit()
     return generated_content
 
+
+def content_generation_progress(task) -> dict:
+    """Состояние задачи генерации для страницы прогресса (JSON)."""
+    generated = task.generated or 0
+    return {
+        'id': task.id,
+        'category': task.category,
+        'trimester': task.trimester,
+        'requested': task.requested,
+        'total': task.total,
+        'generated': generated,
+        'percent': round(100 * generated / task.total) if task.total else 100,
+        'status': task.status,
+        'error': task.error,
+    }
+
+
+def requeue_stale_generation_tasks() -> int:
+    """Возвращает в очередь задачи 'running', чей heartbeat старше CONTENT_GENERATION_STALE_SEC.
+
+    Задачи живых воркеров не трогаются: их heartbeat обновляется после каждого пакета.
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=CONTENT_GENERATION_STALE_SEC)
+    requeued = ContentGenerationTask.query.filter(
+        ContentGenerationTask.status == 'running',
+        db.or_(ContentGenerationTask.heartbeat_at < cutoff, ContentGenerationTask.heartbeat_at.is_(None)),
+    ).update({'status': 'pending'}, synchronize_session=False)
+    db.session.commit()
+    if requeued:
+        logger.info(f"🤖 Content generation tasks requeued: {requeued}")
+    return requeued
+
+
+def process_content_generation_tasks() -> dict:
+    """Выполняет ожидающие задачи генерации по очереди, сохраняя прогресс после каждого пакета.
+
+    Брошенные задачи (см. requeue_stale_generation_tasks) продолжаются с сохранённого места.
+    """
+    requeue_stale_generation_tasks()
+    stats = {'tasks': 0, 'generated': 0, 'failed': 0}
+    while True:
+        query = ContentGenerationTask.query.filter_by(status='pending').order_by(ContentGenerationTask.id)
+        if is_postgresql():
+            query = query.with_for_update(skip_locked=True)
+        task = query.first()
+        if task is None:
+            break
+        task.status = 'running'
+        task.started_at = task.heartbeat_at = datetime.utcnow()
+        db.session.commit()
+        stats['tasks'] += 1
+
+        def progress(done, task=task):
+            task.generated = done
+            task.heartbeat_at = datetime.utcnow()
+
+        try:
+            created = generate_ai_content(task.category, task.trimester, task.total,
+                                          start=task.generated, progress=progress)
+            stats['generated'] += len(created)
+            task.status = 'done'
+        except Exception as e:
+            db.session.rollback()
+            task.status = 'failed'
+            task.error = f"{e.__class__.__name__}: {e}"[:500]
+            stats['failed'] += 1
+            logger.error(f"Content generation task {task.id} failed: {task.error}")
+        task.finished_at = datetime.utcnow()
+        db.session.commit()
+    if stats['tasks']:
+        logger.info(f"🤖 Content generation: {stats}")
+    return stats
+
+
+content_generation_job = register_background_job(
+    'content_generation', process_content_generation_tasks, CONTENT_GENERATION_INTERVAL)
+
 @app.route('/admin/media')
 @login_required
 @admin_required
@@ -3349,8 +6294,8 @@ def admin_media():
         flash('Доступ запрещен.', 'error')
         return redirect(url_for('dashboard'))
     
-    media = MediaFile.query.order_by(MediaFile.uploaded_at.desc()).all()
-    return render_template('admin/media.html', media=media)
+    page = keyset_paginate(MediaFile.query, MediaFile, 'uploaded_at')
+    return render_template('admin/media.html', media=page.items, page=page)
 
 @app.route('/admin/media/upload', methods=['POST'])
 @login_required
@@ -3409,23 +6354,54 @@ def admin_media_upload():
 # ============================================================================
 
 @app.route('/news')
+@cache_page(60)
 def news_list():
     """Список новостей"""
-    news = News.query.filter_by(is_published=True).order_by(News.published_at.desc()).all()
-    return render_template('news/list.html', news=news)
+    not_modified = content_not_modified(lambda: max_updated_at(News))
+    if not_modified:
+        return not_modified
+    page = keyset_paginate(News.query.filter_by(is_published=True), News, 'published_at')
+    return render_template('news/list.html', news=page.items, page=page)
 
 @app.route('/news/<int:news_id>')
 def news_detail(news_id):
     """Детальная страница новости"""
     news = News.query.get_or_404(news_id)
     if news.is_published:
-        news.views += 1
-        db.session.commit()
+        record_view(news)
+    not_modified = content_not_modified(max(filter(None, (news.updated_at, news.published_at)), default=None))
+    if not_modified:
+        return not_modified
     return render_template('news/detail.html', news=news)
 
+@app.route('/api/search')
+@rate_limit('search_ip', 60, 60, methods=('GET',))
+def api_search():
+    """Поиск по статьям UMAY Mama, новостям и методичкам (методички — только для Pro)"""
+    query = request.args.get('q', '').strip()
+    if len(query) < 2:
+        return jsonify({'error': 'Введите запрос (минимум 2 символа)'}), 400
+    doc_types = ['mama', 'news']
+    if current_user.is_authenticated and getattr(current_user, 'app_type', 'pro') == 'pro':
+        doc_types.append('guideline')
+    requested = [t.strip() for t in request.args.get('type', '').split(',') if t.strip()]
+    if requested:
+        doc_types = [t for t in doc_types if t in requested]
+        if not doc_types:
+            return jsonify({'query': query, 'results': []})
+    tags = parse_tags(request.args.get('tags'))
+    limit = min(request.args.get('limit', SEARCH_RESULT_LIMIT, type=int) or SEARCH_RESULT_LIMIT, 50)
+    results = search_content(query, doc_types, category=request.args.get('category') or None,
+                             trimester=request.args.get('trimester') or None, tags=tags, limit=limit)
+    return jsonify({'query': query, 'results': results})
+
 @app.route('/mama')
+@cache_page(120)
 def mama_knowledge():
     """Единая страница UMAY Mama — База знаний"""
+    not_modified = content_not_modified(lambda: max_updated_at(MamaContent, News))
+    if not_modified:
+        return not_modified
     categories = {
         'sport': 'Спорт',
         'nutrition': 'Питание', 
@@ -3435,20 +6411,15 @@ def mama_knowledge():
         'doctor_advice': 'Советы врачей'
     }
 
-    # Последние материалы и новости для превью на хабе
-    recent_content = MamaContent.query.order_by(MamaContent.created_at.desc()).limit(6).all()
-    news_preview = News.query.filter_by(is_published=True).order_by(News.published_at.desc()).limit(10).all()
-
-    return render_template(
-        'mama/knowledge.html',
-        categories=categories,
-        recent_content=recent_content,
-        news_preview=news_preview
-    )
+    # Последние материалы и новости загружаются в шаблоне внутри {% cache %}
+    return render_template('mama/knowledge.html', categories=categories)
 
 @app.route('/mama/content')
 def mama_content():
     """Список контента UMAY Mama по категориям"""
+    not_modified = content_not_modified(lambda: max_updated_at(MamaContent))
+    if not_modified:
+        return not_modified
     categories = {
         'sport': 'Спорт',
         'nutrition': 'Питание', 
@@ -3459,21 +6430,25 @@ def mama_content():
     }
     
     selected_category = request.args.get('category', 'sport')
-    content = MamaContent.query.filter_by(
-        category=selected_category
-    ).order_by(MamaContent.created_at.desc()).all()
+    query = MamaContent.query.filter_by(category=selected_category)
+    page = keyset_paginate(query, MamaContent, 'created_at')
+    by_category = dashboard_counters()['mama_content'].get('category', {})
     
     return render_template('mama/content.html', 
-                         content=content, 
+                         content=page.items, 
+                         page=page,
+                         content_count=by_category.get(selected_category, 0),
                          categories=categories,
                          selected_category=selected_category)
 
 @app.route('/mama/calendar')
+@cache_page(3600, content=False)
 def mama_calendar():
     """Простой календарь беременности (страница-заглушка)"""
     return render_template('mama/calendar.html')
 
 @app.route('/mama/calendar/<int:week>')
+@cache_page(3600, content=False)
 def mama_calendar_week(week: int):
     """Страница недели беременности из JSON"""
     try:
@@ -3526,9 +6501,11 @@ def mama_article_detail(content_id):
     """Детальный просмотр статьи UMAY Mama"""
     article = MamaContent.query.get_or_404(content_id)
     
-    # Увеличиваем счетчик просмотров
-    article.views = (article.views or 0) + 1
-    db.session.commit()
+    # Просмотр копится в буфере и записывается фоновой задачей
+    record_view(article)
+    not_modified = content_not_modified(article.updated_at)
+    if not_modified:
+        return not_modified
     
     # Получаем категории для навигации
     categories = {
@@ -3540,12 +6517,15 @@ def mama_article_detail(content_id):
         'doctor_advice': 'Советы врачей'
     }
     
-    # Получаем похожие статьи
-    similar_articles = MamaContent.query.filter_by(
-        category=article.category
-    ).filter(
-        MamaContent.id != article.id
-    ).order_by(MamaContent.created_at.desc()).limit(3).all()
+    # Похожие статьи предрасчитаны (similar_article); пока статья не проиндексирована —
+    # новые из той же категории, как раньше
+    similar_articles = similar_articles_for(article)
+    if not similar_articles:
+        similar_articles = MamaContent.query.filter_by(
+            category=article.category
+        ).filter(
+            MamaContent.id != article.id
+        ).order_by(MamaContent.created_at.desc()).limit(SIMILAR_ARTICLES_SHOWN).all()
     
     return render_template('mama/article_detail.html',
                          article=article,
@@ -3561,74 +6541,55 @@ def export_csv():
     end_date = request.args.get('end_date')
     user_only = request.args.get('user_only', 'false').lower() == 'true'
     
-    # Базовый запрос
-    query = Patient.query
+    # Выгрузка одним запросом: данные акушерки подтягиваются подзапросом, а не запросом на каждую строку
+    from sqlalchemy import select
+
+    def midwife_column(column, label):
+        subquery = (
+            select(column)
+            .where(UserPro.full_name == Patient.midwife)
+            .order_by(UserPro.id)
+            .limit(1)
+            .scalar_subquery()
+        )
+        return db.func.coalesce(subquery, 'Не указано').label(label)
+
+    def patient_column(field):
+        return getattr(Patient, field).label(PATIENT_FIELD_LABELS[field])
+
+    columns = [patient_column(f) for f in (
+        'date', 'patient_name', 'age', 'pregnancy_weeks', 'weight_before', 'weight_after',
+        'complications', 'notes', 'midwife'
+    )]
+    columns += [
+        midwife_column(UserPro.position, 'Должность акушерки'),
+        midwife_column(UserPro.medical_institution, 'Учреждение акушерки'),
+        midwife_column(UserPro.department, 'Отделение акушерки'),
+    ]
+    columns += [patient_column(f) for f in (
+        'birth_date', 'birth_time', 'child_gender', 'child_weight', 'delivery_method', 'anesthesia',
+        'blood_loss', 'labor_duration', 'other_diseases', 'gestosis', 'diabetes', 'hypertension',
+        'anemia', 'infections', 'placenta_pathology', 'polyhydramnios', 'oligohydramnios'
+    )]
+    statement = select(*columns).order_by(Patient.id)
     
     # Применяем фильтры по датам
     if start_date:
-        query = query.filter(Patient.birth_date >= start_date)
+        statement = statement.where(Patient.birth_date >= start_date)
     if end_date:
-        query = query.filter(Patient.birth_date <= end_date)
+        statement = statement.where(Patient.birth_date <= end_date)
     
     # Если запрошен экспорт только для текущего пользователя
     if user_only:
-        query = query.filter(Patient.midwife == current_user.full_name)
+        statement = statement.where(Patient.midwife == current_user.full_name)
     
-    # Получаем отфильтрованных пациентов
-    patients = query.all()
+    output = io.StringIO()
+    bulk_export_csv(statement, output)
     
-    if not patients:
+    if output.getvalue().count('\n') <= 1:
         flash('Нет данных для экспорта в указанном периоде', 'error')
         return redirect(url_for('dashboard'))
     
-    # Создаем данные для экспорта
-    data = []
-    for patient in patients:
-        # Находим информацию об акушерке
-        midwife_info = None
-        with app.app_context():
-            midwife_info = db.session.query(UserPro).filter_by(full_name=patient.midwife).first()
-        midwife_position = midwife_info.position if midwife_info else "Не указано"
-        midwife_department = getattr(midwife_info, 'department', 'Не указано') if midwife_info else "Не указано"
-        midwife_institution = midwife_info.medical_institution if midwife_info else "Не указано"
-        
-        data.append({
-            'Дата': patient.date,
-            'ФИО роженицы': patient.patient_name,
-            'Возраст': patient.age,
-            'Срок беременности': patient.pregnancy_weeks,
-            'Вес до родов': patient.weight_before,
-            'Вес после родов': patient.weight_after,
-            'Осложнения': patient.complications,
-            'Примечания': patient.notes,
-            'Акушерка': patient.midwife,
-            'Должность акушерки': midwife_position,
-            'Учреждение акушерки': midwife_institution,
-            'Отделение акушерки': midwife_department,
-            'Дата родов': patient.birth_date,
-            'Время родов': patient.birth_time,
-            'Пол ребенка': patient.child_gender,
-            'Вес ребенка': patient.child_weight,
-            'Способ родоразрешения': patient.delivery_method,
-            'Анестезия': patient.anesthesia,
-            'Кровопотеря': patient.blood_loss,
-            'Продолжительность родов': patient.labor_duration,
-            'Сопутствующие заболевания': patient.other_diseases,
-            'Гестоз': patient.gestosis,
-            'Сахарный диабет': patient.diabetes,
-            'Гипертония': patient.hypertension,
-            'Анемия': patient.anemia,
-            'Инфекции': patient.infections,
-            'Патология плаценты': patient.placenta_pathology,
-            'Многоводие': patient.polyhydramnios,
-            'Маловодие': patient.oligohydramnios
-        })
-    
-    df = pd.DataFrame(data)
-    output = io.StringIO()
-    df.to_csv(output, index=False, encoding='utf-8-sig')
-    output.seek(0)
-    
     # Формируем имя файла с периодом
     period_suffix = ""
     if start_date and end_date:
@@ -3645,6 +6606,581 @@ def export_csv():
         download_name=f'umay_patients{period_suffix}_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv'
     )
 
+# ============================================================================
+# Массовый импорт пациентов (CSV / XLSX)
+# ============================================================================
+
+PATIENT_IMPORT_BATCH_SIZE = int(os.getenv('PATIENT_IMPORT_BATCH_SIZE', '2000'))
+PATIENT_IMPORT_MAX_REPORTED_ERRORS = 1000
+
+# Заголовок колонки (подпись из экспорта или имя поля) -> поле Patient
+PATIENT_IMPORT_COLUMNS = {label.lower(): field for field, label in PATIENT_FIELD_LABELS.items()}
+PATIENT_IMPORT_COLUMNS.update({field: field for field in PATIENT_FIELD_LABELS})
+
+
+def _map_import_header(header):
+    return [PATIENT_IMPORT_COLUMNS.get(str(h or '').strip().lower()) for h in header]
+
+
+def iter_patient_import_rows(file_obj, filename: str):
+    """Построчно читает CSV/XLSX и отдаёт (номер строки, dict полей).
+
+    Файл не загружается целиком: XLSX читается через openpyxl в режиме read_only,
+    CSV — потоково через csv.reader.
+    """
+    ext = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+    if ext == 'xlsx':
+        from openpyxl import load_workbook
+        workbook = load_workbook(file_obj, read_only=True, data_only=True)
+        try:
+            rows = workbook.active.iter_rows(values_only=True)
+            header = next(rows, None)
+            if not header:
+                return
+            columns = _map_import_header(header)
+            for row_number, values in enumerate(rows, start=2):
+                if not values or all(v is None or str(v).strip() == '' for v in values):
+                    continue
+                yield row_number, {f: v for f, v in zip(columns, values) if f}
+        finally:
+            workbook.close()
+    elif ext == 'csv':
+        import csv
+        stream = io.TextIOWrapper(file_obj, encoding='utf-8-sig', newline='')
+        first_line = stream.readline()
+        delimiter = ';' if first_line.count(';') > first_line.count(',') else ','
+        columns = _map_import_header(next(csv.reader([first_line], delimiter=delimiter), []))
+        reader = csv.reader(stream, delimiter=delimiter)
+        for row_number, values in enumerate(reader, start=2):
+            if not values or all(not v.strip() for v in values):
+                continue
+            yield row_number, {f: v for f, v in zip(columns, values) if f}
+        stream.detach()
+    else:
+        raise PatientValidationError('Поддерживаются только файлы .csv и .xlsx')
+
+
+def _import_record_date(value) -> str:
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M')
+    return _patient_text(value)[:20]
+
+
+def import_patients(file_obj, filename: str, midwife: str, dry_run: bool = False, batch_size: int = None) -> dict:
+    """Импортирует пациентов из CSV/XLSX пакетами по batch_size строк (см. bulk_insert_rows).
+
+    Строки проверяются parse_patient_record (как в add_patient). Если в файле есть
+    колонка «Акушерка», она используется, иначе — `midwife`. В режиме dry_run
+    ничего не записывается. Возвращает отчёт с ошибками по номерам строк.
+    """
+    batch_size = batch_size or PATIENT_IMPORT_BATCH_SIZE
+    report = {'total': 0, 'imported': 0, 'failed': 0, 'errors': [], 'dry_run': dry_run}
+
+    def add_error(row_number, message):
+        report['failed'] += 1
+        if len(report['errors']) < PATIENT_IMPORT_MAX_REPORTED_ERRORS:
+            report['errors'].append({'row': row_number, 'error': message})
+
+    def flush(batch):
+        if not batch:
+            return
+        try:
+            # COPY/executemany минуют before_flush — версии синхронизации выделяем сами
+            version = next_counter_value(PATIENT_SYNC_COUNTER, len(batch)) - len(batch)
+            deltas = {}
+            for offset, (_, fields) in enumerate(batch, start=1):
+                fields['sync_version'] = version + offset
+                add_patient_rollup_delta(deltas, fields.get, 1)
+            bulk_insert_rows(Patient.__table__, [fields for _, fields in batch])
+            apply_patient_rollup_deltas(deltas)
+            db.session.commit()
+            report['imported'] += len(batch)
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Patient import batch failed: {e}")
+            for row_number, _ in batch:
+                add_error(row_number, f'Ошибка записи в базу: {e.__class__.__name__}')
+
+    batch = []
+    for row_number, row in iter_patient_import_rows(file_obj, filename):
+        report['total'] += 1
+        try:
+            fields = parse_patient_record(
+                row,
+                _patient_text(row.get('midwife')) or midwife,
+                record_date=_import_record_date(row.get('date')) or None
+            )
+            fields['created_at'] = datetime.utcnow()
+        except PatientValidationError as e:
+            add_error(row_number, str(e))
+            continue
+        if dry_run:
+            report['imported'] += 1
+            continue
+        batch.append((row_number, fields))
+        if len(batch) >= batch_size:
+            flush(batch)
+            batch = []
+    if not dry_run:
+        flush(batch)
+
+    logger.info(f"Patient import {filename}: total={report['total']} imported={report['imported']} "
+                f"failed={report['failed']} dry_run={dry_run}")
+    return report
+
+
+@app.route('/admin/patients/import', methods=['GET', 'POST'])
+@login_required
+@admin_required
+def admin_patients_import():
+    """Массовый импорт пациентов из CSV/XLSX"""
+    report = None
+    if request.method == 'POST':
+        upload = request.files.get('file')
+        if not upload or not upload.filename:
+            flash('Файл не выбран', 'error')
+            return render_template('admin/patients_import.html', report=None)
+        dry_run = request.form.get('dry_run') == 'on'
+        try:
+            report = import_patients(upload.stream, upload.filename, current_user.full_name, dry_run=dry_run)
+        except PatientValidationError as e:
+            flash(str(e), 'error')
+            return render_template('admin/patients_import.html', report=None)
+        except Exception as e:
+            db.session.rollback()
+            logger.exception(f"Patient import failed: {e}")
+            flash('Не удалось прочитать файл. Проверьте формат.', 'error')
+            return render_template('admin/patients_import.html', report=None)
+
+        if dry_run:
+            flash(f"Проверка завершена: корректных строк {report['imported']} из {report['total']}", 'success')
+        else:
+            flash(f"Импортировано {report['imported']} из {report['total']} записей", 'success')
+    return render_template('admin/patients_import.html', report=report)
+
+# ============================================================================
+# Offline-синхронизация пациентов (PWA, голосовой мастер)
+# ============================================================================
+
+PATIENT_SYNC_MAX_BATCH = int(os.getenv('PATIENT_SYNC_MAX_BATCH', '200'))
+PATIENT_SYNC_COUNTER = 'patient_sync'
+PATIENT_CHANGES_PAGE_SIZE = int(os.getenv('PATIENT_CHANGES_PAGE_SIZE', '500'))
+# Tombstone хранятся столько секунд. PWA должна запрашивать /api/patients/changes
+# чаще, чем раз в PATIENT_TOMBSTONE_RETENTION_SEC: клиенту, не синхронизировавшемуся
+# дольше, сервер отвечает reset=true, и он перекачивает данные с нуля.
+PATIENT_TOMBSTONE_RETENTION_SEC = int(os.getenv('PATIENT_TOMBSTONE_RETENTION_SEC', str(90 * 24 * 3600)))
+PATIENT_TOMBSTONE_RETENTION_INTERVAL = float(os.getenv('PATIENT_TOMBSTONE_RETENTION_INTERVAL', '3600'))
+# Counter: наибольшая sync_version среди удалённых tombstone — курсор ниже неё мог пропустить удаления
+PATIENT_TOMBSTONE_WATERMARK_COUNTER = 'patient_tombstone_watermark'
+# Колонки, которые PWA получает в delta-выгрузке
+PATIENT_CHANGES_FIELDS = ['id', 'client_uuid', 'sync_version'] + list(PATIENT_FIELD_LABELS)
+# Поля, по которым повторная отправка считается дубликатом (без даты записи и акушерки)
+PATIENT_SYNC_COMPARE_FIELDS = [f for f in PATIENT_FIELD_LABELS if f not in ('date', 'midwife')]
+
+
+def can_write_patients(user) -> bool:
+    """Права как у add_patient: все авторизованные, кроме управленцев (кроме Joker)."""
+    return not (getattr(user, 'user_type', '') == 'manager' and getattr(user, 'login', '') != 'Joker')
+
+
+def sync_patient_records(records, midwife: str, is_superuser: bool = False) -> list:
+    """Сохраняет пакет записей пациентов в одной транзакции.
+
+    Каждая запись несёт client_id — ключ идемпотентности, сгенерированный клиентом.
+    Новый ключ создаёт запись, известный ключ обновляет её, а повторная отправка
+    тех же данных ничего не меняет (status 'duplicate'). Ошибки валидации
+    возвращаются по каждой записи и не отменяют остальные.
+    """
+    keys = {
+        str(r.get('client_id') or '').strip()[:64]
+        for r in records if isinstance(r, dict)
+    }
+    keys.discard('')
+    existing = {}
+    if keys:
+        existing = {p.client_uuid: p for p in Patient.query.filter(Patient.client_uuid.in_(keys)).all()}
+
+    results = []
+    for record in records:
+        if not isinstance(record, dict):
+            results.append({'client_id': None, 'status': 'error', 'error': 'Некорректная запись'})
+            continue
+        key = str(record.get('client_id') or '').strip()[:64]
+        if not key:
+            results.append({'client_id': None, 'status': 'error', 'error': 'Не указан client_id'})
+            continue
+        try:
+            fields = parse_patient_record(record, midwife, record_date=_patient_text(record.get('date'))[:20] or None)
+        except PatientValidationError as e:
+            results.append({'client_id': key, 'status': 'error', 'error': str(e)})
+            continue
+
+        patient = existing.get(key)
+        if patient is None:
+            patient = Patient(client_uuid=key, **fields)
+            db.session.add(patient)
+            existing[key] = patient
+            results.append({'client_id': key, 'status': 'created', 'patient': patient})
+            continue
+        if patient.midwife != midwife and not is_superuser:
+            results.append({'client_id': key, 'status': 'error', 'error': 'Нет прав на изменение этой записи'})
+            continue
+        changed = [f for f in PATIENT_SYNC_COMPARE_FIELDS if getattr(patient, f) != fields[f]]
+        for field in changed:
+            setattr(patient, field, fields[field])
+        results.append({'client_id': key, 'status': 'updated' if changed else 'duplicate', 'patient': patient})
+
+    db.session.commit()
+    for result in results:
+        patient = result.pop('patient', None)
+        if patient is not None:
+            result['id'] = patient.id
+    return results
+
+
+@app.route('/api/patients/sync', methods=['POST'])
+def api_patients_sync():
+    """Пакетная идемпотентная загрузка записей пациентов из PWA/offline-очереди"""
+    if not current_user.is_authenticated:
+        return jsonify({'error': 'Требуется вход в систему'}), 401
+    if not can_write_patients(current_user):
+        return jsonify({'error': 'Доступ запрещен.'}), 403
+
+    payload = request.get_json(silent=True) or {}
+    records = payload.get('records')
+    if not isinstance(records, list):
+        return jsonify({'error': 'Ожидается JSON вида {"records": [...]}'}), 400
+    if len(records) > PATIENT_SYNC_MAX_BATCH:
+        return jsonify({'error': f'Не более {PATIENT_SYNC_MAX_BATCH} записей за запрос'}), 413
+
+    from sqlalchemy.exc import IntegrityError
+    is_superuser = getattr(current_user, 'login', '') == 'Joker'
+    for attempt in range(2):
+        try:
+            results = sync_patient_records(records, current_user.full_name, is_superuser=is_superuser)
+            break
+        except IntegrityError as e:
+            # Параллельная отправка того же client_id: повторяем, ключ уже будет найден
+            db.session.rollback()
+            if attempt:
+                logger.error(f"Patient sync failed: {e}")
+                return jsonify({'error': 'Конфликт при сохранении, повторите отправку'}), 409
+        except Exception as e:
+            db.session.rollback()
+            logger.exception(f"Patient sync failed: {e}")
+            return jsonify({'error': 'Ошибка при сохранении записей'}), 500
+
+    return jsonify({'results': results})
+
+
+def _previous_midwife(session, patient):
+    """Акушерка, за которой пациент числился до текущего изменения, или None, если она не менялась."""
+    history = db.inspect(patient).attrs.midwife.history
+    if not history.has_changes():
+        return None
+    if history.deleted:
+        previous = history.deleted[0]
+    else:
+        # Атрибут не был загружен до присваивания — берём значение из БД
+        previous = session.connection().execute(
+            db.select(Patient.midwife).where(Patient.id == patient.id)
+        ).scalar()
+    return previous if previous and previous != patient.midwife else None
+
+
+@event.listens_for(db.session, 'before_flush')
+def _assign_patient_sync_versions(session, flush_context, instances):
+    """Выдаёт sync_version изменённым пациентам и пишет tombstone для удалённых.
+
+    Пациент, переданный другой акушерке, для прежней тоже считается удалённым:
+    ей пишется tombstone с версией меньше новой версии записи.
+    Массовые вставки через bulk_insert_rows и Query.delete() событий ORM не
+    вызывают — версии для них выделяются явно (см. import_patients).
+    """
+    changed = [
+        obj for obj in list(session.new) + list(session.dirty)
+        if isinstance(obj, Patient) and (obj in session.new or session.is_modified(obj))
+    ]
+    moved = [
+        (patient, previous) for patient in changed if patient not in session.new
+        for previous in [_previous_midwife(session, patient)] if previous
+    ]
+    deleted = [obj for obj in session.deleted if isinstance(obj, Patient)]
+    count = len(moved) + len(changed) + len(deleted)
+    if not count:
+        return
+    version = next_counter_value(PATIENT_SYNC_COUNTER, count, connection=session.connection()) - count
+    for patient, previous in moved:
+        version += 1
+        session.add(PatientTombstone(
+            patient_id=patient.id,
+            client_uuid=patient.client_uuid,
+            midwife=previous,
+            sync_version=version,
+        ))
+    for patient in changed:
+        version += 1
+        patient.sync_version = version
+    for patient in deleted:
+        version += 1
+        session.add(PatientTombstone(
+            patient_id=patient.id,
+            client_uuid=patient.client_uuid,
+            midwife=patient.midwife,
+            sync_version=version,
+        ))
+
+
+def get_patient_changes(midwife, since: int = 0, limit: int = None, resync: bool = False) -> dict:
+    """Изменения пациентов с версией > since в колоночном виде.
+
+    midwife=None — все акушерки (супер-админ). Записи и tombstone идут одной
+    последовательностью по версии; cursor — версия последнего отданного элемента,
+    клиент передаёт его как since в следующем запросе, пока has_more.
+
+    Если since ниже водяного знака удалённых tombstone, клиент мог пропустить
+    удаления: ответ содержит reset=True и выгрузку с нуля, клиент очищает локальную
+    копию и дочитывает остальные страницы с resync=True. Последняя страница
+    поднимает cursor до водяного знака, чтобы следующий обычный запрос не сбросил копию снова.
+    """
+    limit = max(1, min(limit or PATIENT_CHANGES_PAGE_SIZE, PATIENT_CHANGES_PAGE_SIZE))
+    watermark = db.session.query(Counter.value) \
+        .filter(Counter.name == PATIENT_TOMBSTONE_WATERMARK_COUNTER).scalar() or 0
+    reset = 0 < since < watermark and not resync
+    if reset:
+        since = 0
+    columns = [getattr(Patient, field) for field in PATIENT_CHANGES_FIELDS]
+    patients_query = db.session.query(*columns).filter(Patient.sync_version > since)
+    tombstones_query = db.session.query(PatientTombstone.patient_id, PatientTombstone.sync_version) \
+        .filter(PatientTombstone.sync_version > since)
+    if midwife is not None:
+        patients_query = patients_query.filter(Patient.midwife == midwife)
+        tombstones_query = tombstones_query.filter(PatientTombstone.midwife == midwife)
+    else:
+        # Для общей выгрузки передача другой акушерке — не удаление
+        tombstones_query = tombstones_query.filter(
+            ~db.exists().where(Patient.id == PatientTombstone.patient_id)
+        )
+    rows = patients_query.order_by(Patient.sync_version).limit(limit + 1).all()
+    tombstones = tombstones_query.order_by(PatientTombstone.sync_version).limit(limit + 1).all()
+
+    version_index = PATIENT_CHANGES_FIELDS.index('sync_version')
+    items = sorted(
+        [(row[version_index], row) for row in rows] + [(t.sync_version, t.patient_id) for t in tombstones],
+        key=lambda item: item[0]
+    )
+    has_more = len(items) > limit
+    items = items[:limit]
+
+    data = {field: [] for field in PATIENT_CHANGES_FIELDS}
+    deleted = []
+    # Пациент, возвращённый акушерке, идёт на той же странице после своего tombstone
+    returned = {item[0] for _, item in items if not isinstance(item, int)}
+    for _, item in items:
+        if isinstance(item, int):
+            if item not in returned:
+                deleted.append(item)
+            continue
+        for field, value in zip(PATIENT_CHANGES_FIELDS, item):
+            data[field].append(value)
+    cursor = items[-1][0] if items else since
+    if not has_more:
+        # Всё до текущего момента отдано; версии ниже водяного знака уже не появятся
+        cursor = max(cursor, watermark)
+    return {
+        'since': since,
+        'cursor': cursor,
+        'has_more': has_more,
+        'reset': reset,
+        'patients': data,
+        'deleted': deleted,
+    }
+
+
+def purge_patient_tombstones(batch_size: int = None) -> int:
+    """Удаляет tombstone старше PATIENT_TOMBSTONE_RETENTION_SEC, сначала поднимая водяной знак."""
+    batch_size = batch_size or EMAIL_RETENTION_BATCH_SIZE
+    cutoff = datetime.utcnow() - timedelta(seconds=PATIENT_TOMBSTONE_RETENTION_SEC)
+    condition = PatientTombstone.deleted_at < cutoff
+    newest = db.session.query(db.func.max(PatientTombstone.sync_version)).filter(condition).scalar()
+    if newest is None:
+        return 0
+    insert = dialect_insert(Counter).values(name=PATIENT_TOMBSTONE_WATERMARK_COUNTER, value=newest)
+    db.session.execute(insert.on_conflict_do_update(
+        index_elements=['name'],
+        set_={'value': db.case((Counter.value < insert.excluded.value, insert.excluded.value),
+                               else_=Counter.value)},
+    ))
+    db.session.commit()
+    purged = _delete_in_batches(PatientTombstone, condition, batch_size)
+    if purged:
+        logger.info(f"🧹 Patient tombstone retention: {purged}")
+    return purged
+
+
+patient_tombstone_retention_job = register_background_job(
+    'patient_tombstone_retention', purge_patient_tombstones, PATIENT_TOMBSTONE_RETENTION_INTERVAL
+)
+
+
+@app.route('/api/patients/changes')
+def api_patients_changes():
+    """Delta-выгрузка пациентов для локальной копии PWA"""
+    if not current_user.is_authenticated:
+        return jsonify({'error': 'Требуется вход в систему'}), 401
+    if getattr(current_user, 'app_type', 'pro') != 'pro':
+        return jsonify({'error': 'Доступ запрещен.'}), 403
+    since = request.args.get('since', 0, type=int) or 0
+    limit = request.args.get('limit', PATIENT_CHANGES_PAGE_SIZE, type=int)
+    resync = request.args.get('resync', 0, type=int) == 1
+    midwife = None if getattr(current_user, 'login', '') == 'Joker' else current_user.full_name
+    return jsonify(get_patient_changes(midwife, since=max(since, 0), limit=limit, resync=resync))
+
+# ============================================================================
+# Сводка аналитики для PWA (предрасчитанные счётчики)
+# ============================================================================
+
+# Колонки, от которых зависят счётчики patient_rollup
+PATIENT_ROLLUP_FIELDS = ['birth_date', 'created_at'] + PATIENT_COMPLICATION_FIELDS
+_ROLLUP_MONTH_RE = re.compile(r'^\d{4}-\d{2}')
+
+
+def add_patient_rollup_delta(deltas: dict, get, sign: int) -> None:
+    """Добавляет в deltas вклад одной записи (get(field) -> значение) со знаком sign.
+
+    Старые записи без created_at попадают в корзину '' (как и нераспознанная дата
+    родов), а не в текущий месяц — иначе каждый пересчёт завышал бы new_this_month.
+    """
+    birth_date = get('birth_date') or ''
+    birth_month = birth_date[:7] if _ROLLUP_MONTH_RE.match(birth_date) else ''
+    created_at = get('created_at')
+    created_month = created_at.strftime('%Y-%m') if created_at else ''
+    complicated = int(any(get(field) == 'Да' for field in PATIENT_COMPLICATION_FIELDS))
+    for key in (('birth', birth_month), ('created', created_month)):
+        entry = deltas.setdefault(key, [0, 0])
+        entry[0] += sign
+        entry[1] += sign * complicated
+
+
+def apply_patient_rollup_deltas(deltas: dict, connection=None) -> None:
+    """Применяет накопленные изменения к patient_rollup в текущей транзакции."""
+    connection = connection if connection is not None else db.session.connection()
+    table = PatientRollup.__table__
+    for (kind, bucket), (patients, complicated) in deltas.items():
+        if not patients and not complicated:
+            continue
+        updated = connection.execute(
+            table.update()
+            .where(table.c.kind == kind, table.c.bucket == bucket)
+            .values(patients=table.c.patients + patients, complicated=table.c.complicated + complicated)
+        ).rowcount
+        if not updated:
+            connection.execute(table.insert().values(
+                kind=kind, bucket=bucket, patients=patients, complicated=complicated
+            ))
+
+
+@event.listens_for(db.session, 'before_flush')
+def _update_patient_rollups(session, flush_context, instances):
+    """Поддерживает patient_rollup при изменениях пациентов через ORM.
+
+    Старые значения изменённых и удалённых записей читаются из базы одним
+    запросом. Срабатывает после выдачи sync_version, поэтому строка счётчика
+    уже заблокирована и параллельные транзакции не гоняются за вставку
+    новых месяцев.
+    """
+    def changed(patient):
+        state = db.inspect(patient)
+        return any(state.attrs[field].history.has_changes() for field in PATIENT_ROLLUP_FIELDS)
+
+    added = [obj for obj in session.new if isinstance(obj, Patient)]
+    dirty = [obj for obj in session.dirty if isinstance(obj, Patient) and obj not in session.new and changed(obj)]
+    deleted = [obj for obj in session.deleted if isinstance(obj, Patient)]
+    if not (added or dirty or deleted):
+        return
+
+    from sqlalchemy import select
+    connection = session.connection()
+    deltas = {}
+    old_ids = [patient.id for patient in dirty + deleted if patient.id is not None]
+    if old_ids:
+        columns = [getattr(Patient, field) for field in PATIENT_ROLLUP_FIELDS]
+        for row in connection.execute(select(*columns).where(Patient.id.in_(old_ids))).mappings():
+            add_patient_rollup_delta(deltas, row.get, -1)
+    for patient in added:
+        # Значение по умолчанию колонки ставим сразу, чтобы месяц в сводке совпал с записанным
+        if patient.created_at is None:
+            patient.created_at = datetime.utcnow()
+    for patient in added + dirty:
+        add_patient_rollup_delta(deltas, lambda field: getattr(patient, field), 1)
+    apply_patient_rollup_deltas(deltas, connection=connection)
+
+
+def rebuild_patient_rollups() -> None:
+    """Полностью пересчитывает patient_rollup по таблице пациентов."""
+    columns = [getattr(Patient, field) for field in PATIENT_ROLLUP_FIELDS]
+    deltas = {}
+    for row in db.session.execute(db.select(*columns).execution_options(yield_per=2000)).mappings():
+        add_patient_rollup_delta(deltas, row.get, 1)
+    db.session.execute(PatientRollup.__table__.delete())
+    bulk_insert_rows(PatientRollup.__table__, [
+        {'kind': kind, 'bucket': bucket, 'patients': patients, 'complicated': complicated}
+        for (kind, bucket), (patients, complicated) in deltas.items()
+    ])
+    db.session.commit()
+
+
+def _last_months(today, count: int = 12) -> list:
+    """Список 'YYYY-MM' за последние count месяцев, заканчивая текущим."""
+    year, month = today.year, today.month
+    months = []
+    for _ in range(count):
+        months.append(f'{year:04d}-{month:02d}')
+        year, month = (year, month - 1) if month > 1 else (year - 1, 12)
+    return months[::-1]
+
+
+def get_analytics_summary(today=None) -> dict:
+    """KPI для /pwa/analytics: всего, новые за месяц, доля осложнений, 12 месяцев родов."""
+    today = today or datetime.utcnow()
+    months = _last_months(today)
+    birth = {row.bucket: row for row in PatientRollup.query.filter_by(kind='birth').all()}
+    created = db.session.get(PatientRollup, ('created', months[-1]))
+    total = sum(row.patients for row in birth.values())
+    complicated = sum(row.complicated for row in birth.values())
+    return {
+        'total_patients': total,
+        'new_this_month': created.patients if created else 0,
+        'complications_rate': round(complicated / total * 100, 1) if total else 0,
+        'sparkline': {
+            'months': months,
+            'counts': [birth[m].patients if m in birth else 0 for m in months],
+        },
+    }
+
+
+def analytics_summary_etag(today=None) -> str:
+    """ETag сводки: версия синхронизации пациентов + текущий месяц."""
+    counter = db.session.get(Counter, PATIENT_SYNC_COUNTER)
+    return f"{counter.value if counter else 0}-{(today or datetime.utcnow()).strftime('%Y-%m')}"
+
+
+@app.route('/api/analytics/summary')
+def api_analytics_summary():
+    """Сводка для PWA; повторный запрос с If-None-Match отвечает 304 без чтения счётчиков"""
+    if not current_user.is_authenticated:
+        return jsonify({'error': 'Требуется вход в систему'}), 401
+    if getattr(current_user, 'app_type', 'pro') != 'pro':
+        return jsonify({'error': 'Доступ запрещен.'}), 403
+    etag = analytics_summary_etag()
+    if etag in request.if_none_match:
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(get_analytics_summary())
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
 @app.route('/analytics')
 @login_required
 @pro_required
@@ -3844,8 +7380,8 @@ def analytics():
 def pro_documents():
     """Список документов для скачивания (загруженных админом)."""
     try:
-        documents = MediaFile.query.filter_by(file_type='document').order_by(MediaFile.uploaded_at.desc()).all()
-        return render_template('pro/documents.html', documents=documents)
+        page = keyset_paginate(MediaFile.query.filter_by(file_type='document'), MediaFile, 'uploaded_at')
+        return render_template('pro/documents.html', documents=page.items, page=page)
     except Exception as e:
         logger.error(f"Error loading documents: {e}")
         flash('Ошибка при загрузке документов', 'error')
@@ -3858,8 +7394,13 @@ def pro_documents():
 def pro_guidelines():
     """Список методичек (для чтения)."""
     try:
-        guidelines = Guideline.query.filter_by(is_published=True).order_by(Guideline.updated_at.desc()).all()
-        return render_template('pro/guidelines.html', guidelines=guidelines)
+        selected_tags = parse_tags(','.join(request.args.getlist('tag')))
+        query = Guideline.query.filter_by(is_published=True)
+        if selected_tags:
+            query = query.filter(Guideline.id.in_(guideline_ids_with_tags(selected_tags)))
+        page = keyset_paginate(query, Guideline, 'updated_at')
+        return render_template('pro/guidelines.html', guidelines=page.items, page=page,
+                               selected_tags=selected_tags, tag_facets=guideline_tag_facets(selected_tags))
     except Exception as e:
         logger.error(f"Error loading guidelines: {e}")
         flash('Ошибка при загрузке методичек', 'error')
@@ -3876,18 +7417,11 @@ def pro_guideline_detail(guideline_id: int):
         if not guideline.is_published and getattr(current_user, 'user_type', '') != 'admin' and getattr(current_user, 'login', '') != 'Joker':
             flash('Методичка недоступна', 'error')
             return redirect(url_for('pro_guidelines'))
-        # Рендер разметки: поддержка Markdown и аккуратные списки
-        try:
-            import re
-            from markdown import markdown as md
-            raw_text = guideline.content or ''
-            # Конвертируем строки, начинающиеся с типографских маркеров (•, —, –), в маркдаун‑списки
-            normalized = re.sub(r'^[\u2022•—–]\s+', '- ', raw_text, flags=re.MULTILINE)
-            # Убираем лишние пробелы в начале строк
-            normalized = re.sub(r'^[\t ]+', '', normalized, flags=re.MULTILINE)
-            html_content = md(normalized, extensions=['extra', 'sane_lists', 'nl2br'])
-        except Exception:
-            html_content = (guideline.content or '').replace('\n', '<br>')
+        not_modified = content_not_modified(guideline.updated_at)
+        if not_modified:
+            return not_modified
+        # HTML отрендерен при сохранении (content_html); Markdown здесь не выполняется
+        html_content = rendered_content(guideline)
         return render_template('pro/guideline_detail.html', guideline=guideline, html_content=html_content)
     except Exception as e:
         logger.error(f"Error in guideline detail: {e}")
@@ -3903,8 +7437,8 @@ def pro_guideline_detail(guideline_id: int):
 @login_required
 @admin_required
 def admin_guidelines():
-    guidelines = Guideline.query.order_by(Guideline.updated_at.desc()).all()
-    return render_template('admin/guidelines_list.html', guidelines=guidelines)
+    page = keyset_paginate(Guideline.query, Guideline, 'updated_at')
+    return render_template('admin/guidelines_list.html', guidelines=page.items, page=page)
 
 
 @app.route('/admin/guidelines/add', methods=['GET', 'POST'])
@@ -3916,7 +7450,6 @@ def admin_guideline_add():
             title = request.form.get('title', '').strip()
             content = request.form.get('content', '').strip()
             category = request.form.get('category', '').strip() or None
-            tags = request.form.get('tags', '').strip() or None
             is_published = True if request.form.get('is_published') == 'on' else False
 
             if not title or not content:
@@ -3927,11 +7460,11 @@ def admin_guideline_add():
                 title=title,
                 content=content,
                 category=category,
-                tags=tags,
                 author=getattr(current_user, 'full_name', 'Admin'),
                 is_published=is_published
             )
             db.session.add(g)
+            set_guideline_tags(g, request.form.get('tags'))
             db.session.commit()
             flash('Методичка добавлена', 'success')
             return redirect(url_for('admin_guidelines'))
@@ -3952,7 +7485,7 @@ def admin_guideline_edit(guideline_id: int):
             g.title = request.form.get('title', g.title).strip()
             g.content = request.form.get('content', g.content).strip()
             g.category = request.form.get('category', g.category) or None
-            g.tags = request.form.get('tags', g.tags) or None
+            set_guideline_tags(g, request.form.get('tags', g.tags))
             g.is_published = True if request.form.get('is_published') == 'on' else False
             db.session.commit()
             flash('Методичка обновлена', 'success')
@@ -3970,6 +7503,7 @@ def admin_guideline_edit(guideline_id: int):
 def admin_guideline_delete(guideline_id: int):
     try:
         g = Guideline.query.get_or_404(guideline_id)
+        GuidelineTag.query.filter_by(guideline_id=g.id).delete()
         db.session.delete(g)
         db.session.commit()
         flash('Методичка удалена', 'success')
@@ -4421,12 +7955,10 @@ def pwa_patients():
     if not current_user.is_authenticated:
         return redirect(url_for('pwa_login'))
     try:
-        # Получаем список пациентов
-        patients = []
-        if session.get('app_type') == 'pro':
-            # Здесь будет логика получения пациентов
-            pass
-        return render_template('pwa/patients.html', patients=patients)
+        # Список хранится локально в PWA и догружается дельтами из /api/patients/changes
+        return render_template('pwa/patients.html',
+                               changes_url=url_for('api_patients_changes'),
+                               sync_owner=current_user.get_id())
     except Exception as e:
         logger.error(f"❌ Error in PWA patients: {e}")
         return f"PWA Error: {e}", 500
@@ -4438,13 +7970,9 @@ def pwa_analytics():
     if not current_user.is_authenticated:
         return redirect(url_for('pwa_login'))
     try:
-        # Данные для аналитики
-        analytics_data = {
-            'total_patients': 0,
-            'new_this_month': 0,
-            'complications_rate': 0
-        }
-        return render_template('pwa/analytics.html', data=analytics_data)
+        return render_template('pwa/analytics.html',
+                               data=get_analytics_summary(),
+                               summary_url=url_for('api_analytics_summary'))
     except Exception as e:
         logger.error(f"❌ Error in PWA analytics: {e}")
         return f"PWA Error: {e}", 500
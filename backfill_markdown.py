@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+"""
+Заполнение content_html для статей UMAY Mama и методичек
+
+Новые и изменённые записи рендерятся при сохранении; скрипт нужен один раз
+после обновления, чтобы страницы статей не выполняли Markdown для старых записей.
+После смены настроек рендера увеличьте MARKDOWN_RENDER_VERSION в app.py и
+запустите скрипт снова: он перерендерит все записи.
+
+    python backfill_markdown.py
+    DATABASE_URL=postgresql://... python backfill_markdown.py --batch-size 500
+"""
+
+import argparse
+import time
+
+from app import app, backfill_rendered_markdown
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--batch-size', type=int, default=200)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    with app.app_context():
+        updated = backfill_rendered_markdown(batch_size=args.batch_size)
+    print(f"✅ Отрендерено записей: {updated} за {time.perf_counter() - started:.1f} с")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк массовой загрузки и выгрузки пациентов: COPY против executemany
+
+Всегда измеряется SQLite (executemany). Если DATABASE_URL указывает на PostgreSQL,
+дополнительно измеряются оба пути на PostgreSQL: executemany и COPY.
+Замеры идут во временной таблице bench_patient, рабочая таблица не затрагивается.
+
+    python benchmark_bulk_load.py --rows 20000
+    DATABASE_URL=postgresql://... python benchmark_bulk_load.py --rows 100000
+"""
+
+import argparse
+import io
+import os
+import tempfile
+import time
+from datetime import datetime
+
+from sqlalchemy import MetaData, create_engine, select
+
+from app import Patient, PATIENT_YES_NO_FIELDS, bulk_insert_rows, bulk_export_csv, is_postgresql
+
+
+def make_rows(count):
+    now = datetime.utcnow()
+    rows = []
+    for i in range(count):
+        row = {
+            'date': now.strftime('%Y-%m-%d %H:%M'),
+            'patient_name': f'Бенчмарк Пациентка {i}',
+            'age': 18 + i % 25,
+            'pregnancy_weeks': 36 + i % 5,
+            'weight_before': 60.0 + i % 20,
+            'weight_after': 64.5 + i % 20,
+            'complications': '',
+            'notes': 'Нормальные роды' if i % 3 else None,
+            'midwife': f'Акушерка {i % 50}',
+            'birth_date': f'2024-{1 + i % 12:02d}-{1 + i % 28:02d}',
+            'birth_time': '10:30',
+            'child_gender': 'Девочка' if i % 2 else 'Мальчик',
+            'child_weight': 2800 + i % 900,
+            'delivery_method': 'Естественные роды',
+            'anesthesia': 'Без анестезии',
+            'blood_loss': 300 + i % 700,
+            'labor_duration': 6.5,
+            'other_diseases': '',
+            'created_at': now,
+        }
+        for field in PATIENT_YES_NO_FIELDS:
+            row[field] = 'Да' if i % 17 == 0 else 'Нет'
+        rows.append(row)
+    return rows
+
+
+def run(engine, rows, use_copy, batch_size):
+    table = Patient.__table__.to_metadata(MetaData(), name='bench_patient')
+    table.drop(engine, checkfirst=True)
+    table.create(engine)
+    try:
+        started = time.perf_counter()
+        with engine.begin() as conn:
+            for i in range(0, len(rows), batch_size):
+                bulk_insert_rows(table, rows[i:i + batch_size], connection=conn, use_copy=use_copy)
+        load_rate = len(rows) / (time.perf_counter() - started)
+
+        started = time.perf_counter()
+        with engine.connect() as conn:
+            out = io.StringIO()
+            bulk_export_csv(select(table), out, connection=conn, use_copy=use_copy)
+        export_rate = len(rows) / (time.perf_counter() - started)
+        return load_rate, export_rate
+    finally:
+        table.drop(engine, checkfirst=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='COPY vs executemany для таблицы пациентов')
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--batch-size', type=int, default=2000)
+    args = parser.parse_args()
+
+    rows = make_rows(args.rows)
+    targets = []
+    sqlite_path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    targets.append(('SQLite executemany', create_engine(f'sqlite:///{sqlite_path}'), False))
+    database_url = os.getenv('DATABASE_URL', '')
+    if database_url:
+        pg_engine = create_engine(database_url)
+        with pg_engine.connect() as conn:
+            if is_postgresql(conn):
+                targets.append(('PostgreSQL executemany', pg_engine, False))
+                targets.append(('PostgreSQL COPY', pg_engine, True))
+
+    print(f"📊 Строк: {args.rows}, пакет: {args.batch_size}")
+    print(f"{'Путь':<24}{'загрузка, строк/с':>20}{'выгрузка, строк/с':>20}")
+    for name, engine, use_copy in targets:
+        load_rate, export_rate = run(engine, rows, use_copy, args.batch_size)
+        print(f"{name:<24}{load_rate:>20,.0f}{export_rate:>20,.0f}")
+
+
+if __name__ == '__main__':
+    main()
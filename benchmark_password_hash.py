@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк хэширования паролей: сколько входов в секунду выдерживает проверка пароля
+
+Для каждого метода из --methods считается хэш и в течение --seconds секунд
+выполняются проверки пароля в --threads потоков (как gunicorn threads) через
+verify_password приложения. Остальная часть входа (запрос пользователя, сессия)
+на фоне хэширования почти не видна.
+
+    python benchmark_password_hash.py
+    python benchmark_password_hash.py --threads 4 \\
+        --methods pbkdf2:sha256:600000 pbkdf2:sha256:200000 scrypt:16384:8:1
+"""
+
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.security import generate_password_hash
+
+from app import verify_password
+
+DEFAULT_METHODS = ['pbkdf2:sha256:600000', 'pbkdf2:sha256:260000', 'pbkdf2:sha256:100000', 'scrypt:32768:8:1']
+
+
+def measure(method, threads, seconds):
+    stored = generate_password_hash('benchmark-password', method=method)
+    deadline = time.perf_counter() + seconds
+    latencies = []
+
+    def worker():
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            assert verify_password(stored, 'benchmark-password')
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        for _ in range(threads):
+            pool.submit(worker)
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return len(latencies) / elapsed, latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.95)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--methods', nargs='+', default=DEFAULT_METHODS)
+    parser.add_argument('--threads', type=int, default=2)
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+
+    print(f"Потоков запросов: {args.threads}")
+    print(f"{'метод':<26} {'входов/с':>9} {'p50, мс':>9} {'p95, мс':>9}")
+    for method in args.methods:
+        rate, p50, p95 = measure(method, args.threads, args.seconds)
+        print(f"{method:<26} {rate:>9.1f} {p50 * 1000:>9.1f} {p95 * 1000:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""
+Скрипт для массового импорта пациентов из CSV/XLSX
+
+Примеры:
+    python import_patients.py журнал_2023.xlsx --midwife "Гаухар Токсанбаева" --dry-run
+    python import_patients.py выгрузка.csv --report ошибки.csv
+"""
+
+import argparse
+import csv
+import sys
+
+from app import app, import_patients, PATIENT_IMPORT_BATCH_SIZE
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Импорт пациентов UMAY из CSV/XLSX')
+    parser.add_argument('path', help='Путь к файлу .csv или .xlsx')
+    parser.add_argument('--midwife', default='', help='Акушерка для строк без колонки «Акушерка»')
+    parser.add_argument('--dry-run', action='store_true', help='Только проверить файл, ничего не записывать')
+    parser.add_argument('--batch-size', type=int, default=PATIENT_IMPORT_BATCH_SIZE, help='Размер пакета вставки')
+    parser.add_argument('--report', help='Сохранить ошибки по строкам в CSV')
+    args = parser.parse_args()
+
+    print(f"📥 Импорт пациентов из {args.path}{' (проверка)' if args.dry_run else ''}...")
+    with app.app_context(), open(args.path, 'rb') as f:
+        report = import_patients(f, args.path, args.midwife, dry_run=args.dry_run, batch_size=args.batch_size)
+
+    print(f"✅ Строк в файле: {report['total']}")
+    print(f"✅ {'Корректных' if args.dry_run else 'Импортировано'}: {report['imported']}")
+    if report['failed']:
+        print(f"❌ С ошибками: {report['failed']}")
+        for error in report['errors'][:20]:
+            print(f"   строка {error['row']}: {error['error']}")
+    if args.report and report['errors']:
+        with open(args.report, 'w', newline='', encoding='utf-8-sig') as out:
+            writer = csv.writer(out)
+            writer.writerow(['Строка', 'Ошибка'])
+            for error in report['errors']:
+                writer.writerow([error['row'], error['error']])
+        print(f"📄 Отчет об ошибках: {args.report}")
+    return 0 if not report['failed'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
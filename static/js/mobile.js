@@ -20,6 +20,9 @@ class UMAYPWA {
     // Настройка событий
     this.setupEventListeners();
     
+    // Offline-очередь для формы добавления пациента
+    this.setupOfflinePatientForms();
+    
     // Настроить кнопку установки для iOS/Android
     this.setupInstallCTA();
     
@@ -95,6 +98,7 @@ class UMAYPWA {
       this.isOnline = true;
       this.updateOnlineStatus();
       this.showSuccessMessage('Подключение к интернету восстановлено');
+      this.flushPatientQueue();
     });
     
     window.addEventListener('offline', () => {
@@ -110,6 +114,75 @@ class UMAYPWA {
     this.setupSwipeGestures();
   }
 
+  // Формы с data-offline-sync="patient": без сети запись уходит в очередь Service Worker
+  setupOfflinePatientForms() {
+    document.querySelectorAll('form[data-offline-sync="patient"]').forEach((form) => {
+      form.addEventListener('submit', (e) => {
+        if (navigator.onLine || !navigator.serviceWorker || !navigator.serviceWorker.controller) {
+          return;
+        }
+        e.preventDefault();
+        this.queuePatientForm(form);
+      });
+    });
+    
+    if (navigator.serviceWorker) {
+      navigator.serviceWorker.addEventListener('message', (event) => {
+        if (!event.data || event.data.type !== 'PATIENT_SYNC_RESULT') {
+          return;
+        }
+        const results = event.data.results || [];
+        const failed = results.filter((r) => r.status === 'error');
+        const saved = results.length - failed.length;
+        if (saved) {
+          this.showSuccessMessage(`Отправлено записей из offline-очереди: ${saved}`);
+        }
+        failed.forEach((r) => this.showWarningMessage(`Запись не принята: ${r.error}`));
+      });
+    }
+    
+    if (navigator.onLine) {
+      this.flushPatientQueue();
+    }
+  }
+  
+  async queuePatientForm(form) {
+    const record = Object.fromEntries(new FormData(form).entries());
+    record.client_id = (window.crypto && crypto.randomUUID)
+      ? crypto.randomUUID()
+      : `${Date.now()}-${Math.random().toString(16).slice(2)}`;
+    const now = new Date();
+    const pad = (n) => String(n).padStart(2, '0');
+    record.date = `${now.getFullYear()}-${pad(now.getMonth() + 1)}-${pad(now.getDate())} ${pad(now.getHours())}:${pad(now.getMinutes())}`;
+    
+    try {
+      const response = await fetch('/api/patients/sync', {
+        method: 'POST',
+        credentials: 'same-origin',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ records: [record] })
+      });
+      if (response.status === 202 || response.ok) {
+        form.reset();
+        this.showSuccessMessage(response.status === 202
+          ? 'Нет сети: запись сохранена на устройстве и будет отправлена автоматически'
+          : 'Пациент успешно добавлен!');
+      } else {
+        this.showWarningMessage('Не удалось сохранить запись. Проверьте данные.');
+      }
+    } catch (error) {
+      console.error('❌ UMAY PWA: Ошибка offline-сохранения:', error);
+      this.showWarningMessage('Не удалось сохранить запись на устройстве');
+    }
+  }
+  
+  // Попросить Service Worker отправить накопленную очередь (fallback без Background Sync)
+  flushPatientQueue() {
+    if (navigator.serviceWorker && navigator.serviceWorker.controller) {
+      navigator.serviceWorker.controller.postMessage({ type: 'FLUSH_PATIENT_QUEUE' });
+    }
+  }
+
   // Показать кнопку установки и поведение для разных платформ
   setupInstallCTA() {
     const baseInstallBtn = document.getElementById('install-pwa-btn');
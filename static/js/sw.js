@@ -1,5 +1,5 @@
 // UMAY Service Worker - PWA функциональность
-const CACHE_VERSION = 'v1.0.4';
+const CACHE_VERSION = 'v1.0.7';
 const CACHE_NAME = `umay-${CACHE_VERSION}`;
 const STATIC_CACHE = `umay-static-${CACHE_VERSION}`;
 const DYNAMIC_CACHE = `umay-dynamic-${CACHE_VERSION}`;
@@ -63,6 +63,12 @@ self.addEventListener('fetch', (event) => {
   const { request } = event;
   const url = new URL(request.url);
   
+  // Пакетная отправка пациентов: при отсутствии сети кладем в offline-очередь
+  if (request.method === 'POST' && url.origin === location.origin && url.pathname === PATIENT_SYNC_URL) {
+    event.respondWith(sendOrQueuePatients(request));
+    return;
+  }
+  
   // Пропускаем не-GET запросы
   if (request.method !== 'GET') {
     return;
@@ -73,6 +79,17 @@ self.addEventListener('fetch', (event) => {
     return;
   }
   
+  // Дельты пациентов применяются к IndexedDB (pullPatientChanges) — в кэш их не кладем
+  if (url.pathname === PATIENT_CHANGES_URL) {
+    return;
+  }
+  
+  // Сводка аналитики: мгновенно из кэша, в фоне перепроверяем по ETag
+  if (url.pathname === ANALYTICS_SUMMARY_URL) {
+    event.respondWith(staleWhileRevalidate(request));
+    return;
+  }
+  
   // Стратегия кэширования: Cache First для статики, Network First для HTML/API
   if (isStaticFile(request.url)) {
     event.respondWith(cacheFirst(request));
@@ -105,6 +122,25 @@ async function cacheFirst(request) {
   }
 }
 
+// Стратегия Stale-While-Revalidate: кэш сразу, обновление из сети в фоне.
+// Браузер сам шлет If-None-Match, и при 304 сеть почти не тратится.
+async function staleWhileRevalidate(request) {
+  const cache = await caches.open(DYNAMIC_CACHE);
+  const cachedResponse = await cache.match(request);
+  const networkPromise = fetch(request)
+    .then((networkResponse) => {
+      if (networkResponse.ok) {
+        cache.put(request, networkResponse.clone());
+      }
+      return networkResponse;
+    })
+    .catch(() => cachedResponse || new Response(JSON.stringify({ error: 'offline' }), {
+      status: 503,
+      headers: { 'Content-Type': 'application/json' }
+    }));
+  return cachedResponse || networkPromise;
+}
+
 // Стратегия Network First для динамических страниц
 async function networkFirst(request) {
   try {
@@ -141,6 +177,179 @@ function isStaticFile(url) {
   return staticExtensions.some(ext => url.includes(ext));
 }
 
+// ======================
+// Offline-очередь записей пациентов (IndexedDB + Background Sync)
+// ======================
+const PATIENT_SYNC_URL = '/api/patients/sync';
+const PATIENT_CHANGES_URL = '/api/patients/changes';
+const ANALYTICS_SUMMARY_URL = '/api/analytics/summary';
+const PATIENT_SYNC_TAG = 'umay-patient-sync';
+const PATIENT_SYNC_BATCH = 50;
+const SYNC_DB_NAME = 'umay-offline';
+const SYNC_STORE = 'patient-queue';
+// Локальная копия пациентов (ключ — id) и курсор delta-выгрузки
+const PATIENT_STORE = 'patients';
+const SYNC_META_STORE = 'sync-meta';
+const PATIENT_CURSOR_KEY = 'patients_cursor';
+
+function openSyncDb() {
+  return new Promise((resolve, reject) => {
+    const req = indexedDB.open(SYNC_DB_NAME, 2);
+    req.onupgradeneeded = () => {
+      const db = req.result;
+      if (!db.objectStoreNames.contains(SYNC_STORE)) {
+        db.createObjectStore(SYNC_STORE, { keyPath: 'client_id' });
+      }
+      if (!db.objectStoreNames.contains(PATIENT_STORE)) {
+        db.createObjectStore(PATIENT_STORE, { keyPath: 'id' });
+      }
+      if (!db.objectStoreNames.contains(SYNC_META_STORE)) {
+        db.createObjectStore(SYNC_META_STORE);
+      }
+    };
+    req.onsuccess = () => resolve(req.result);
+    req.onerror = () => reject(req.error);
+  });
+}
+
+async function withStores(names, mode, fn) {
+  const db = await openSyncDb();
+  return new Promise((resolve, reject) => {
+    const tx = db.transaction(names, mode);
+    const result = fn(...names.map((name) => tx.objectStore(name)));
+    tx.oncomplete = () => resolve(result && 'result' in result ? result.result : undefined);
+    tx.onerror = () => reject(tx.error);
+  });
+}
+
+function withSyncStore(mode, fn) {
+  return withStores([SYNC_STORE], mode, fn);
+}
+
+function queuePatientRecords(records) {
+  return withSyncStore('readwrite', (store) => {
+    records.filter((r) => r && r.client_id).forEach((r) => store.put(r));
+  });
+}
+
+function readQueuedPatients() {
+  return withSyncStore('readonly', (store) => store.getAll());
+}
+
+function removeQueuedPatients(clientIds) {
+  return withSyncStore('readwrite', (store) => {
+    clientIds.forEach((id) => store.delete(id));
+  });
+}
+
+async function notifyClients(message) {
+  const windows = await self.clients.matchAll({ type: 'window' });
+  windows.forEach((client) => client.postMessage(message));
+}
+
+async function sendOrQueuePatients(request) {
+  const payload = await request.clone().json().catch(() => ({}));
+  try {
+    return await fetch(request);
+  } catch (error) {
+    const records = Array.isArray(payload.records) ? payload.records : [];
+    await queuePatientRecords(records);
+    if (self.registration.sync) {
+      await self.registration.sync.register(PATIENT_SYNC_TAG).catch(() => {});
+    }
+    console.log('📥 UMAY Service Worker: Записи пациентов поставлены в очередь:', records.length);
+    return new Response(JSON.stringify({
+      queued: true,
+      results: records.map((r) => ({ client_id: r.client_id, status: 'queued' }))
+    }), { status: 202, headers: { 'Content-Type': 'application/json' } });
+  }
+}
+
+async function flushPatientQueue() {
+  const records = await readQueuedPatients();
+  for (let i = 0; i < records.length; i += PATIENT_SYNC_BATCH) {
+    const batch = records.slice(i, i + PATIENT_SYNC_BATCH);
+    const response = await fetch(PATIENT_SYNC_URL, {
+      method: 'POST',
+      credentials: 'same-origin',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ records: batch })
+    });
+    if (!response.ok) {
+      // 401/5xx: оставляем в очереди, Background Sync повторит позже
+      throw new Error(`Patient sync failed: ${response.status}`);
+    }
+    const { results = [] } = await response.json();
+    // Принятые и окончательно отклоненные записи удаляем из очереди, ошибки показываем пользователю
+    await removeQueuedPatients(results.map((r) => r.client_id).filter(Boolean));
+    await notifyClients({ type: 'PATIENT_SYNC_RESULT', results });
+  }
+}
+
+// Применяет страницу /api/patients/changes одной транзакцией: reset очищает копию,
+// записи перезаписываются по id, tombstone удаляют, курсор сохраняется вместе с данными
+function applyPatientChanges(page) {
+  return withStores([PATIENT_STORE, SYNC_META_STORE], 'readwrite', (patients, meta) => {
+    if (page.reset) {
+      patients.clear();
+    }
+    const columns = Object.keys(page.patients);
+    (page.patients.id || []).forEach((_, i) => {
+      const record = {};
+      columns.forEach((column) => { record[column] = page.patients[column][i]; });
+      patients.put(record);
+    });
+    page.deleted.forEach((id) => patients.delete(id));
+    meta.put(page.cursor, PATIENT_CURSOR_KEY);
+  });
+}
+
+async function pullPatientChanges() {
+  let since = (await withStores([SYNC_META_STORE], 'readonly', (meta) => meta.get(PATIENT_CURSOR_KEY))) || 0;
+  // После reset сервер отдает выгрузку с нуля; остальные страницы дочитываем с resync=1,
+  // иначе курсор ниже водяного знака снова вызвал бы сброс
+  let resync = false;
+  for (;;) {
+    const params = new URLSearchParams({ since: String(since) });
+    if (resync) {
+      params.set('resync', '1');
+    }
+    const response = await fetch(`${PATIENT_CHANGES_URL}?${params}`, { credentials: 'same-origin' });
+    if (!response.ok) {
+      throw new Error(`Patient changes failed: ${response.status}`);
+    }
+    const page = await response.json();
+    resync = resync || page.reset;
+    await applyPatientChanges(page);
+    since = page.cursor;
+    if (!page.has_more) {
+      break;
+    }
+  }
+  await notifyClients({ type: 'PATIENT_CHANGES_APPLIED', cursor: since });
+}
+
+self.addEventListener('sync', (event) => {
+  if (event.tag === PATIENT_SYNC_TAG) {
+    event.waitUntil(flushPatientQueue().then(pullPatientChanges));
+  }
+});
+
+self.addEventListener('message', (event) => {
+  // Fallback для браузеров без Background Sync (iOS Safari): страница просит отправить очередь
+  if (event.data && event.data.type === 'FLUSH_PATIENT_QUEUE') {
+    event.waitUntil(flushPatientQueue().catch((error) => {
+      console.warn('⚠️ UMAY Service Worker: Очередь не отправлена:', error);
+    }));
+  }
+  // Страница просит обновить локальную копию пациентов
+  if (event.data && event.data.type === 'PULL_PATIENT_CHANGES') {
+    event.waitUntil(pullPatientChanges().catch((error) => {
+      console.warn('⚠️ UMAY Service Worker: Изменения пациентов не получены:', error);
+    }));
+  }
+});
+
 // Push уведомления
 self.addEventListener('push', (event) => {
   console.log('📱 UMAY Service Worker: Получено push уведомление');
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Скрипт для тестирования предрасчитанной сводки аналитики (/api/analytics/summary)
+"""
+
+import time
+from datetime import datetime
+
+from app import app, db, Patient, PatientRollup, get_analytics_summary, parse_patient_record, rebuild_patient_rollups
+
+TEST_MIDWIFE = "Тестовая акушерка аналитики"
+
+
+def _rollup_rows():
+    return {(r.kind, r.bucket): (r.patients, r.complicated) for r in PatientRollup.query.all() if r.patients}
+
+
+def test_analytics_summary_rollups():
+    """Счётчики следуют за добавлением, правкой и удалением пациентов"""
+    month = datetime.utcnow().strftime('%Y-%m')
+    with app.app_context():
+        Patient.query.filter_by(midwife=TEST_MIDWIFE).delete()
+        db.session.commit()
+        rebuild_patient_rollups()
+        before = get_analytics_summary()
+
+        fields = parse_patient_record({
+            'patient_name': 'Сводка Тест', 'age': 30, 'pregnancy_weeks': 39,
+            'weight_before': 60, 'weight_after': 64, 'birth_date': f'{month}-05', 'birth_time': '12:00',
+            'child_gender': 'Мальчик', 'child_weight': 3500, 'delivery_method': 'Естественные роды',
+            'anesthesia': 'Без анестезии', 'blood_loss': 400, 'labor_duration': 6, 'anemia': 'on',
+        }, TEST_MIDWIFE)
+        patient = Patient(**fields)
+        db.session.add(patient)
+        db.session.commit()
+        try:
+            after = get_analytics_summary()
+            assert after['total_patients'] == before['total_patients'] + 1
+            assert after['new_this_month'] == before['new_this_month'] + 1
+            assert after['sparkline']['counts'][-1] == before['sparkline']['counts'][-1] + 1
+            assert after['sparkline']['months'][-1] == month
+
+            patient.anemia = 'Нет'
+            db.session.commit()
+            maintained = _rollup_rows()
+            rebuild_patient_rollups()
+            assert _rollup_rows() == maintained
+
+            # Старая запись без created_at не считается новой в месяц пересчёта
+            Patient.query.filter_by(id=patient.id).update({'created_at': None})
+            db.session.commit()
+            rebuild_patient_rollups()
+            assert get_analytics_summary()['new_this_month'] == before['new_this_month']
+            assert db.session.get(PatientRollup, ('created', '')).patients >= 1
+
+            db.session.delete(patient)
+            db.session.commit()
+            assert get_analytics_summary() == before
+
+            started = time.perf_counter()
+            get_analytics_summary()
+            print(f"✅ Сводка аналитики за {(time.perf_counter() - started) * 1000:.1f} мс")
+        finally:
+            Patient.query.filter_by(midwife=TEST_MIDWIFE).delete()
+            db.session.commit()
+            rebuild_patient_rollups()
+
+
+def test_analytics_summary_etag():
+    """Повторный запрос с ETag отвечает 304"""
+    app.config['TESTING'] = True
+    client = app.test_client()
+    assert client.get('/api/analytics/summary').status_code == 401
+
+    client.post('/login', data={'login': 'Joker', 'password': '19341934', 'is_medic': 'on'})
+    response = client.get('/api/analytics/summary')
+    assert response.status_code == 200
+    assert 'sparkline' in response.get_json()
+    etag = response.headers['ETag']
+    response = client.get('/api/analytics/summary', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert client.get('/pwa/analytics').status_code == 200
+    print("✅ ETag сводки аналитики работает")
+
+
+if __name__ == "__main__":
+    test_analytics_summary_rollups()
+    test_analytics_summary_etag()
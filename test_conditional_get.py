@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Скрипт для тестирования conditional GET (ETag / Last-Modified) на страницах контента
+"""
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+
+from app import app, db, News
+
+MARKER = 'Условтест'
+
+
+def _cleanup():
+    for news in News.query.filter(News.title.like(f'{MARKER}%')).all():
+        db.session.delete(news)
+    db.session.commit()
+
+
+def test_conditional_get():
+    """Повторный запрос с валидаторами получает 304 без запросов к таблицам контента"""
+    app.config['TESTING'] = True
+    client = app.test_client()
+    with app.app_context():
+        _cleanup()
+        news = News(title=f'{MARKER} новость', short_description='Коротко', full_content='Текст',
+                    published_at=datetime.utcnow() - timedelta(days=1), updated_at=datetime.utcnow() - timedelta(days=1))
+        db.session.add(news)
+        db.session.commit()
+        news_id = news.id
+    try:
+        first = client.get('/news')
+        assert first.status_code == 200
+        etag = first.headers['ETag']
+        assert first.headers['Last-Modified']
+        assert first.headers['Cache-Control'] == 'public, no-cache'
+        assert 'Cookie' in first.headers['Vary']
+
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            if 'FROM news' in statement:
+                statements.append(statement)
+
+        with app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            repeat = client.get('/news', headers={'If-None-Match': etag})
+        finally:
+            with app.app_context():
+                event.remove(db.engine, 'before_cursor_execute', count)
+        assert repeat.status_code == 304
+        assert repeat.headers['ETag'] == etag
+        assert statements == [], "304 не должен читать новости"
+
+        detail = client.get(f'/news/{news_id}')
+        assert detail.status_code == 200
+        since = detail.headers['Last-Modified']
+        assert client.get(f'/news/{news_id}', headers={'If-Modified-Since': since}).status_code == 304
+
+        # Правка новости меняет и ETag, и Last-Modified
+        with app.app_context():
+            db.session.get(News, news_id).title = f'{MARKER} новость (обновлено)'
+            db.session.commit()
+        changed = client.get('/news', headers={'If-None-Match': etag})
+        assert changed.status_code == 200 and changed.headers['ETag'] != etag
+        assert MARKER + ' новость (обновлено)' in changed.get_data(as_text=True)
+        assert client.get(f'/news/{news_id}', headers={'If-Modified-Since': since}).status_code == 200
+
+        # Страница пользователя — только в его кэше и со своим ETag
+        with client.session_transaction() as session:
+            session['_flashes'] = [('success', 'Сообщение')]
+        assert 'ETag' not in client.get('/news').headers, "страница с flash-сообщением не кэшируется"
+        client.post('/login', data={'login': 'Joker', 'password': '19341934', 'is_medic': 'on'})
+        client.get('/news')  # показывает flash после входа
+        personal = client.get('/news', headers={'If-None-Match': changed.headers['ETag']})
+        assert personal.status_code == 200
+        assert personal.headers['Cache-Control'] == 'private, no-cache'
+        print("✅ Conditional GET работает")
+    finally:
+        with app.app_context():
+            _cleanup()
+
+
+if __name__ == "__main__":
+    test_conditional_get()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Скрипт для тестирования фоновой генерации статей UMAY Mama по шаблонам
+"""
+
+from datetime import datetime, timedelta
+
+import app as umay
+from app import (app, db, ContentGenerationTask, MamaContent, ai_content_library, content_generation_job,
+                 generate_ai_content, rate_limiter, requeue_stale_generation_tasks, _ai_content_template_source)
+
+NEWS = [{'title': 'Генерациятест новость', 'source': 'Тест', 'date': '2026-01-01'}]
+
+
+def _cleanup(after_id, task_ids=()):
+    """Удаляет статьи, созданные тестом (id больше after_id), и его задачи"""
+    for article in MamaContent.query.filter(MamaContent.id > after_id, MamaContent.category == 'body_care').all():
+        db.session.delete(article)
+    ContentGenerationTask.query.filter(ContentGenerationTask.id.in_(task_ids)).delete(synchronize_session=False)
+    db.session.commit()
+
+
+def test_compiled_templates():
+    """Скомпилированные шаблоны дают тот же текст, что и str.format"""
+    source = _ai_content_template_source()
+    for category, template in ai_content_library().items():
+        for compiled, text in zip(template['titles'] + template['content'],
+                                  source[category]['titles'] + source[category].get('content', [])):
+            assert compiled.render(trimester='2') == text.format(trimester='2')
+    assert ai_content_library() is ai_content_library(), "библиотека разбирается один раз"
+    print("✅ Шаблоны генератора компилируются один раз")
+
+
+def test_generation_in_background():
+    """POST только ставит задачу; фоновая задача вставляет статьи пакетами и сохраняет прогресс"""
+    app.config['TESTING'] = True
+    client = app.test_client()
+    rate_limiter.reset()
+    client.post('/login', data={'login': 'Joker', 'password': '19341934', 'is_medic': 'on'})
+    client.get('/admin')  # flash после входа
+    fetches = []
+    get_latest_news, batch_size = umay.get_latest_news, umay.CONTENT_GENERATION_BATCH_SIZE
+    umay.get_latest_news = lambda category: fetches.append(category) or NEWS
+    umay.CONTENT_GENERATION_BATCH_SIZE = 3
+    task_ids, last_id = [], None
+    try:
+        with app.app_context():
+            last_id = db.session.query(db.func.max(MamaContent.id)).scalar() or 0
+            before = MamaContent.query.count()
+
+        response = client.post('/admin/mama-content/generate',
+                               data={'category': 'body_care', 'trimester': '2', 'count': '20'})
+        assert response.status_code == 302
+        task_id = int(response.headers['Location'].rsplit('task=', 1)[1])
+        task_ids.append(task_id)
+        with app.app_context():
+            assert MamaContent.query.count() == before, "в запросе статьи не создаются"
+        status = client.get(f'/admin/mama-content/generate/{task_id}/status').get_json()
+        assert status['status'] == 'pending' and status['total'] == 7 and status['requested'] == 20
+        assert 'generation-progress' in client.get(response.headers['Location']).get_data(as_text=True)
+
+        assert content_generation_job.run_once() == {'tasks': 1, 'generated': 7, 'failed': 0}
+        status = client.get(f'/admin/mama-content/generate/{task_id}/status').get_json()
+        assert status['status'] == 'done' and status['generated'] == 7 and status['percent'] == 100
+        assert fetches == ['body_care'], "новости запрашиваются один раз на задачу"
+        with app.app_context():
+            assert MamaContent.query.count() == before + 7
+
+            # Прогресс сохраняется после каждого пакета; генерация продолжается с места остановки
+            _cleanup(last_id)
+            progress = []
+            created = generate_ai_content('body_care', '1', 7, start=2, batch_size=2, progress=progress.append)
+            assert progress == [4, 6, 7]
+            assert len(created) == 5
+        print("✅ Фоновая генерация работает")
+    finally:
+        umay.get_latest_news, umay.CONTENT_GENERATION_BATCH_SIZE = get_latest_news, batch_size
+        if last_id is not None:
+            with app.app_context():
+                _cleanup(last_id, task_ids)
+
+
+def test_requeue_only_stale_tasks():
+    """Задача, которую ещё выполняет другой воркер, не возвращается в очередь"""
+    with app.app_context():
+        now = datetime.utcnow()
+        live = ContentGenerationTask(category='body_care', requested=5, total=5, status='running',
+                                     started_at=now, heartbeat_at=now)
+        stale = ContentGenerationTask(category='body_care', requested=5, total=5, status='running',
+                                      started_at=now - timedelta(hours=2), heartbeat_at=now - timedelta(hours=1))
+        db.session.add_all([live, stale])
+        db.session.commit()
+        try:
+            assert requeue_stale_generation_tasks() == 1
+            db.session.expire_all()
+            assert live.status == 'running' and stale.status == 'pending'
+            print("✅ В очередь возвращаются только брошенные задачи")
+        finally:
+            ContentGenerationTask.query.filter(ContentGenerationTask.id.in_([live.id, stale.id])) \
+                .delete(synchronize_session=False)
+            db.session.commit()
+
+
+if __name__ == "__main__":
+    test_compiled_templates()
+    test_generation_in_background()
+    test_requeue_only_stale_tasks()
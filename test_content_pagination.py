@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Скрипт для тестирования keyset-пагинации списков контента
+"""
+
+import re
+from datetime import datetime, timedelta
+
+from app import app, db, News, CONTENT_PAGE_SIZE
+
+TEST_AUTHOR = "Тест пагинации"
+
+
+def _cleanup():
+    News.query.filter_by(author=TEST_AUTHOR).delete()
+    db.session.commit()
+
+
+def test_news_keyset_pagination():
+    """Переход по ссылкам «Дальше» проходит ленту целиком без повторов и пропусков"""
+    app.config['TESTING'] = True
+    base = datetime.utcnow() + timedelta(days=365)  # выше существующих новостей
+    total = CONTENT_PAGE_SIZE * 2 + 5
+    with app.app_context():
+        _cleanup()
+        for i in range(total):
+            # по три новости с одинаковым временем — порядок внутри решает id
+            db.session.add(News(title=f'Пагинация {i:03d}', short_description='-', full_content='-',
+                                author=TEST_AUTHOR, published_at=base - timedelta(minutes=i // 3)))
+        db.session.add(News(title='Пагинация черновик', short_description='-', full_content='-',
+                            author=TEST_AUTHOR, published_at=base, is_published=False))
+        db.session.commit()
+    try:
+        client = app.test_client()
+        url, seen, pages = '/news', [], 0
+        while url and len(seen) < total:
+            body = client.get(url).get_data(as_text=True)
+            pages += 1
+            seen += re.findall(r'Пагинация (\d{3})', body)
+            match = re.search(r'href="([^"]*after=[^"]*)"', body)
+            url = match.group(1).replace('&amp;', '&') if match else None
+        assert pages == 3
+        # внутри одинакового времени — более новые id раньше
+        expected = sorted(range(total), key=lambda i: (i // 3, -i))
+        assert seen == [f'{i:03d}' for i in expected]
+        assert 'черновик' not in body
+
+        with app.app_context():
+            if db.engine.dialect.name == 'sqlite':
+                plan = db.session.execute(db.text(
+                    "EXPLAIN QUERY PLAN SELECT id FROM news WHERE is_published = 1 "
+                    "AND (published_at, id) < (:p, :i) ORDER BY published_at DESC, id DESC LIMIT 21"),
+                    {'p': base, 'i': 10}).fetchall()
+                assert 'ix_news_published_published_at' in str(plan), plan
+        print(f"✅ Лента новостей: {pages} страницы по {CONTENT_PAGE_SIZE}")
+    finally:
+        with app.app_context():
+            _cleanup()
+
+
+def test_admin_lists_paginated():
+    """Списки админки и Pro открываются с курсором и без него"""
+    app.config['TESTING'] = True
+    client = app.test_client()
+    client.post('/login', data={'login': 'Joker', 'password': '19341934', 'is_medic': 'on'})
+    for url in ('/admin/news', '/admin/mama-content/list', '/admin/guidelines', '/admin/media', '/pro/guidelines',
+                '/pro/documents', '/mama/content?category=sport'):
+        assert client.get(url).status_code == 200, url
+        assert client.get(url + ('&' if '?' in url else '?') + 'after=2020-01-01T00:00:00_5').status_code == 200
+        assert client.get(url + ('&' if '?' in url else '?') + 'after=garbage').status_code == 200
+    print("✅ Списки с пагинацией открываются")
+
+
+if __name__ == "__main__":
+    test_news_keyset_pagination()
+    test_admin_lists_paginated()
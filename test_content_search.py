@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Скрипт для тестирования полнотекстового поиска по статьям, новостям и методичкам
+"""
+
+from sqlalchemy import text
+
+from app import app, db, ContentSearchDocument, Guideline, MamaContent, News, is_postgresql, stem_russian
+
+MARKER = 'Поисктест'
+# Слово -> основа по Snowball (совпадает с ts_lexize('russian_stem', слово) в PostgreSQL)
+REFERENCE_STEMS = {
+    'беременность': 'беремен', 'беременности': 'беремен', 'беременных': 'беремен',
+    'витаминов': 'витамин', 'витамины': 'витамин', 'ребёнка': 'ребенк', 'ёлка': 'елк',
+    'упражнения': 'упражнен', 'железо': 'желез', 'анемия': 'анем', 'питание': 'питан',
+    'дыхательные': 'дыхательн', 'рекомендации': 'рекомендац', 'кормление': 'кормлен',
+    'новорожденного': 'новорожден', 'триместре': 'триместр', 'гемоглобин': 'гемоглобин',
+    'прогулки': 'прогулк', 'растяжка': 'растяжк', 'подготовиться': 'подготов',
+}
+
+
+def _cleanup():
+    for model in (MamaContent, News, Guideline):
+        for obj in model.query.filter(model.title.like(f'{MARKER}%')).all():
+            db.session.delete(obj)
+    db.session.commit()
+
+
+def _search(client, **params):
+    response = client.get('/api/search', query_string=params)
+    assert response.status_code == 200, response.get_data(as_text=True)
+    return [r for r in response.get_json()['results'] if r['title'].startswith(MARKER)]
+
+
+def test_stem_russian():
+    """Словоформы сводятся к одной основе, как в конфигурации 'russian' PostgreSQL"""
+    assert {word: stem_russian(word) for word in REFERENCE_STEMS} == REFERENCE_STEMS
+    with app.app_context():
+        if is_postgresql():
+            for word, stem in REFERENCE_STEMS.items():
+                assert db.session.execute(text("SELECT ts_lexize('russian_stem', :w)"), {'w': word}).scalar() == [stem]
+
+
+def test_content_search():
+    """Ранжирование, подсветка, фильтры и инкрементальное обновление индекса"""
+    app.config['TESTING'] = True
+    client = app.test_client()
+    with app.app_context():
+        _cleanup()
+        try:
+            title_hit = MamaContent(title=f'{MARKER}: витамины при беременности', category='vitamins',
+                                    trimester='1', content='Какие **витамины** нужны в первом триместре.')
+            body_hit = MamaContent(title=f'{MARKER}: питание', category='nutrition', trimester='all',
+                                   content='Рацион богат витаминами и <b>железом</b>, полезен беременным.')
+            news = News(title=f'{MARKER}: новости', short_description='Коротко',
+                        full_content='<p>Новая школа для беременных открылась в Шымкенте.</p>')
+            draft = MamaContent(title=f'{MARKER}: черновик витаминов', category='vitamins', trimester='1',
+                                content='Не опубликовано', is_published=False)
+            guideline = Guideline(title=f'{MARKER}: протокол', content='Ведение беременности высокого риска.',
+                                  category='obstetrics', tags='Протокол, риск')
+            db.session.add_all([title_hit, body_hit, news, draft, guideline])
+            db.session.commit()
+
+            results = _search(client, q='витамин')
+            assert [r['id'] for r in results] == [title_hit.id, body_hit.id], "совпадение в заголовке выше"
+            assert '<mark>витаминами</mark>' in results[1]['snippet']
+            assert '<b>' not in results[1]['snippet'], "разметка статьи не попадает в сниппет"
+            assert results[0]['url'] == f'/mama/article/{title_hit.id}'
+
+            assert [r['id'] for r in _search(client, q='витамин', category='nutrition')] == [body_hit.id]
+            assert [r['id'] for r in _search(client, q='витамин', trimester='2')] == [body_hit.id]
+            assert {r['type'] for r in _search(client, q='беременная')} == {'mama', 'news'}, \
+                "методички не видны анонимам"
+
+            # Правка, снятие с публикации и удаление сразу отражаются в индексе
+            body_hit.content = 'Рацион богат кальцием.'
+            news.is_published = False
+            db.session.commit()
+            assert [r['id'] for r in _search(client, q='витамин')] == [title_hit.id]
+            assert _search(client, q='школа') == []
+            db.session.delete(title_hit)
+            db.session.commit()
+            assert _search(client, q='витамин') == []
+            assert ContentSearchDocument.query.filter_by(doc_type='mama', doc_id=draft.id).count() == 0
+
+            # Массовое удаление Query.delete() тоже чистит индекс
+            assert _search(client, q='кальций')
+            body_id = body_hit.id
+            MamaContent.query.filter_by(id=body_id).delete(synchronize_session=False)
+            db.session.commit()
+            assert _search(client, q='кальций') == []
+            assert ContentSearchDocument.query.filter_by(doc_type='mama', doc_id=body_id).count() == 0
+
+            client.post('/login', data={'login': 'Joker', 'password': '19341934', 'is_medic': 'on'})
+            results = _search(client, q='беременности риска', type='guideline', tags='протокол')
+            assert [r['id'] for r in results] == [guideline.id]
+            assert results[0]['tags'] == ['протокол', 'риск']
+            assert client.get('/api/search?q=а').status_code == 400
+            print("✅ Поиск по контенту работает")
+        finally:
+            _cleanup()
+
+
+if __name__ == "__main__":
+    test_stem_russian()
+    test_content_search()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Скрипт для тестирования предрасчитанных счётчиков дашбордов (entity_counter)
+"""
+
+from sqlalchemy import event
+
+from app import (app, db, EntityCounter, MamaContent, News, apply_entity_counter_deltas, dashboard_counters,
+                 entity_counters_in_sync, rate_limiter, rebuild_entity_counters)
+
+MARKER = 'Счётчиктест'
+
+
+def _cleanup():
+    for model in (News, MamaContent):
+        for obj in model.query.filter(model.title.like(f'{MARKER}%')).all():
+            db.session.delete(obj)
+    db.session.commit()
+
+
+def _actual():
+    """Те же цифры, посчитанные напрямую по таблицам"""
+    return {
+        'news': News.query.count(),
+        'mama': MamaContent.query.count(),
+        'published': MamaContent.query.filter_by(is_published=True).count(),
+        'pending': MamaContent.query.filter_by(is_published=False).count(),
+        'sport': MamaContent.query.filter_by(category='sport').count(),
+    }
+
+
+def _maintained():
+    counters = dashboard_counters()
+    mama = counters['mama_content']
+    return {
+        'news': counters['news']['total'],
+        'mama': mama['total'],
+        'published': mama.get('is_published', {}).get('true', 0),
+        'pending': mama.get('is_published', {}).get('false', 0),
+        'sport': mama.get('category', {}).get('sport', 0),
+    }
+
+
+def test_counters_follow_orm_changes():
+    """Добавление, публикация, смена категории и удаление меняют счётчики"""
+    with app.app_context():
+        _cleanup()
+        rebuild_entity_counters()
+        try:
+            before = _maintained()
+            assert before == _actual()
+
+            article = MamaContent(title=f'{MARKER} статья', content='Текст', category='sport', is_published=False)
+            db.session.add_all([article, News(title=f'{MARKER} новость', short_description='к', full_content='т')])
+            db.session.commit()
+            after = _maintained()
+            assert after == _actual()
+            assert after['news'] == before['news'] + 1 and after['pending'] == before['pending'] + 1
+
+            article.is_published = True
+            article.category = 'nutrition'
+            db.session.commit()
+            assert _maintained() == _actual()
+
+            db.session.delete(article)
+            db.session.commit()
+            assert _maintained()['mama'] == before['mama']
+            assert _maintained() == _actual()
+            print("✅ Счётчики следуют за изменениями через ORM")
+        finally:
+            _cleanup()
+
+
+def test_counter_facets_upsert_and_drift():
+    """Новый срез создаётся upsert'ом; расхождение в срезе (не только в total) видно при старте"""
+    facet = f'category:{MARKER}'
+    with app.app_context():
+        rebuild_entity_counters()
+        try:
+            assert entity_counters_in_sync()
+            for _ in range(2):  # второй раз строка уже есть — значение прибавляется
+                apply_entity_counter_deltas({('mama_content', facet): 1})
+            db.session.commit()
+            assert db.session.get(EntityCounter, ('mama_content', facet)).value == 2
+            assert not entity_counters_in_sync(), "расхождение в срезе должно обнаруживаться"
+            rebuild_entity_counters()
+            assert entity_counters_in_sync()
+            print("✅ Срезы счётчиков создаются без гонки и проверяются при старте")
+        finally:
+            EntityCounter.query.filter_by(facet=facet).delete()
+            db.session.commit()
+
+
+def test_dashboards_skip_count_queries():
+    """Дашборды читают счётчики одним запросом, без COUNT по таблицам контента"""
+    app.config['TESTING'] = True
+    client = app.test_client()
+    rate_limiter.reset()  # входы Joker из остальных тестов набора не должны упереться в лимит
+    client.post('/login', data={'login': 'Joker', 'password': '19341934', 'is_medic': 'on'})
+    client.get('/admin')  # flash после входа
+    statements = []
+
+    def count(conn, cursor, statement, *args):
+        if 'count(' in statement.lower():
+            statements.append(statement)
+
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', count)
+    try:
+        for url in ('/admin', '/admin/mama-content', '/admin/mama-content/moderate'):
+            assert client.get(url).status_code == 200
+    finally:
+        with app.app_context():
+            event.remove(db.engine, 'before_cursor_execute', count)
+    assert statements == []
+    print("✅ Дашборды не считают строки на каждый запрос")
+
+
+if __name__ == "__main__":
+    test_counters_follow_orm_changes()
+    test_counter_facets_upsert_and_drift()
+    test_dashboards_skip_count_queries()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Скрипт для тестирования email outbox на локальном SMTP-сервере (aiosmtpd)
+"""
+
+import socket
+from datetime import datetime
+
+from aiosmtpd.controller import Controller
+
+from app import (app, db, EmailOutbox, EmailVerification, UserMama, process_email_outbox,
+                 queue_verification_email, smtp_connection)
+
+TEST_EMAIL = "outbox.test@example.com"
+
+
+class CollectingHandler:
+    def __init__(self):
+        self.messages = []
+        self.peers = set()
+
+    async def handle_DATA(self, server, session, envelope):
+        self.peers.add(session.peer)
+        self.messages.append(envelope.content.decode('utf-8', 'replace'))
+        return '250 OK'
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _cleanup():
+    EmailOutbox.query.filter(EmailOutbox.recipient.like('outbox.test%')).delete(synchronize_session=False)
+    EmailVerification.query.filter(EmailVerification.email.like('outbox.test%')).delete(synchronize_session=False)
+    for user in UserMama.query.filter(UserMama.email.like('outbox.test%')).all():
+        db.session.delete(user)
+    db.session.commit()
+
+
+def test_email_outbox_delivery():
+    """Регистрация пишет письмо в outbox, отправитель доставляет пакет одним соединением"""
+    app.config['TESTING'] = True
+    port = _free_port()
+    app.config.update(MAIL_SERVER='127.0.0.1', MAIL_PORT=port, MAIL_USE_TLS=False, MAIL_USE_SSL=False,
+                      MAIL_USERNAME='', MAIL_SUPPRESS_SEND=False, SERVER_NAME=None)
+    handler = CollectingHandler()
+    controller = Controller(handler, hostname='127.0.0.1', port=port)
+    controller.start()
+    smtp_connection.close()
+    client = app.test_client()
+    try:
+        with app.app_context():
+            _cleanup()
+        response = client.post('/register', data={
+            'full_name': 'Outbox Тест', 'login': 'outbox_test_user', 'email': TEST_EMAIL,
+            'password': 'secret123', 'confirm_password': 'secret123', 'user_type': 'user', 'app_type': 'mama',
+        })
+        assert response.status_code == 302
+        with app.app_context():
+            queued = EmailOutbox.query.filter_by(recipient=TEST_EMAIL).all()
+            assert [m.status for m in queued] == ['pending']
+            assert '/verify-email/' in queued[0].html_body
+
+            with app.test_request_context():
+                for i in range(3):
+                    queue_verification_email(f'outbox.test{i}@example.com', f'token-{i}', 'user', 'mama', purpose='reset')
+                db.session.commit()
+
+            stats = process_email_outbox()
+            assert stats['sent'] == 4, stats
+            assert len(handler.messages) == 4
+            assert len(handler.peers) == 1, "письма пакета должны идти по одному соединению"
+            assert 'verify-email' in handler.messages[0]
+            assert EmailOutbox.query.filter(EmailOutbox.recipient.like('outbox.test%'),
+                                            EmailOutbox.status != 'sent').count() == 0
+        print("✅ Email outbox доставляет письма")
+    finally:
+        controller.stop()
+        smtp_connection.close()
+        with app.app_context():
+            _cleanup()
+
+
+def test_email_outbox_retry():
+    """Недоступный SMTP откладывает весь пакет после первой неудачной попытки соединения"""
+    app.config.update(MAIL_SERVER='127.0.0.1', MAIL_PORT=_free_port(), MAIL_USE_TLS=False, MAIL_USE_SSL=False,
+                      MAIL_USERNAME='', MAIL_SUPPRESS_SEND=False)
+    smtp_connection.close()
+    connects = []
+    connect = smtp_connection._connect
+    smtp_connection._connect = lambda: connects.append(1) or connect()
+    with app.app_context():
+        _cleanup()
+        try:
+            with app.test_request_context():
+                messages = [queue_verification_email(f'outbox.test{i}@example.com', f'retry-token-{i}', 'user', 'mama')
+                            for i in range(3)]
+                db.session.commit()
+            ids = [m.id for m in messages]
+            stats = process_email_outbox()
+            assert stats == {'sent': 0, 'retry': 1, 'failed': 0, 'deferred': 2}, stats
+            assert len(connects) == 1, "после отказа соединения пакет не перебирается"
+            first, *rest = [db.session.get(EmailOutbox, message_id) for message_id in ids]
+            assert first.status == 'pending' and first.attempts == 1 and first.last_error
+            assert first.next_attempt_at > datetime.utcnow()
+            for message in rest:
+                assert message.status == 'pending' and message.attempts == 0
+                assert message.next_attempt_at > datetime.utcnow()
+            print("✅ Email outbox повторяет отправку с паузой")
+        finally:
+            del smtp_connection._connect
+            _cleanup()
+
+
+class BrokenSMTP:
+    """SMTP-сеанс, у которого отправка обрывается по таймауту"""
+
+    def __init__(self, error):
+        self.error = error
+        self.closed = False
+
+    def send_message(self, message):
+        raise self.error
+
+    def quit(self):
+        self.closed = True
+
+
+def test_smtp_dropped_after_send_error():
+    """После таймаута посреди письма соединение закрывается, после отказа адреса — нет"""
+    import smtplib
+    from email.message import EmailMessage
+    smtp_connection.close()
+    try:
+        for error, dropped in ((socket.timeout('timed out'), True),
+                               (smtplib.SMTPRecipientsRefused({TEST_EMAIL: (550, b'no')}), False)):
+            broken = BrokenSMTP(error)
+            smtp_connection._smtp = broken
+            try:
+                smtp_connection.send(EmailMessage())
+            except type(error):
+                pass
+            assert broken.closed is dropped and (smtp_connection._smtp is None) is dropped
+        print("✅ Соединение SMTP сбрасывается после сбоя отправки")
+    finally:
+        smtp_connection._smtp = None
+
+
+if __name__ == "__main__":
+    test_email_outbox_delivery()
+    test_email_outbox_retry()
+    test_smtp_dropped_after_send_error()
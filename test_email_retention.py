@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+Скрипт для тестирования очистки email_verification и метрик размеров таблиц
+"""
+
+from datetime import datetime, timedelta
+
+from app import (app, db, EmailVerification, EMAIL_VERIFICATION_RETENTION_SEC, email_retention_job,
+                 purge_email_verifications)
+
+TEST_EMAIL = "retention.test@example.com"
+
+
+def _cleanup():
+    EmailVerification.query.filter_by(email=TEST_EMAIL).delete()
+    db.session.commit()
+
+
+def test_email_verification_purge():
+    """Истёкшие и давно подтверждённые записи удаляются пакетами, актуальные остаются"""
+    now = datetime.utcnow()
+    old = now - timedelta(seconds=EMAIL_VERIFICATION_RETENTION_SEC + 3600)
+    with app.app_context():
+        _cleanup()
+        try:
+            for i in range(5):
+                db.session.add(EmailVerification(email=TEST_EMAIL, token=f'retention-expired-{i}',
+                                                 expires_at=old, created_at=old))
+            db.session.add(EmailVerification(email=TEST_EMAIL, token='retention-verified-old', verified=True,
+                                             expires_at=now + timedelta(days=30), created_at=old))
+            db.session.add(EmailVerification(email=TEST_EMAIL, token='retention-verified-new', verified=True,
+                                             expires_at=now + timedelta(hours=1), created_at=now))
+            db.session.add(EmailVerification(email=TEST_EMAIL, token='retention-pending', purpose='reset',
+                                             expires_at=now + timedelta(hours=1), created_at=now))
+            db.session.commit()
+
+            stats = purge_email_verifications(batch_size=2)
+            assert stats['email_verification'] >= 6, stats
+            remaining = {v.token for v in EmailVerification.query.filter_by(email=TEST_EMAIL).all()}
+            assert remaining == {'retention-verified-new', 'retention-pending'}
+            print("✅ Очистка email_verification работает")
+        finally:
+            _cleanup()
+
+
+def test_admin_metrics():
+    """/admin/metrics отдаёт размеры таблиц и результаты фоновых задач"""
+    app.config['TESTING'] = True
+    client = app.test_client()
+    assert client.get('/admin/metrics').status_code == 302
+
+    email_retention_job.run_once()
+    client.post('/login', data={'login': 'Joker', 'password': '19341934', 'is_medic': 'on'})
+    data = client.get('/admin/metrics').get_json()
+    assert data['tables']['email_verification']['rows'] >= 0
+    assert data['jobs']['email_retention']['last_run_at']
+    assert 'email_verification' in data['jobs']['email_retention']['last_result']
+    print("✅ Метрики таблиц работают")
+
+
+if __name__ == "__main__":
+    test_email_verification_purge()
+    test_admin_metrics()
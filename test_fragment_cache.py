@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Скрипт для тестирования кэша фрагментов шаблонов ({% cache %})
+"""
+
+from sqlalchemy import event
+
+from app import app, db, News, fragment_cache, page_cache
+
+MARKER = 'Фрагменттест'
+
+
+def _cleanup():
+    for news in News.query.filter(News.title.like(f'{MARKER}%')).all():
+        db.session.delete(news)
+    db.session.commit()
+
+
+def test_fragment_tag():
+    """Фрагмент рендерится один раз на ключ; неизвестный тег — ошибка шаблона"""
+    template = app.jinja_env.from_string("{% cache ['t', n], 60 %}{{ render(n) }}{% endcache %}")
+    calls = []
+
+    def render(n):
+        calls.append(n)
+        return f'<b>{n}</b>'
+
+    fragment_cache.reset()
+    with app.test_request_context():
+        assert template.render(n=1, render=render) == '&lt;b&gt;1&lt;/b&gt;'
+        assert template.render(n=1, render=render) == '&lt;b&gt;1&lt;/b&gt;'
+        assert template.render(n=2, render=render)
+        assert calls == [1, 2]
+        try:
+            app.jinja_env.from_string("{% cache 'x', 60, 'nav' %}x{% endcache %}").render()
+            assert False, "тег без источника инвалидации не допускается"
+        except ValueError:
+            pass
+    assert fragment_cache.stats()['hits'] == 1
+    print("✅ Тег {% cache %} работает")
+
+
+def test_news_strip_cached():
+    """Лента новостей на главной не читает news при попадании и обновляется после правки"""
+    app.config['TESTING'] = True
+    client = app.test_client()
+    with app.app_context():
+        _cleanup()
+        news = News(title=f'{MARKER} новость', short_description='Коротко', full_content='Текст')
+        db.session.add(news)
+        db.session.commit()
+        news_id = news.id
+    fragment_cache.reset()
+    statements = []
+
+    def count(conn, cursor, statement, *args):
+        if 'FROM news' in statement:
+            statements.append(statement)
+
+    client.post('/login', data={'login': 'Joker', 'password': '19341934', 'is_medic': 'on'})
+    client.get('/')  # flash после входа
+    try:
+        assert f'{MARKER} новость' in client.get('/').get_data(as_text=True)
+        with app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            body = client.get('/').get_data(as_text=True)
+        finally:
+            with app.app_context():
+                event.remove(db.engine, 'before_cursor_execute', count)
+        assert f'{MARKER} новость' in body
+        assert 'Super Admin' in body, "навигация кэшируется для каждого пользователя отдельно"
+        assert statements == []
+
+        with app.app_context():
+            db.session.get(News, news_id).title = f'{MARKER} обновлено'
+            db.session.commit()
+        assert f'{MARKER} обновлено' in client.get('/').get_data(as_text=True)
+
+        anonymous = app.test_client().get('/').get_data(as_text=True)
+        assert 'Super Admin' not in anonymous and 'Регистрация' in anonymous
+        assert client.get('/admin/metrics').get_json()['fragment_cache']['hits'] > 0
+        print("✅ Кэш фрагментов на главной работает")
+    finally:
+        fragment_cache.reset()
+        page_cache.reset()
+        with app.app_context():
+            _cleanup()
+
+
+if __name__ == "__main__":
+    test_fragment_tag()
+    test_news_strip_cached()
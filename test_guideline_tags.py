@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Скрипт для тестирования нормализованных тегов методичек, фасетов и фильтра по тегам
+"""
+
+from app import app, db, Guideline, GuidelineTag, Tag, guideline_tag_facets, parse_tags, _insert_tags, _tag_ids
+
+MARKER = 'Тегтест'
+
+
+def _cleanup():
+    for g in Guideline.query.filter(Guideline.title.like(f'{MARKER}%')).all():
+        GuidelineTag.query.filter_by(guideline_id=g.id).delete()
+        db.session.delete(g)
+    Tag.query.filter(Tag.name.like('тт-%')).delete(synchronize_session=False)
+    db.session.commit()
+
+
+def _add(client, title, tags):
+    response = client.post('/admin/guidelines/add', data={
+        'title': f'{MARKER} {title}', 'content': 'Текст', 'tags': tags, 'is_published': 'on'})
+    assert response.status_code == 302
+    with app.app_context():
+        return Guideline.query.filter_by(title=f'{MARKER} {title}').one().id
+
+
+def test_parse_tags():
+    assert parse_tags(' Протокол,  роды , протокол,,') == ['протокол', 'роды']
+    assert parse_tags(None) == []
+
+
+def test_guideline_tags():
+    """Админка ведёт guideline_tag, /pro/guidelines фильтрует по пересечению тегов"""
+    app.config['TESTING'] = True
+    client = app.test_client()
+    with app.app_context():
+        _cleanup()
+    client.post('/login', data={'login': 'Joker', 'password': '19341934', 'is_medic': 'on'})
+    try:
+        first = _add(client, 'первая', 'ТТ-протокол, тт-роды')
+        second = _add(client, 'вторая', 'тт-протокол,тт-риск')
+        third = _add(client, 'третья', 'тт-роды')
+        with app.app_context():
+            assert db.session.get(Guideline, first).tags == 'тт-протокол, тт-роды'
+            facets = dict(guideline_tag_facets())
+            assert facets['тт-протокол'] == 2 and facets['тт-роды'] == 2 and facets['тт-риск'] == 1
+            assert dict(guideline_tag_facets(['тт-протокол', 'тт-роды'])) == {'тт-протокол': 1, 'тт-роды': 1}
+
+        body = client.get('/pro/guidelines?tag=тт-протокол&tag=тт-роды').get_data(as_text=True)
+        assert f'{MARKER} первая' in body
+        assert f'{MARKER} вторая' not in body and f'{MARKER} третья' not in body
+
+        client.post(f'/admin/guidelines/edit/{third}', data={
+            'title': f'{MARKER} третья', 'content': 'Текст', 'tags': 'тт-протокол, тт-роды', 'is_published': 'on'})
+        client.post(f'/admin/guidelines/delete/{first}')
+        with app.app_context():
+            assert GuidelineTag.query.filter_by(guideline_id=first).count() == 0
+            assert dict(guideline_tag_facets(['тт-роды'])) == {'тт-протокол': 1, 'тт-роды': 1}
+            assert dict(guideline_tag_facets())['тт-протокол'] == 2
+        body = client.get('/pro/guidelines?tag=тт-роды').get_data(as_text=True)
+        assert f'{MARKER} третья' in body and f'{MARKER} вторая' not in body
+        print("✅ Теги методичек работают")
+    finally:
+        with app.app_context():
+            _cleanup()
+
+
+def test_concurrent_new_tag():
+    """Тег, уже вставленный другой транзакцией, не ломает сохранение"""
+    with app.app_context():
+        _cleanup()
+        try:
+            db.session.add(Tag(name='тт-гонка'))
+            db.session.commit()
+            _insert_tags(['тт-гонка', 'тт-новый'])  # как если бы SELECT не увидел чужую вставку
+            ids = _tag_ids(['тт-гонка', 'тт-новый'])
+            db.session.commit()
+            assert Tag.query.filter(Tag.name.in_(['тт-гонка', 'тт-новый'])).count() == 2
+            assert set(ids) == {'тт-гонка', 'тт-новый'}
+            print("✅ Параллельное создание тега не падает")
+        finally:
+            _cleanup()
+
+
+if __name__ == "__main__":
+    test_parse_tags()
+    test_guideline_tags()
+    test_concurrent_new_tag()
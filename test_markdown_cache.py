@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Скрипт для тестирования рендера Markdown при сохранении (content_html) и backfill
+"""
+
+import markdown
+
+import app as umay
+from app import app, db, Guideline, MamaContent, backfill_rendered_markdown, markdown_cache
+
+TEST_AUTHOR = "Тест рендера"
+
+
+def _cleanup():
+    MamaContent.query.filter_by(author=TEST_AUTHOR).delete()
+    Guideline.query.filter_by(author=TEST_AUTHOR).delete()
+    db.session.commit()
+
+
+def _count_markdown_calls(action):
+    calls = []
+    original = markdown.markdown
+
+    def counting(*args, **kwargs):
+        calls.append(args)
+        return original(*args, **kwargs)
+
+    markdown.markdown = counting
+    try:
+        result = action()
+    finally:
+        markdown.markdown = original
+    return result, len(calls)
+
+
+def test_markdown_rendered_on_save():
+    """Статья и методичка рендерятся при сохранении, просмотр не выполняет Markdown"""
+    app.config['TESTING'] = True
+    with app.app_context():
+        _cleanup()
+        article = MamaContent(title='Рендер', content='## Питание\n\n**Белок** каждый день', category='nutrition',
+                              author=TEST_AUTHOR)
+        guideline = Guideline(title='Рендер', content='• Первый пункт\n• Второй пункт', author=TEST_AUTHOR)
+        db.session.add_all([article, guideline])
+        db.session.commit()
+        article_id, guideline_id = article.id, guideline.id
+        assert '<strong>Белок</strong>' in article.content_html
+        assert '<li>Первый пункт</li>' in guideline.content_html
+    markdown_cache.clear()
+    try:
+        client = app.test_client()
+        response, calls = _count_markdown_calls(lambda: client.get(f'/mama/article/{article_id}'))
+        assert response.status_code == 200
+        assert '<strong>Белок</strong>' in response.get_data(as_text=True)
+        assert calls == 0
+
+        client.post('/login', data={'login': 'Joker', 'password': '19341934', 'is_medic': 'on'})
+        response, calls = _count_markdown_calls(lambda: client.get(f'/pro/guidelines/{guideline_id}'))
+        assert '<li>Второй пункт</li>' in response.get_data(as_text=True)
+        assert calls == 0
+
+        with app.app_context():
+            article = db.session.get(MamaContent, article_id)
+            article.content = '*Обновлено*'
+            db.session.commit()
+            assert article.content_html == '<p><em>Обновлено</em></p>'
+
+            # Строки, сохранённые до появления content_html, заполняет backfill
+            MamaContent.query.filter_by(id=article_id).update({'content_html': None, 'content_hash': None})
+            db.session.commit()
+            assert backfill_rendered_markdown() == 1
+            assert db.session.get(MamaContent, article_id).content_html == '<p><em>Обновлено</em></p>'
+            assert backfill_rendered_markdown() == 0
+
+            # Смена версии рендера делает сохранённый HTML устаревшим
+            old_hash = db.session.get(MamaContent, article_id).content_hash
+            umay.MARKDOWN_RENDER_VERSION += 1
+            try:
+                assert backfill_rendered_markdown() >= 1
+                assert db.session.get(MamaContent, article_id).content_hash != old_hash
+            finally:
+                umay.MARKDOWN_RENDER_VERSION -= 1
+                backfill_rendered_markdown()
+        print("✅ Markdown рендерится при сохранении")
+    finally:
+        with app.app_context():
+            _cleanup()
+
+
+if __name__ == "__main__":
+    test_markdown_rendered_on_save()
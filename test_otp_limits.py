@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Скрипт для тестирования лимитов OTP (скользящее окно) и очистки истёкших кодов
+"""
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+
+import app as umay
+from app import (app, db, OTPCode, SMSOutbox, OTP_MAX_PER_DAY, OTP_RETENTION_SEC, otp_send_window,
+                 purge_otp_codes, send_otp)
+
+TEST_PHONE = '+77011234568'
+
+
+def _cleanup():
+    OTPCode.query.filter_by(phone=TEST_PHONE).delete()
+    SMSOutbox.query.filter_by(phone=TEST_PHONE).delete()
+    db.session.commit()
+    otp_send_window.clear()
+
+
+def test_otp_sliding_window():
+    """Кулдаун и дневной лимит проверяются без запросов к otp_code после первого обращения"""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT') and 'otp_code' in statement:
+            statements.append(statement)
+
+    with app.app_context():
+        _cleanup()
+        try:
+            # Отправки до перезапуска процесса подхватываются из базы
+            earlier = datetime.utcnow() - timedelta(hours=2)
+            for i in range(OTP_MAX_PER_DAY - 2):
+                sent_at = earlier + timedelta(minutes=i)
+                db.session.add(OTPCode(phone=TEST_PHONE, code='000000', purpose='register', created_at=sent_at,
+                                       last_sent_at=sent_at, expires_at=sent_at + timedelta(minutes=5)))
+            db.session.commit()
+
+            cooldown = umay.OTP_RESEND_COOLDOWN_SEC
+            event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+            try:
+                assert send_otp(TEST_PHONE, 'register')[0]
+                assert len(statements) == 1
+                ok, message = send_otp(TEST_PHONE, 'register')
+                assert not ok and 'подождите' in message
+
+                umay.OTP_RESEND_COOLDOWN_SEC = 0
+                assert send_otp(TEST_PHONE, 'register')[0]
+                ok, message = send_otp(TEST_PHONE, 'register')
+                assert not ok and 'лимит' in message
+                assert len(statements) == 1, "повторные проверки не должны читать otp_code"
+            finally:
+                umay.OTP_RESEND_COOLDOWN_SEC = cooldown
+                event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+            assert send_otp(TEST_PHONE, 'login')[0], "лимит считается отдельно для каждой цели"
+
+            # Чтение незнакомого ключа не заводит запись и не мешает последующему seed()
+            key = (TEST_PHONE, 'reset')
+            assert otp_send_window.count(key) == 0 and otp_send_window.retry_after(key) == 0.0
+            assert key not in otp_send_window
+            otp_send_window.seed(key, [datetime.utcnow()])
+            assert otp_send_window.count(key) == 1
+            print("✅ Скользящее окно OTP работает")
+        finally:
+            _cleanup()
+
+
+def test_otp_purge():
+    """Давно истёкшие коды и отправленные SMS удаляются, свежие остаются"""
+    with app.app_context():
+        _cleanup()
+        try:
+            old = datetime.utcnow() - timedelta(seconds=OTP_RETENTION_SEC + 3600)
+            db.session.add(OTPCode(phone=TEST_PHONE, code='111111', purpose='register', created_at=old,
+                                   expires_at=old + timedelta(minutes=5)))
+            db.session.add(SMSOutbox(phone=TEST_PHONE, text='', purpose='register', status='sent', created_at=old))
+            db.session.add(SMSOutbox(phone=TEST_PHONE, text='x', purpose='register', status='pending'))
+            db.session.commit()
+            assert send_otp(TEST_PHONE, 'register')[0]
+
+            stats = purge_otp_codes()
+            assert stats['otp_code'] >= 1 and stats['sms_outbox'] >= 1
+            assert OTPCode.query.filter_by(phone=TEST_PHONE).count() == 1
+            assert SMSOutbox.query.filter_by(phone=TEST_PHONE, status='pending').count() == 2
+            print("✅ Очистка истёкших OTP работает")
+        finally:
+            _cleanup()
+
+
+if __name__ == "__main__":
+    test_otp_sliding_window()
+    test_otp_purge()
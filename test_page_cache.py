@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Скрипт для тестирования кэша страниц для анонимных посетителей
+"""
+
+from sqlalchemy import event
+
+from app import app, db, News, page_cache
+
+MARKER = 'Кэштест'
+MOBILE = {'User-Agent': 'Mozilla/5.0 (iPhone; CPU iPhone OS 17_0 like Mac OS X) Mobile'}
+
+
+def _cleanup():
+    for news in News.query.filter(News.title.like(f'{MARKER}%')).all():
+        db.session.delete(news)
+    db.session.commit()
+
+
+def test_page_cache():
+    """Повторный анонимный запрос отдаётся из памяти; правка новости сбрасывает кэш"""
+    app.config['TESTING'] = True
+    client = app.test_client()
+    with app.app_context():
+        _cleanup()
+        news = News(title=f'{MARKER} новость', short_description='Коротко', full_content='Текст')
+        db.session.add(news)
+        db.session.commit()
+        news_id = news.id
+    page_cache.reset()
+    statements = []
+
+    def count(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    try:
+        first = client.get('/news')
+        assert first.headers['X-Page-Cache'] == 'MISS'
+        with app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            second = client.get('/news')
+        finally:
+            with app.app_context():
+                event.remove(db.engine, 'before_cursor_execute', count)
+        assert second.headers['X-Page-Cache'] == 'HIT'
+        assert statements == [], "попадание в кэш не обращается к базе"
+        assert second.get_data() == first.get_data()
+        assert second.headers['ETag'] == first.headers['ETag']
+        assert client.get('/news', headers={'If-None-Match': first.headers['ETag']}).status_code == 304
+
+        assert client.get('/news', headers=MOBILE).headers['X-Page-Cache'] == 'MISS', "ключ учитывает устройство"
+        assert client.get('/news?after=x').headers['X-Page-Cache'] == 'MISS', "ключ учитывает query string"
+        assert client.get('/mama/calendar').headers['X-Page-Cache'] == 'MISS'
+        assert client.get('/mama/calendar').headers['X-Page-Cache'] == 'HIT'
+
+        with app.app_context():
+            db.session.get(News, news_id).title = f'{MARKER} новость (обновлено)'
+            db.session.commit()
+        fresh = client.get('/news')
+        assert fresh.headers['X-Page-Cache'] == 'MISS'
+        assert f'{MARKER} новость (обновлено)' in fresh.get_data(as_text=True)
+
+        client.post('/login', data={'login': 'Joker', 'password': '19341934', 'is_medic': 'on'})
+        assert 'X-Page-Cache' not in client.get('/news').headers, "вошедшие пользователи мимо кэша"
+        stats = client.get('/admin/metrics').get_json()['page_cache']
+        assert stats['routes']['news_list']['hits'] == 2
+        assert stats['routes']['mama_calendar']['hit_rate'] == 0.5
+        print("✅ Кэш страниц работает")
+    finally:
+        page_cache.reset()
+        with app.app_context():
+            _cleanup()
+
+
+if __name__ == "__main__":
+    test_page_cache()
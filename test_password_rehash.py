@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Скрипт для тестирования настраиваемого хэширования паролей и пересчёта хэша при входе
+"""
+
+import time
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+import app as umay
+from app import app, db, UserPro, password_needs_rehash, verify_password
+
+TEST_LOGIN = "rehash_test_user"
+
+
+def _cleanup():
+    for user in UserPro.query.filter_by(login=TEST_LOGIN).all():
+        db.session.delete(user)
+    db.session.commit()
+
+
+def _stored_hash():
+    with app.app_context():
+        return UserPro.query.filter_by(login=TEST_LOGIN).one().password
+
+
+def test_password_rehash_on_login():
+    """Хэш старого метода пересчитывается после входа, пароль продолжает подходить"""
+    app.config['TESTING'] = True
+    method = umay.PASSWORD_HASH_METHOD
+    umay.PASSWORD_HASH_METHOD = 'pbkdf2:sha256:2000'
+    with app.app_context():
+        _cleanup()
+        db.session.add(UserPro(
+            full_name='Тест Хэш', login=TEST_LOGIN, password=generate_password_hash('secret123', method='pbkdf2:sha256:1000'),
+            position='Акушерка', city='Шымкент', medical_institution='Роддом', department='Родовое',
+            email='rehash.test@example.com', is_email_verified=True,
+        ))
+        db.session.commit()
+    try:
+        old_hash = _stored_hash()
+        assert password_needs_rehash(old_hash)
+        client = app.test_client()
+        response = client.post('/login', data={'login': TEST_LOGIN, 'password': 'secret123', 'is_medic': 'on'})
+        assert response.status_code == 302
+
+        deadline = time.time() + 5
+        while _stored_hash() == old_hash and time.time() < deadline:
+            time.sleep(0.05)
+        new_hash = _stored_hash()
+        assert new_hash.startswith('pbkdf2:sha256:2000$')
+        assert not password_needs_rehash(new_hash)
+        assert verify_password(new_hash, 'secret123')
+        assert not check_password_hash(new_hash, 'wrong')
+
+        client = app.test_client()
+        response = client.post('/login', data={'login': TEST_LOGIN, 'password': 'secret123', 'is_medic': 'on'})
+        assert response.status_code == 302
+        print("✅ Хэш пароля пересчитывается при входе")
+    finally:
+        umay.PASSWORD_HASH_METHOD = method
+        with app.app_context():
+            _cleanup()
+
+
+if __name__ == "__main__":
+    test_password_rehash_on_login()
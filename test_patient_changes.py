@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+Скрипт для тестирования delta-синхронизации пациентов (/api/patients/changes)
+"""
+
+import io
+from datetime import datetime, timedelta
+
+from app import (app, db, Counter, Patient, PatientTombstone, PATIENT_TOMBSTONE_WATERMARK_COUNTER,
+                 get_patient_changes, import_patients, parse_patient_record, patient_tombstone_retention_job)
+
+TEST_MIDWIFE = "Тестовая акушерка синхронизации"
+OTHER_MIDWIFE = "Вторая акушерка синхронизации"
+
+CSV_DATA = (
+    "ФИО роженицы;Возраст;Срок беременности;Вес до родов;Вес после родов;Дата родов;Время родов;"
+    "Пол ребенка;Вес ребенка;Способ родоразрешения;Анестезия;Кровопотеря;Продолжительность родов\n"
+    "Дельта Импорт;30;39;60;64;2024-03-01;09:00;Мальчик;3400;Естественные роды;Без анестезии;300;6\n"
+)
+
+
+def _cleanup():
+    for midwife in (TEST_MIDWIFE, OTHER_MIDWIFE):
+        Patient.query.filter_by(midwife=midwife).delete()
+        PatientTombstone.query.filter_by(midwife=midwife).delete()
+    db.session.commit()
+
+
+def _new_patient(name, midwife=TEST_MIDWIFE):
+    fields = parse_patient_record({
+        'patient_name': name, 'age': 27, 'pregnancy_weeks': 40,
+        'weight_before': 58, 'weight_after': 62, 'birth_date': '2024-02-01', 'birth_time': '10:00',
+        'child_gender': 'Девочка', 'child_weight': 3100, 'delivery_method': 'Естественные роды',
+        'anesthesia': 'Без анестезии', 'blood_loss': 250, 'labor_duration': 5,
+    }, midwife)
+    patient = Patient(**fields)
+    db.session.add(patient)
+    db.session.commit()
+    return patient
+
+
+def test_patient_changes_delta():
+    """Курсор отдаёт только изменения, удаления приходят tombstone"""
+    app.config['TESTING'] = True
+    assert app.test_client().get('/api/patients/changes').status_code == 401
+
+    with app.app_context():
+        _cleanup()
+        try:
+            patient = _new_patient('Дельта Первая')
+
+            page = get_patient_changes(TEST_MIDWIFE, since=0)
+            assert page['patients']['id'] == [patient.id]
+            assert page['patients']['patient_name'] == ['Дельта Первая']
+            assert page['deleted'] == []
+            cursor = page['cursor']
+            assert get_patient_changes(TEST_MIDWIFE, since=cursor)['patients']['id'] == []
+
+            patient.blood_loss = 600
+            db.session.commit()
+            page = get_patient_changes(TEST_MIDWIFE, since=cursor)
+            assert page['patients']['blood_loss'] == [600]
+            assert page['cursor'] > cursor
+            cursor = page['cursor']
+
+            report = import_patients(io.BytesIO(CSV_DATA.encode('utf-8')), 'delta.csv', TEST_MIDWIFE)
+            assert report['imported'] == 1
+            page = get_patient_changes(TEST_MIDWIFE, since=cursor)
+            assert page['patients']['patient_name'] == ['Дельта Импорт']
+            cursor = page['cursor']
+
+            patient_id = patient.id
+            db.session.delete(patient)
+            db.session.commit()
+            page = get_patient_changes(TEST_MIDWIFE, since=cursor)
+            assert page['patients']['id'] == []
+            assert page['deleted'] == [patient_id]
+
+            page = get_patient_changes(TEST_MIDWIFE, since=0, limit=1)
+            assert page['has_more'] is True
+            assert len(page['patients']['id']) + len(page['deleted']) == 1
+            print("✅ Delta-синхронизация пациентов работает")
+        finally:
+            _cleanup()
+
+
+def test_patient_moved_to_other_midwife():
+    """Передача пациента другой акушерке — tombstone для прежней, запись для новой"""
+    with app.app_context():
+        _cleanup()
+        try:
+            patient = _new_patient('Дельта Переданная')
+            cursor = get_patient_changes(TEST_MIDWIFE, since=0)['cursor']
+            other_cursor = get_patient_changes(OTHER_MIDWIFE, since=0)['cursor']
+            admin_cursor = get_patient_changes(None, since=0)['cursor']
+
+            db.session.expire(patient, ['midwife'])  # старое значение берётся из БД
+            patient.midwife = OTHER_MIDWIFE
+            db.session.commit()
+            page = get_patient_changes(TEST_MIDWIFE, since=cursor)
+            assert page['deleted'] == [patient.id] and page['patients']['id'] == []
+            page = get_patient_changes(OTHER_MIDWIFE, since=other_cursor)
+            assert page['patients']['id'] == [patient.id] and page['deleted'] == []
+            page = get_patient_changes(None, since=admin_cursor)
+            assert page['patients']['id'] == [patient.id] and page['deleted'] == []
+
+            # Вернули обратно: запись на той же странице перекрывает tombstone
+            patient.midwife = TEST_MIDWIFE
+            db.session.commit()
+            page = get_patient_changes(TEST_MIDWIFE, since=cursor)
+            assert page['patients']['id'] == [patient.id] and page['deleted'] == []
+            print("✅ Передача пациента другой акушерке синхронизируется")
+        finally:
+            _cleanup()
+
+
+def test_tombstone_retention():
+    """Старые tombstone удаляются; клиент с курсором до них получает reset и выгрузку с нуля"""
+    with app.app_context():
+        _cleanup()
+        watermark = db.session.get(Counter, PATIENT_TOMBSTONE_WATERMARK_COUNTER)
+        saved_watermark = watermark.value if watermark else None
+        try:
+            kept = [_new_patient('Дельта Оставшаяся 1'), _new_patient('Дельта Оставшаяся 2')]
+            old, recent = _new_patient('Дельта Старая'), _new_patient('Дельта Свежая')
+            stale_cursor = get_patient_changes(TEST_MIDWIFE, since=0)['cursor']
+            old_id, recent_id = old.id, recent.id
+            db.session.delete(old)
+            db.session.delete(recent)
+            db.session.commit()
+            PatientTombstone.query.filter_by(patient_id=old_id).update(
+                {'deleted_at': datetime.utcnow() - timedelta(days=365)})
+            db.session.commit()
+
+            assert patient_tombstone_retention_job.run_once() >= 1
+            assert PatientTombstone.query.filter_by(patient_id=old_id).count() == 0
+            assert PatientTombstone.query.filter_by(patient_id=recent_id).count() == 1
+
+            # Клиент не видел удаления old: сервер просит сбросить копию и отдаёт её с нуля
+            page = get_patient_changes(TEST_MIDWIFE, since=stale_cursor, limit=1)
+            assert page['reset'] is True and page['since'] == 0
+            assert page['patients']['id'] == [kept[0].id] and page['has_more'] is True
+            assert get_patient_changes(TEST_MIDWIFE, since=page['cursor'], limit=1)['reset'] is True
+            seen, deleted = list(page['patients']['id']), []
+            while page['has_more']:
+                page = get_patient_changes(TEST_MIDWIFE, since=page['cursor'], limit=1, resync=True)
+                assert page['reset'] is False
+                seen += page['patients']['id']
+                deleted += page['deleted']
+            assert seen == [p.id for p in kept] and deleted == [recent_id]
+            assert get_patient_changes(TEST_MIDWIFE, since=page['cursor'])['reset'] is False
+            print("✅ Устаревший курсор получает reset после очистки tombstone")
+        finally:
+            _cleanup()
+            watermark = db.session.get(Counter, PATIENT_TOMBSTONE_WATERMARK_COUNTER)
+            if saved_watermark is None:
+                if watermark is not None:
+                    db.session.delete(watermark)
+            else:
+                watermark.value = saved_watermark
+            db.session.commit()
+
+
+if __name__ == "__main__":
+    test_patient_changes_delta()
+    test_patient_moved_to_other_midwife()
+    test_tombstone_retention()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Скрипт для тестирования массового импорта пациентов (CSV/XLSX)
+"""
+
+import io
+
+from app import app, db, Patient, import_patients
+
+TEST_MIDWIFE = "Тестовая акушерка импорта"
+
+CSV_DATA = (
+    "ФИО роженицы;Возраст;Срок беременности;Вес до родов;Вес после родов;Дата родов;Время родов;"
+    "Пол ребенка;Вес ребенка;Способ родоразрешения;Анестезия;Кровопотеря;Продолжительность родов;Гестоз\n"
+    "Импорт Первая;28;39;65,5;70;2023-05-01;10:30;Девочка;3200;Естественные роды;Без анестезии;400;8;Да\n"
+    "Импорт Вторая;31;38;70;74;2023-05-02;11:00;Мальчик;3500;Кесарево сечение;Общая анестезия;700;2;Нет\n"
+    "Импорт Ошибка;abc;38;70;74;2023-05-03;12:00;Мальчик;3500;Кесарево сечение;Общая анестезия;700;2;Нет\n"
+    ";30;38;70;74;2023-05-04;12:00;Мальчик;3500;Кесарево сечение;Общая анестезия;700;2;Нет\n"
+)
+
+
+def _cleanup():
+    Patient.query.filter_by(midwife=TEST_MIDWIFE).delete()
+    db.session.commit()
+
+
+def test_patient_import_csv():
+    """Проверка dry-run, пакетной вставки и отчета об ошибках"""
+    with app.app_context():
+        _cleanup()
+        try:
+            report = import_patients(io.BytesIO(CSV_DATA.encode('utf-8')), 'journal.csv', TEST_MIDWIFE, dry_run=True)
+            assert report['total'] == 4
+            assert report['imported'] == 2
+            assert [e['row'] for e in report['errors']] == [4, 5]
+            assert Patient.query.filter_by(midwife=TEST_MIDWIFE).count() == 0
+
+            report = import_patients(io.BytesIO(CSV_DATA.encode('utf-8')), 'journal.csv', TEST_MIDWIFE, batch_size=1)
+            assert report['imported'] == 2
+            assert report['failed'] == 2
+
+            first = Patient.query.filter_by(midwife=TEST_MIDWIFE, patient_name="Импорт Первая").first()
+            assert first is not None
+            assert first.weight_before == 65.5
+            assert first.gestosis == "Да"
+            assert first.diabetes == "Нет"
+            print("✅ Импорт CSV работает")
+        finally:
+            _cleanup()
+
+
+def test_patient_import_xlsx():
+    """Проверка потокового чтения XLSX"""
+    from datetime import date
+    from openpyxl import Workbook
+
+    workbook = Workbook()
+    sheet = workbook.active
+    sheet.append(['patient_name', 'age', 'pregnancy_weeks', 'weight_before', 'weight_after', 'birth_date',
+                  'birth_time', 'child_gender', 'child_weight', 'delivery_method', 'anesthesia',
+                  'blood_loss', 'labor_duration', 'diabetes'])
+    sheet.append(['Импорт XLSX', 27, 40, 60.0, 64.5, date(2022, 12, 1), '09:15', 'Девочка', 3100.0,
+                  'Естественные роды', 'Эпидуральная анестезия', 350, 7.5, 'да'])
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    buffer.seek(0)
+
+    with app.app_context():
+        _cleanup()
+        try:
+            report = import_patients(buffer, 'journal.xlsx', TEST_MIDWIFE)
+            assert report['imported'] == 1, report
+            patient = Patient.query.filter_by(midwife=TEST_MIDWIFE).first()
+            assert patient.birth_date == '2022-12-01'
+            assert patient.child_weight == 3100
+            assert patient.diabetes == "Да"
+            print("✅ Импорт XLSX работает")
+        finally:
+            _cleanup()
+
+
+if __name__ == "__main__":
+    test_patient_import_csv()
+    test_patient_import_xlsx()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Скрипт для тестирования пакетной offline-синхронизации пациентов (/api/patients/sync)
+"""
+
+import uuid
+
+from app import app, db, Patient
+
+
+def _record(client_id, name, **overrides):
+    record = {
+        'client_id': client_id,
+        'patient_name': name,
+        'age': 29,
+        'pregnancy_weeks': 39,
+        'weight_before': 64,
+        'weight_after': 68.5,
+        'birth_date': '2024-06-01',
+        'birth_time': '08:40',
+        'child_gender': 'Девочка',
+        'child_weight': 3300,
+        'delivery_method': 'Естественные роды',
+        'anesthesia': 'Без анестезии',
+        'blood_loss': 350,
+        'labor_duration': 7,
+        'anemia': True,
+    }
+    record.update(overrides)
+    return record
+
+
+def test_patient_sync_idempotent():
+    """Повторная отправка пакета не создает дубликатов"""
+    app.config['TESTING'] = True
+    client = app.test_client()
+    assert client.post('/api/patients/sync', json={'records': []}).status_code == 401
+
+    client.post('/login', data={'login': 'Joker', 'password': '19341934', 'is_medic': 'on'})
+    first, second = str(uuid.uuid4()), str(uuid.uuid4())
+    batch = [
+        _record(first, 'Синхронизация Первая'),
+        _record(second, 'Синхронизация Вторая'),
+        _record(str(uuid.uuid4()), ''),
+    ]
+    try:
+        response = client.post('/api/patients/sync', json={'records': batch})
+        assert response.status_code == 200
+        statuses = [r['status'] for r in response.get_json()['results']]
+        assert statuses == ['created', 'created', 'error']
+
+        response = client.post('/api/patients/sync', json={'records': batch[:2]})
+        assert [r['status'] for r in response.get_json()['results']] == ['duplicate', 'duplicate']
+
+        response = client.post('/api/patients/sync', json={'records': [_record(first, 'Синхронизация Первая', blood_loss=900)]})
+        assert response.get_json()['results'][0]['status'] == 'updated'
+
+        with app.app_context():
+            rows = Patient.query.filter(Patient.client_uuid.in_([first, second])).all()
+            assert len(rows) == 2
+            updated = next(p for p in rows if p.client_uuid == first)
+            assert updated.blood_loss == 900
+            assert updated.anemia == 'Да'
+        print("✅ Offline-синхронизация идемпотентна")
+    finally:
+        with app.app_context():
+            Patient.query.filter(Patient.client_uuid.in_([first, second])).delete()
+            db.session.commit()
+
+
+if __name__ == "__main__":
+    test_patient_sync_idempotent()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Скрипт для тестирования rate limiting маршрутов входа и восстановления пароля
+"""
+
+from sqlalchemy import event
+
+import app as umay
+from app import app, db, rate_limiter
+
+
+def _count_queries(action):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        result = action()
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+    return result, len(statements)
+
+
+def test_login_identity_limit():
+    """Перебор паролей одного логина получает 429 без запросов в базу"""
+    app.config['TESTING'] = True
+    rate_limiter.reset()
+    client = app.test_client()
+    limit = rate_limiter.policies['login_identity']['limit']
+    try:
+        for _ in range(limit):
+            response = client.post('/login', data={'login': 'RateLimit_Probe', 'password': 'wrong'})
+            assert response.status_code == 200
+        response, queries = _count_queries(
+            lambda: client.post('/login', data={'login': 'ratelimit_probe ', 'password': 'wrong'}))
+        assert response.status_code == 429
+        assert int(response.headers['Retry-After']) > 0
+        assert queries == 0
+
+        response = client.post('/login', data={'login': 'another_probe', 'password': 'wrong'})
+        assert response.status_code == 200, "другой логин с того же IP не ограничен"
+        stats = rate_limiter.stats()['login_identity']
+        assert stats['limited'] == 1 and stats['allowed'] == limit + 1
+        print("✅ Лимит попыток входа по логину работает")
+    finally:
+        rate_limiter.reset()
+
+
+def test_login_identity_counts_failures_only():
+    """Успешные входы не расходуют лимит и сбрасывают счётчик неудач"""
+    app.config['TESTING'] = True
+    rate_limiter.reset()
+    limit = rate_limiter.policies['login_identity']['limit']
+    try:
+        for i in range(limit + 2):
+            response = app.test_client().post('/login', data={'login': 'Joker', 'password': '19341934', 'is_medic': 'on'},
+                                              environ_base={'REMOTE_ADDR': f'10.0.0.{i}'})
+            assert response.status_code == 302
+        client = app.test_client()
+        for _ in range(limit - 1):
+            assert client.post('/login', data={'login': 'Joker', 'password': 'wrong', 'is_medic': 'on'}).status_code == 200
+        assert client.post('/login', data={'login': 'Joker', 'password': '19341934', 'is_medic': 'on'}).status_code == 302
+        for _ in range(limit - 1):
+            assert client.post('/login', data={'login': 'Joker', 'password': 'wrong', 'is_medic': 'on'}).status_code == 200
+        print("✅ Лимит по логину считает только неудачные попытки")
+    finally:
+        rate_limiter.reset()
+
+
+def test_recover_ip_limit():
+    """Окно по IP учитывает X-Forwarded-For от доверенного прокси"""
+    app.config['TESTING'] = True
+    rate_limiter.reset()
+    client = app.test_client()
+    limit = rate_limiter.policies['recover_ip']['limit']
+    bot = {'X-Forwarded-For': '198.51.100.1, 203.0.113.7'}
+    trusted_proxies = umay.RATE_LIMIT_TRUSTED_PROXIES
+    umay.RATE_LIMIT_TRUSTED_PROXIES = 1  # как за прокси Railway/Render
+    try:
+        for i in range(limit):
+            response = client.post('/recover', data={'email': f'ratelimit{i}@example.com'}, headers=bot)
+            assert response.status_code == 200
+        # Подменённый первый адрес не помогает: ключ — адрес, дописанный прокси
+        spoofed = {'X-Forwarded-For': '192.0.2.99, 203.0.113.7'}
+        assert client.post('/recover', data={'email': 'x@example.com'}, headers=spoofed).status_code == 429
+        other = {'X-Forwarded-For': '203.0.113.8'}
+        assert client.post('/recover', data={'email': 'x@example.com'}, headers=other).status_code == 200
+        assert client.get('/recover', headers=bot).status_code == 200, "GET не ограничивается"
+
+        # Без доверенных прокси заголовок игнорируется: ключ — адрес соединения
+        umay.RATE_LIMIT_TRUSTED_PROXIES = 0
+        rate_limiter.reset()
+        for i in range(limit):
+            headers = {'X-Forwarded-For': f'192.0.2.{i}'}
+            client.post('/recover', data={'email': f'ratelimit{i}@example.com'}, headers=headers)
+        assert client.post('/recover', data={'email': 'x@example.com'}, headers=other).status_code == 429
+        print("✅ Лимит по IP работает")
+    finally:
+        umay.RATE_LIMIT_TRUSTED_PROXIES = trusted_proxies
+        rate_limiter.reset()
+
+
+if __name__ == "__main__":
+    test_login_identity_limit()
+    test_login_identity_counts_failures_only()
+    test_recover_ip_limit()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Скрипт для тестирования параллельных регистраций (всплеск после рассылки)
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import app as umay
+from app import app, db, EmailOutbox, EmailVerification, UserMama, generate_email_token
+
+BURST_SIZE = 200
+DUPLICATES = 20  # столько запросов повторяют чужой логин/email
+
+
+def _cleanup():
+    EmailOutbox.query.filter(EmailOutbox.recipient.like('burst.test%')).delete(synchronize_session=False)
+    EmailVerification.query.filter(EmailVerification.email.like('burst.test%')).delete(synchronize_session=False)
+    for user in UserMama.query.filter(UserMama.login.like('burst_test_%')).all():
+        db.session.delete(user)
+    db.session.commit()
+
+
+def _register(i):
+    client = app.test_client()
+    n = i % (BURST_SIZE - DUPLICATES)
+    response = client.post('/register', data={
+        'full_name': f'Всплеск {n}', 'login': f'burst_test_{n}', 'email': f'burst.test{n}@example.com',
+        'password': 'secret123', 'confirm_password': 'secret123', 'user_type': 'user', 'app_type': 'mama',
+    })
+    body = response.get_data(as_text=True)
+    if response.status_code == 302:
+        return 'ok'
+    if 'уже существует' in body:
+        return 'duplicate'
+    return 'error'
+
+
+def test_email_tokens_unique():
+    """Токены, выпущенные в одну секунду, не совпадают"""
+    with app.app_context():
+        tokens = {generate_email_token() for _ in range(1000)}
+    assert len(tokens) == 1000
+    assert max(len(t) for t in tokens) <= 100
+
+
+def test_register_burst():
+    """Параллельные регистрации не падают на коллизиях токенов; дубликаты получают понятный отказ"""
+    app.config['TESTING'] = True
+    method = umay.PASSWORD_HASH_METHOD
+    umay.PASSWORD_HASH_METHOD = 'pbkdf2:sha256:1000'  # тест про конкурентность, а не про стоимость хэша
+    app.config['RATELIMIT_ENABLED'] = False  # все запросы идут с одного адреса
+    with app.app_context():
+        _cleanup()
+    try:
+        with ThreadPoolExecutor(max_workers=32) as pool:
+            results = list(pool.map(_register, range(BURST_SIZE)))
+        assert results.count('error') == 0, results
+        assert results.count('ok') == BURST_SIZE - DUPLICATES
+        assert results.count('duplicate') == DUPLICATES
+        with app.app_context():
+            users = UserMama.query.filter(UserMama.login.like('burst_test_%')).all()
+            assert len(users) == BURST_SIZE - DUPLICATES
+            assert len({u.email_verification_token for u in users}) == len(users)
+        print(f"✅ {BURST_SIZE} параллельных регистраций без ошибок")
+    finally:
+        umay.PASSWORD_HASH_METHOD = method
+        app.config['RATELIMIT_ENABLED'] = True
+        with app.app_context():
+            _cleanup()
+
+
+if __name__ == "__main__":
+    test_email_tokens_unique()
+    test_register_burst()
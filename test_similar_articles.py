@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Скрипт для тестирования предрасчитанных похожих статей (TF-IDF)
+"""
+
+from sqlalchemy import event
+
+import app as umay
+from app import (app, db, MamaContent, SimilarArticle, rebuild_similar_articles, similar_articles,
+                 similar_articles_for, similar_articles_job)
+
+MARKER = 'Похожтест'
+
+
+def _cleanup():
+    ids = []
+    for article in MamaContent.query.filter(MamaContent.title.like(f'{MARKER}%')).all():
+        ids.append(article.id)
+        db.session.delete(article)
+    SimilarArticle.query.filter(SimilarArticle.article_id.in_(ids) | SimilarArticle.similar_id.in_(ids)).delete(
+        synchronize_session=False)
+    db.session.commit()
+
+
+def _article(title, content, category='nutrition'):
+    return MamaContent(title=f'{MARKER}: {title}', content=content, category=category, trimester='all')
+
+
+def test_similar_articles():
+    """Соседи по смыслу, а не по дате; правка статьи пересчитывает затронутые списки"""
+    app.config['TESTING'] = True
+    client = app.test_client()
+    with app.app_context():
+        _cleanup()
+        try:
+            iron = _article('железо и гемоглобин', 'Анемия беременных: железо, гемоглобин, анализ крови, ферритин.')
+            anemia = _article('анемия у беременных', 'Низкий гемоглобин и дефицит железа лечат препаратами железа.',
+                              category='doctor_advice')
+            yoga = _article('йога для беременных', 'Дыхание, растяжка и упражнения на фитболе.', category='sport')
+            newest = _article('рецепт салата', 'Огурцы, помидоры, оливковое масло.')
+            db.session.add_all([iron, anemia, yoga, newest])
+            db.session.commit()
+            rebuild_similar_articles()
+            similar_articles.refresh()  # очередь коммита выше уже учтена полным пересчётом
+
+            assert similar_articles_for(iron)[0].id == anemia.id, "ближайшая — про железо, а не новейшая"
+
+            statements = []
+
+            def count(conn, cursor, statement, *args):
+                if 'similar_article' in statement:
+                    statements.append(statement)
+
+            event.listen(db.engine, 'before_cursor_execute', count)
+            try:
+                body = client.get(f'/mama/article/{iron.id}').get_data(as_text=True)
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', count)
+            assert len(statements) == 1
+            assert 'анемия у беременных' in body
+
+            # Статья про фитбол становится статьёй про железо — попадает в соседи iron
+            yoga.content = 'Продукты, богатые железом, повышают гемоглобин и ферритин.'
+            db.session.commit()
+            assert similar_articles_job.run_once()['updated'] >= 2
+            assert yoga.id in [a.id for a in similar_articles_for(iron)]
+
+            anemia.is_published = False
+            db.session.commit()
+            similar_articles_job.run_once()
+            assert anemia.id not in [a.id for a in similar_articles_for(iron)]
+            assert SimilarArticle.query.filter_by(article_id=anemia.id).count() == 0
+            print("✅ Похожие статьи работают")
+        finally:
+            _cleanup()
+
+
+def _hold_similar_articles_lock():
+    """Держит блокировку пересчёта «из другого воркера»: отдельное соединение на PostgreSQL."""
+    if umay.is_postgresql():
+        connection = db.engine.connect()
+        connection.begin()
+        connection.execute(db.text('SELECT pg_advisory_xact_lock(:key)'), {'key': umay.SIMILAR_ARTICLES_LOCK_KEY})
+        return connection.close
+    original = umay._lock_similar_articles
+    umay._lock_similar_articles = lambda: False
+    return lambda: setattr(umay, '_lock_similar_articles', original)
+
+
+def test_rebuild_skipped_while_locked():
+    """Пока другой воркер пересчитывает таблицу, пересчёт пропускается, а очередь сохраняется"""
+    with app.app_context():
+        _cleanup()
+        try:
+            article = _article('пропуск пересчёта', 'Железо и гемоглобин.')
+            db.session.add(article)
+            db.session.commit()
+            release = _hold_similar_articles_lock()
+            try:
+                assert rebuild_similar_articles() is None
+                similar_articles.rebuilt_at -= umay.SIMILAR_ARTICLES_REBUILD_SEC
+                assert similar_articles.refresh() == {'rebuilt': 0, 'skipped': 'locked'}
+                similar_articles.mark([article.id])
+                assert similar_articles.refresh() == {'updated': 0, 'skipped': 'locked'}
+            finally:
+                release()
+            assert similar_articles.refresh()['updated'] >= 1, "очередь не потеряна"
+            assert rebuild_similar_articles() >= 1
+            print("✅ Пересчёт похожих статей сериализован между воркерами")
+        finally:
+            _cleanup()
+
+
+if __name__ == "__main__":
+    test_similar_articles()
+    test_rebuild_skipped_while_locked()
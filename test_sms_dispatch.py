@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Скрипт для тестирования очереди SMS и размыкателей провайдеров на локальных HTTP-заглушках
+"""
+
+import json
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import app as umay
+from app import (app, db, OTPCode, SMSOutbox, SMS_PROVIDERS, SMS_PROVIDER_ORDER, process_sms_outbox,
+                 send_otp, send_sms, sms_breakers)
+
+TEST_PHONE = '+77011234567'
+
+
+class ProviderStandIn:
+    """HTTP-заглушка провайдера: status/body задаются тестом, запросы считаются."""
+
+    def __init__(self, status=200, body=None, delay=0):
+        self.status = status
+        self.body = body or {}
+        self.delay = delay
+        self.requests = []
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                stand_in.requests.append((self.path, self.rfile.read(length).decode('utf-8')))
+                time.sleep(stand_in.delay)
+                payload = json.dumps(stand_in.body).encode('utf-8')
+                self.send_response(stand_in.status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def _configure(mobizon, infobip):
+    SMS_PROVIDERS['mobizon'].update(base_url=mobizon.url, api_key='test-mobizon-key')
+    SMS_PROVIDERS['infobip'].update(base_url=infobip.url, api_key='test-infobip-key')
+    SMS_PROVIDER_ORDER[:] = ['mobizon', 'infobip']
+    for breaker in sms_breakers.values():
+        breaker.record_success()
+
+
+def test_sms_circuit_breaker():
+    """Сбойный Mobizon переключает на Infobip, после порога Mobizon не вызывается"""
+    mobizon = ProviderStandIn(status=500)
+    infobip = ProviderStandIn(status=200, body={'messages': [{'status': {'groupName': 'PENDING'}}]})
+    saved = {name: dict(config) for name, config in SMS_PROVIDERS.items()}, list(SMS_PROVIDER_ORDER)
+    try:
+        _configure(mobizon, infobip)
+        threshold = sms_breakers['mobizon'].failure_threshold
+        for _ in range(threshold):
+            assert send_sms(TEST_PHONE, 'test') == 'infobip'
+        assert len(mobizon.requests) == threshold
+        assert sms_breakers['mobizon'].state == 'open'
+
+        assert send_sms(TEST_PHONE, 'test') == 'infobip'
+        assert len(mobizon.requests) == threshold, "разомкнутый провайдер не должен вызываться"
+        assert len(infobip.requests) == threshold + 1
+
+        mobizon.status = 200
+        mobizon.body = {'code': 0, 'data': {'messageId': '1'}}
+        sms_breakers['mobizon'].opened_at -= sms_breakers['mobizon'].reset_timeout
+        assert send_sms(TEST_PHONE, 'test') == 'mobizon'
+        assert sms_breakers['mobizon'].state == 'closed'
+        print("✅ Размыкатель SMS-провайдеров работает")
+    finally:
+        for name, config in saved[0].items():
+            SMS_PROVIDERS[name].update(config)
+        SMS_PROVIDER_ORDER[:] = saved[1]
+        mobizon.close()
+        infobip.close()
+
+
+def test_send_otp_is_queued():
+    """send_otp не ждёт медленного провайдера, диспетчер отправляет из очереди"""
+    mobizon = ProviderStandIn(status=200, body={'code': 0, 'data': {'messageId': '1'}}, delay=1.5)
+    infobip = ProviderStandIn(status=500)
+    saved = {name: dict(config) for name, config in SMS_PROVIDERS.items()}, list(SMS_PROVIDER_ORDER)
+    with app.app_context():
+        OTPCode.query.filter_by(phone=TEST_PHONE).delete()
+        SMSOutbox.query.filter_by(phone=TEST_PHONE).delete()
+        db.session.commit()
+        try:
+            _configure(mobizon, infobip)
+            started = time.perf_counter()
+            ok, message = send_otp('8 701 123 45 67', 'register')
+            assert ok, message
+            assert time.perf_counter() - started < 1.0
+            assert mobizon.requests == []
+
+            queued = SMSOutbox.query.filter_by(phone=TEST_PHONE).one()
+            assert queued.status == 'pending'
+            assert OTPCode.query.filter_by(phone=TEST_PHONE).one().code in queued.text
+
+            assert process_sms_outbox()['sent'] == 1
+            db.session.refresh(queued)
+            assert queued.status == 'sent'
+            assert queued.provider == 'mobizon'
+            assert queued.text == ''
+            assert TEST_PHONE.lstrip('+') in mobizon.requests[0][1]
+            print("✅ OTP ставится в очередь и отправляется в фоне")
+        finally:
+            for name, config in saved[0].items():
+                SMS_PROVIDERS[name].update(config)
+            SMS_PROVIDER_ORDER[:] = saved[1]
+            mobizon.close()
+            infobip.close()
+            OTPCode.query.filter_by(phone=TEST_PHONE).delete()
+            SMSOutbox.query.filter_by(phone=TEST_PHONE).delete()
+            db.session.commit()
+
+
+def test_sms_sent_outside_transaction():
+    """Провайдер вызывается без открытой транзакции, результат каждого SMS фиксируется сразу"""
+    calls = []
+
+    def fake_send_sms(phone, text, providers=None):
+        in_transaction = db.session().in_transaction()
+        row = db.session.query(SMSOutbox.next_attempt_at, SMSOutbox.attempts).filter_by(text=text).one()
+        calls.append((in_transaction, row.next_attempt_at > datetime.utcnow(), row.attempts,
+                      SMSOutbox.query.filter_by(phone=TEST_PHONE, status='sent').count()))
+        db.session.rollback()
+        return 'mobizon'
+
+    with app.app_context():
+        SMSOutbox.query.filter_by(phone=TEST_PHONE).delete()
+        db.session.add_all([SMSOutbox(phone=TEST_PHONE, text=f'sms {i}') for i in range(2)])
+        db.session.commit()
+        send = umay.send_sms
+        umay.send_sms = fake_send_sms
+        try:
+            assert process_sms_outbox()['sent'] >= 2
+            # до отправки строка уже закреплена коммитом; второе SMS видит первое отправленным
+            assert calls[:2] == [(False, True, 1, 0), (False, True, 1, 1)], calls
+            print("✅ SMS отправляются вне транзакции пакета")
+        finally:
+            umay.send_sms = send
+            SMSOutbox.query.filter_by(phone=TEST_PHONE).delete()
+            db.session.commit()
+
+
+if __name__ == "__main__":
+    test_sms_circuit_breaker()
+    test_send_otp_is_queued()
+    test_sms_sent_outside_transaction()
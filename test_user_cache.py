@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Скрипт для тестирования кэша пользователей load_user (memo + TTL LRU)
+"""
+
+from sqlalchemy import event
+
+from app import app, db, UserPro, load_user, user_cache
+
+
+def _count_user_queries(action):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if 'FROM user_pro' in statement:
+            statements.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        action()
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+    return len(statements)
+
+
+def test_load_user_cache():
+    """Повторные запросы не читают user_pro, смена профиля сбрасывает кэш"""
+    app.config['TESTING'] = True
+    client = app.test_client()
+    client.post('/login', data={'login': 'Joker', 'password': '19341934', 'is_medic': 'on'})
+    with app.app_context():
+        admin = UserPro.query.filter_by(login='Joker').first()
+        key, old_phone = admin.get_id(), admin.phone
+    assert key == f'pro:{admin.id}'
+
+    user_cache.clear()
+    assert _count_user_queries(lambda: client.get('/api/analytics/summary')) == 1
+    assert _count_user_queries(lambda: client.get('/api/analytics/summary')) == 0
+    assert user_cache.get(key) is not None
+
+    try:
+        with app.test_request_context():
+            user = load_user(key)
+            assert load_user(key) is user
+            user.phone = '+77000000031'
+            db.session.commit()
+        assert user_cache.get(key) is None
+
+        with app.test_request_context():
+            assert load_user(key).phone == '+77000000031'
+            assert load_user('mama:999999') is None
+        print("✅ Кэш пользователей работает")
+    finally:
+        with app.app_context():
+            UserPro.query.filter_by(login='Joker').first().phone = old_phone
+            db.session.commit()
+
+
+if __name__ == "__main__":
+    test_load_user_cache()
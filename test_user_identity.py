@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Скрипт для тестирования единого индекса логинов/email (user_identity)
+"""
+
+from sqlalchemy.exc import IntegrityError
+
+from app import app, db, UserPro, UserMama, UserIdentity, find_user, rebuild_user_identity, user_identity_in_sync
+
+TEST_LOGIN = "identity_test_user"
+
+
+def _mama(**overrides):
+    fields = dict(
+        full_name='Тест Индекс', login=TEST_LOGIN, password='x', position='Пользователь',
+        city='Не указан', medical_institution='Не указано', department='Не указано',
+        email='Identity.Test@Example.com', email_verification_token='identity-test-token',
+    )
+    fields.update(overrides)
+    return UserMama(**fields)
+
+
+def _cleanup():
+    for model in (UserPro, UserMama):
+        for user in model.query.filter(model.login.like(f'{TEST_LOGIN}%')).all():
+            db.session.delete(user)
+    db.session.commit()
+
+
+def test_user_identity_index():
+    """Поиск по логину/email/токену, общие учётные записи Pro и Mama и починка индекса"""
+    with app.app_context():
+        _cleanup()
+        try:
+            user = _mama()
+            db.session.add(user)
+            db.session.commit()
+
+            assert find_user('login', TEST_LOGIN, app_type='mama').id == user.id
+            assert find_user('login', TEST_LOGIN, app_type='pro') is None
+            assert find_user('email', ' identity.test@example.COM').id == user.id
+            assert find_user('token', 'identity-test-token').id == user.id
+
+            # Новый пользователь другой системы с тем же логином не проходит уникальный индекс
+            pro_fields = dict(full_name='Тест Индекс', password='x', position='Акушерка', city='Шымкент',
+                              medical_institution='Роддом', department='Родовое')
+            db.session.add(UserPro(login=TEST_LOGIN, email='identity.pro@example.com', **pro_fields))
+            try:
+                db.session.commit()
+                assert False, "логин должен быть уникален между Pro и Mama"
+            except IntegrityError:
+                db.session.rollback()
+
+            # Старые общие логины/email Pro и Mama (до индекса) допустимы: каждая система находит своего
+            shared = UserPro(login=f'{TEST_LOGIN}_pro', email='identity.pro@example.com', **pro_fields)
+            db.session.add(shared)
+            db.session.commit()
+            db.session.execute(UserPro.__table__.update().where(UserPro.id == shared.id)
+                               .values(login=TEST_LOGIN, email='identity.test@example.com'))
+            db.session.commit()
+            rebuild_user_identity()
+            shared = db.session.get(UserPro, shared.id)
+            assert find_user('login', TEST_LOGIN, app_type='pro').id == shared.id
+            assert find_user('login', TEST_LOGIN, app_type='mama').id == user.id
+            assert isinstance(find_user('email', 'identity.test@example.com'), UserPro), "как раньше, Pro первым"
+            assert user_identity_in_sync()
+            shared.full_name = 'Тест Индекс 2'
+            shared.email_verification_token = 'identity-shared-token'  # пересохранение общих значений
+            db.session.commit()
+            assert find_user('login', TEST_LOGIN, app_type='pro').id == shared.id
+            db.session.delete(shared)
+            db.session.commit()
+
+            # Дубликаты внутри системы (email в разном регистре) пропускаются и не ломают проверку
+            twin = _mama(login=f'{TEST_LOGIN}_twin', email='other@example.com', email_verification_token=None)
+            db.session.add(twin)
+            db.session.commit()
+            db.session.execute(UserMama.__table__.update().where(UserMama.id == twin.id)
+                               .values(email='IDENTITY.test@example.com'))
+            db.session.commit()
+            rebuild_user_identity()
+            assert user_identity_in_sync(), "после пересборки с дубликатами индекс считается актуальным"
+            db.session.delete(db.session.get(UserMama, twin.id))
+            db.session.commit()
+
+            # Частично заполненный индекс чинится пересборкой
+            UserIdentity.query.filter_by(app_type='mama', user_id=user.id, kind='login').delete()
+            db.session.commit()
+            assert not user_identity_in_sync()
+            rebuild_user_identity()
+            assert find_user('login', TEST_LOGIN, app_type='mama').id == user.id
+
+            duplicate = _mama(login=f'{TEST_LOGIN}_2', email_verification_token=None)
+            db.session.add(duplicate)
+            try:
+                db.session.commit()
+                assert False, "email должен быть уникален внутри системы"
+            except IntegrityError:
+                db.session.rollback()
+
+            user = db.session.get(UserMama, user.id)
+            user.email_verification_token = None
+            user.email = 'identity.changed@example.com'
+            db.session.commit()
+            assert find_user('token', 'identity-test-token') is None
+            assert find_user('email', 'identity.test@example.com') is None
+            assert find_user('email', 'identity.changed@example.com').id == user.id
+
+            user_id = user.id
+            db.session.delete(user)
+            db.session.commit()
+            assert UserIdentity.query.filter_by(app_type='mama', user_id=user_id).count() == 0
+            print("✅ Единый индекс идентификаторов работает")
+        finally:
+            db.session.rollback()
+            _cleanup()
+
+
+if __name__ == "__main__":
+    test_user_identity_index()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Скрипт для тестирования буферизованных счётчиков просмотров
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import event
+
+from app import app, db, MamaContent, News, flush_view_counters, view_counters
+
+TEST_AUTHOR = "Тест просмотров"
+
+
+def _cleanup():
+    MamaContent.query.filter_by(author=TEST_AUTHOR).delete()
+    News.query.filter_by(author=TEST_AUTHOR).delete()
+    db.session.commit()
+
+
+def test_buffered_view_counters():
+    """Просмотры не пишут в базу, параллельные просмотры не теряются при сбросе"""
+    app.config['TESTING'] = True
+    with app.app_context():
+        flush_view_counters()  # просмотры из других тестов
+        _cleanup()
+        news = News(title='Просмотры', short_description='-', full_content='<p>-</p>', author=TEST_AUTHOR, views=5)
+        article = MamaContent(title='Просмотры', content='-', category='sport', author=TEST_AUTHOR)
+        db.session.add_all([news, article])
+        db.session.commit()
+        news_id, article_id = news.id, article.id
+    writes = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if not statement.lstrip().upper().startswith('SELECT'):
+            writes.append(statement)
+
+    try:
+        with app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            def view(i):
+                client = app.test_client()
+                url = f'/news/{news_id}' if i % 2 else f'/mama/article/{article_id}'
+                return client.get(url).status_code
+            with ThreadPoolExecutor(max_workers=8) as pool:
+                assert set(pool.map(view, range(100))) == {200}
+        finally:
+            event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+        assert writes == [], "просмотр не должен писать в базу"
+        assert view_counters.pending(News, news_id) == 50
+
+        body = app.test_client().get(f'/news/{news_id}').get_data(as_text=True)
+        assert '56 просмотров' in body, "показываем сохранённое значение плюс буфер"
+
+        with app.app_context():
+            assert flush_view_counters() == {'news': 51, 'mama_content': 50}
+            assert db.session.get(News, news_id).views == 56
+            assert db.session.get(MamaContent, article_id).views == 50
+        assert view_counters.pending(News, news_id) == 0
+        print("✅ Буфер просмотров работает")
+    finally:
+        with app.app_context():
+            flush_view_counters()
+            _cleanup()
+
+
+if __name__ == "__main__":
+    test_buffered_view_counters()